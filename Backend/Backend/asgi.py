@@ -5,6 +5,10 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
+
+Serve it with an ASGI server (e.g. ``uvicorn Backend.asgi:application``) so
+the render progress streams at /api/jobs/<id>/events/ are held open by the
+event loop instead of tying up a worker thread each.
 """
 
 import os
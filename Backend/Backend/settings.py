@@ -167,3 +167,91 @@ REST_FRAMEWORK = {
     ],
 }
 
+
+# Render job settings
+# Maximum number of renders running at once in each web process
+RENDER_MAX_WORKERS = config('RENDER_MAX_WORKERS', default=2, cast=int)
+
+# Rendered text sprites (watermark, text overlay) shared between renders
+SPRITE_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'sprites')
+SPRITE_CACHE_MAX_ITEMS = config('SPRITE_CACHE_MAX_ITEMS', default=64, cast=int)
+# Sprite files on disk, least recently used removed first past this size
+SPRITE_DISK_CACHE_MAX_BYTES = config('SPRITE_DISK_CACHE_MAX_BYTES', default=64 * 1024 * 1024, cast=int)
+
+# Upload limits, checked while the request body streams in
+MAX_UPLOAD_FILE_SIZE = config('MAX_UPLOAD_FILE_SIZE', default=1024 * 1024 * 1024, cast=int)
+MAX_UPLOAD_REQUEST_SIZE = config('MAX_UPLOAD_REQUEST_SIZE', default=3 * 1024 * 1024 * 1024, cast=int)
+
+# Finished renders kept for identical repeat requests, evicted least recently used first
+RENDER_CACHE_MAX_BYTES = config('RENDER_CACHE_MAX_BYTES', default=20 * 1024 * 1024 * 1024, cast=int)
+
+# Short looped clips (video2, background music) are decoded once and kept in memory up to this size
+LOOP_CACHE_MAX_BYTES = config('LOOP_CACHE_MAX_BYTES', default=256 * 1024 * 1024, cast=int)
+
+# Layout previews: sources kept open between requests and the decoded frames they hold
+PREVIEW_SOURCE_CACHE_ITEMS = config('PREVIEW_SOURCE_CACHE_ITEMS', default=8, cast=int)
+PREVIEW_CACHE_MAX_BYTES = config('PREVIEW_CACHE_MAX_BYTES', default=256 * 1024 * 1024, cast=int)
+# Files uploaded only for previews are removed after this many seconds without use
+PREVIEW_INPUT_TTL = config('PREVIEW_INPUT_TTL', default=3600, cast=int)
+
+# Batch renders: shared video2 frames and music decoded once per batch
+PREPARED_ASSET_DIR = os.path.join(BASE_DIR, 'cache', 'prepared')
+BATCH_PREPARED_MAX_BYTES = config('BATCH_PREPARED_MAX_BYTES', default=1024 * 1024 * 1024, cast=int)
+MAX_BATCH_ITEMS = config('MAX_BATCH_ITEMS', default=50, cast=int)
+
+# Segmented renders: processes per render (0 = the cores of one render worker)
+# and the shortest video worth splitting
+RENDER_SEGMENT_WORKERS = config('RENDER_SEGMENT_WORKERS', default=0, cast=int)
+RENDER_SEGMENT_MIN_SECONDS = config('RENDER_SEGMENT_MIN_SECONDS', default=10, cast=float)
+
+# Resumable chunked uploads: largest chunk per PUT, how long an unfinished
+# upload is kept, and how long a finished asset is kept after its last use
+UPLOAD_CHUNK_MAX_SIZE = config('UPLOAD_CHUNK_MAX_SIZE', default=64 * 1024 * 1024, cast=int)
+UPLOAD_SESSION_TTL = config('UPLOAD_SESSION_TTL', default=24 * 3600, cast=int)
+UPLOAD_ASSET_TTL = config('UPLOAD_ASSET_TTL', default=7 * 24 * 3600, cast=int)
+
+# Finished outputs are deleted after this many seconds without being requested,
+# on top of the RENDER_CACHE_MAX_BYTES quota
+RENDER_OUTPUT_TTL = config('RENDER_OUTPUT_TTL', default=7 * 24 * 3600, cast=int)
+# How outputs are sent: 'django' (Range-aware file response), 'x-accel-redirect'
+# (nginx, with OUTPUT_ACCEL_PREFIX an internal location aliasing
+# MEDIA_ROOT/output_videos/) or 'x-sendfile' (Apache mod_xsendfile, lighttpd)
+OUTPUT_SERVE_MODE = config('OUTPUT_SERVE_MODE', default='django')
+OUTPUT_ACCEL_PREFIX = config('OUTPUT_ACCEL_PREFIX', default='/protected/output_videos/')
+
+# Inputs are probed before a render is queued and rejected outside these limits
+MAX_INPUT_DURATION = config('MAX_INPUT_DURATION', default=3600, cast=float)
+MIN_INPUT_DIMENSION = config('MIN_INPUT_DIMENSION', default=16, cast=int)
+MAX_INPUT_DIMENSION = config('MAX_INPUT_DIMENSION', default=8192, cast=int)
+
+# Render progress: how often workers write frame counts and the event stream
+# endpoint polls them, in seconds
+RENDER_PROGRESS_INTERVAL = config('RENDER_PROGRESS_INTERVAL', default=0.5, cast=float)
+
+# Memory admission: jobs are handed to the render workers while the sum of
+# their estimated ceilings (see combine_video/memory.py) fits in this many
+# bytes; 0 admits every job. A job larger than the budget runs alone
+RENDER_MEMORY_BUDGET = config('RENDER_MEMORY_BUDGET', default=0, cast=int)
+
+# Job recovery: each web process stamps the jobs it holds every
+# RENDER_HEARTBEAT_INTERVAL seconds; queued or running jobs without a stamp
+# for RENDER_JOB_STALE_SECONDS were left by a stopped process and are taken
+# over (see combine_video/jobs.py). An interval of 0 turns this off
+RENDER_HEARTBEAT_INTERVAL = config('RENDER_HEARTBEAT_INTERVAL', default=10, cast=float)
+RENDER_JOB_STALE_SECONDS = config('RENDER_JOB_STALE_SECONDS', default=60, cast=float)
+# A job left running is started again until it has been started this many times
+RENDER_JOB_MAX_ATTEMPTS = config('RENDER_JOB_MAX_ATTEMPTS', default=2, cast=int)
+
+# Asset pool: each render worker keeps source readers, a looped video2's
+# frames and short music decoded between jobs, keyed by content hash (see
+# combine_video/asset_pool.py). Held on top of the jobs' memory ceilings;
+# 0 disables it. Idle entries close after ASSET_POOL_IDLE_SECONDS
+ASSET_POOL_MAX_BYTES = config('ASSET_POOL_MAX_BYTES', default=512 * 1024 * 1024, cast=int)
+ASSET_POOL_IDLE_SECONDS = config('ASSET_POOL_IDLE_SECONDS', default=300, cast=int)
+
+# Timed captions (SRT/WebVTT, see combine_video/captions.py): the largest
+# caption file and number of cues accepted, and the font file used when a
+# caption font name cannot be matched through fontconfig
+MAX_CAPTION_FILE_SIZE = config('MAX_CAPTION_FILE_SIZE', default=2 * 1024 * 1024, cast=int)
+MAX_CAPTION_CUES = config('MAX_CAPTION_CUES', default=10000, cast=int)
+CAPTION_FONT_PATH = config('CAPTION_FONT_PATH', default='')
@@ -1,3 +1,35 @@
 from django.contrib import admin
+from .models import RenderJob, RenderCacheEntry, RenderBatch, RenderBatchItem, UploadSession
 
-# Register your models here.
+
+@admin.register(RenderJob)
+class RenderJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'status', 'created_at', 'started_at', 'finished_at')
+    list_filter = ('status',)
+    readonly_fields = ('id', 'metrics', 'memory_ceiling', 'created_at', 'started_at', 'finished_at')
+
+
+@admin.register(RenderCacheEntry)
+class RenderCacheEntryAdmin(admin.ModelAdmin):
+    list_display = ('cache_key', 'job', 'output_size', 'hits', 'last_used_at')
+    readonly_fields = ('created_at', 'last_used_at')
+
+
+class RenderBatchItemInline(admin.TabularInline):
+    model = RenderBatchItem
+    readonly_fields = ('index', 'source_name', 'job')
+    extra = 0
+
+
+@admin.register(RenderBatch)
+class RenderBatchAdmin(admin.ModelAdmin):
+    list_display = ('id', 'created_at')
+    readonly_fields = ('id', 'created_at')
+    inlines = [RenderBatchItemInline]
+
+
+@admin.register(UploadSession)
+class UploadSessionAdmin(admin.ModelAdmin):
+    list_display = ('id', 'filename', 'status', 'size', 'received', 'updated_at')
+    list_filter = ('status',)
+    readonly_fields = ('id', 'sha256', 'path', 'created_at', 'updated_at')
@@ -4,3 +4,15 @@ from django.apps import AppConfig
 class CombineVideoConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'combine_video'
+
+    def ready(self):
+        from django.core.signals import request_started
+
+        # Jobs a stopped process left queued or running are recovered once this one serves requests
+        request_started.connect(_start_job_monitor, dispatch_uid='combine_video.start_job_monitor')
+
+
+def _start_job_monitor(**kwargs):
+    from .jobs import start_job_monitor
+
+    start_job_monitor()
@@ -0,0 +1,265 @@
+"""
+Process-local pool of source readers and short decoded assets.
+
+Render workers are reused across jobs, and the same B-roll and music come
+back in many of them. Opening a source costs an `ffmpeg -i` probe and a
+decoder process, and a looped video2 or a music track is then decoded
+whole. The pool keeps these between jobs, keyed by the asset's content
+hash (uploads are stored under their sha256, see upload_handlers.py) and
+the size they were decoded to:
+
+- region readers, used by one job at a time. A released reader is
+  rewound, so its ffmpeg process is already decoding the first frame when
+  the next job asks for the asset.
+- the frames of a video2 short enough to loop, decoded once and shared by
+  every job that loops it (what LoopedVideoClip would cache per job).
+- music decoded to PCM, shared likewise.
+
+Entries in use are reference counted and never evicted. Idle ones are
+closed after ASSET_POOL_IDLE_SECONDS, and least recently used first while
+the pool holds more than ASSET_POOL_MAX_BYTES. Decoded frames and samples
+are read-only, so a job cannot change what the next one sees.
+"""
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .audio import AUDIO_CHANNELS, AUDIO_FPS, decode_pcm
+from .memory import decoder_bytes
+from .prepared import PreparedVideoClip, decode_region_frames
+from .probe import get_probe
+from .readers import RegionVideoFileClip
+
+_content_address_re = re.compile(r'^([0-9a-f]{64})(\.[a-z0-9]{1,10})?$')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class PoolEntry:
+    """A value opened for a key, with what it costs and how to rewind and close it"""
+
+    def __init__(self, key, value, nbytes, close=None, reset=None, shared=False):
+        self.key = key
+        self.value = value
+        self.nbytes = nbytes
+        self.close = close
+        self.reset = reset
+        self.shared = shared
+        self.refs = 1
+        self.last_used = time.monotonic()
+
+
+class AssetPool:
+    """
+    Values kept between uses, by key. A shared value is handed to any
+    number of users at once; any other goes to one user at a time.
+    """
+
+    def __init__(self, max_bytes, idle_seconds):
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        # id(value) -> entry, least recently released first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.sweeper = None
+
+    @property
+    def nbytes(self):
+        return sum(entry.nbytes for entry in self.entries.values())
+
+    def checkout(self, key):
+        """A pooled value for `key`, now in use; None if there is none free"""
+        with self.lock:
+            for entry in self.entries.values():
+                if entry.key == key and (entry.shared or not entry.refs):
+                    entry.refs += 1
+                    return entry.value
+        return None
+
+    def add(self, key, value, nbytes, close=None, reset=None, shared=False):
+        """Pool a value just opened for `key`; it starts out in use by the caller"""
+        with self.lock:
+            self.entries[id(value)] = PoolEntry(key, value, nbytes, close, reset, shared)
+        return value
+
+    def release(self, value):
+        """Give back a value from checkout or add; values the pool does not hold are ignored"""
+        with self.lock:
+            entry = self.entries.get(id(value))
+        if entry is None or entry.value is not value:
+            return
+
+        if entry.reset is not None and entry.nbytes <= self.max_bytes:
+            try:
+                entry.reset(value)
+            except Exception as e:
+                print(f"Error rewinding pooled asset, closing it: {str(e)}")
+                self.discard(value)
+                return
+
+        with self.lock:
+            entry.refs -= 1
+            entry.last_used = time.monotonic()
+            self.entries.move_to_end(id(value))
+            evicted = self._evict(self.max_bytes)
+        self._close(evicted)
+        self._start_sweeper()
+
+    def discard(self, value):
+        """Close a value this caller holds instead of giving it back"""
+        with self.lock:
+            entry = self.entries.pop(id(value), None)
+        if entry is not None:
+            self._close([entry])
+
+    def sweep(self):
+        """Close entries idle for longer than idle_seconds"""
+        with self.lock:
+            evicted = self._evict(self.max_bytes, idle_before=time.monotonic() - self.idle_seconds)
+        self._close(evicted)
+
+    def clear(self):
+        """Close every idle entry"""
+        with self.lock:
+            evicted = self._evict(0)
+        self._close(evicted)
+
+    def _evict(self, max_bytes, idle_before=None):
+        """Remove idle entries, oldest first, until the rest fit in max_bytes; call with the lock held"""
+        total = self.nbytes
+        evicted = []
+        for entry_id, entry in list(self.entries.items()):
+            if entry.refs:
+                continue
+            expired = idle_before is not None and entry.last_used < idle_before
+            if total <= max_bytes and not expired:
+                continue
+            del self.entries[entry_id]
+            total -= entry.nbytes
+            evicted.append(entry)
+        return evicted
+
+    def _close(self, entries):
+        for entry in entries:
+            if entry.close is None:
+                continue
+            try:
+                entry.close(entry.value)
+            except Exception as e:
+                print(f"Error closing pooled asset: {str(e)}")
+
+    def _start_sweeper(self):
+        with self.lock:
+            if self.sweeper is not None or not self.idle_seconds:
+                return
+            self.sweeper = threading.Thread(target=self._sweep_forever, daemon=True)
+        self.sweeper.start()
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(max(1, self.idle_seconds / 4))
+            self.sweep()
+
+
+def get_pool():
+    """Return this process's pool, creating it on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = AssetPool(settings.ASSET_POOL_MAX_BYTES, settings.ASSET_POOL_IDLE_SECONDS)
+        return _pool
+
+
+def release(value):
+    """Give a value from open_region_clip or music_samples back to the pool"""
+    if value is not None:
+        get_pool().release(value)
+
+
+def content_hash(path):
+    """The sha256 a stored upload is named by, or None for other files"""
+    match = _content_address_re.match(os.path.basename(path))
+    return match.group(1) if match else None
+
+
+def asset_key(path):
+    """Identity of a source: its content hash, or the path, size and mtime of files not stored by hash"""
+    sha256 = content_hash(path)
+    if sha256:
+        return sha256
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def _rewind_clip(clip):
+    """Put a clip's reader back on its first frame, as a freshly opened one is"""
+    reader = clip.reader
+    reader.initialize()
+    reader.pos = 1
+    reader.lastread = reader.read_frame()
+
+
+def _clip_bytes(clip):
+    """A region reader's ffmpeg process and frame buffers"""
+    width, height = clip.reader.infos['video_size']
+    return decoder_bytes({'width': width, 'height': height}) + 3 * clip.w * clip.h * 3
+
+
+def open_region_clip(path, size, crop=None, loop_duration=None):
+    """
+    The video at `path` fitted to a region of `size`, as
+    RegionVideoFileClip(audio=False, reuse_buffers=True) opens it. A video
+    shorter than loop_duration whose frames fit in LOOP_CACHE_MAX_BYTES is
+    decoded whole and shared instead (a PreparedVideoClip). Give it back
+    with release() rather than closing it.
+    """
+    pool = get_pool()
+    key = asset_key(path)
+
+    frames = pool.checkout((key, 'frames', size, crop))
+    if frames is not None:
+        return frames
+
+    clip = pool.checkout((key, 'reader', size, crop))
+    if clip is None:
+        clip = RegionVideoFileClip(path, size, crop=crop, audio=False, reuse_buffers=True)
+        pool.add((key, 'reader', size, crop), clip, _clip_bytes(clip),
+                 close=lambda c: c.close(), reset=_rewind_clip)
+    if loop_duration is None or clip.duration >= loop_duration:
+        return clip
+
+    frames, info = decode_region_frames(clip, min(settings.LOOP_CACHE_MAX_BYTES, pool.max_bytes))
+    if frames is None:
+        return clip
+    # The frames replace the reader for this asset
+    pool.discard(clip)
+    frames.setflags(write=False)
+    return pool.add((key, 'frames', size, crop), PreparedVideoClip(frames, info['fps'], info['duration']),
+                    frames.nbytes, shared=True)
+
+
+def music_samples(path):
+    """
+    The music at `path` decoded to float32 PCM, or None when its samples
+    would take more than LOOP_CACHE_MAX_BYTES and it is better streamed.
+    Give it back with release().
+    """
+    pool = get_pool()
+    key = (asset_key(path), 'pcm', AUDIO_FPS, AUDIO_CHANNELS)
+
+    samples = pool.checkout(key)
+    if samples is not None:
+        return samples
+
+    # Uploads were probed when the render was requested, so this is a lookup
+    duration = get_probe(path, content_hash(path))['duration']
+    max_bytes = min(settings.LOOP_CACHE_MAX_BYTES, pool.max_bytes)
+    if not duration or duration * AUDIO_FPS * AUDIO_CHANNELS * 4 > max_bytes:
+        return None
+    samples = decode_pcm(path)
+    return pool.add(key, samples, samples.nbytes, shared=True)
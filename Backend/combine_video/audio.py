@@ -0,0 +1,398 @@
+"""
+Vectorized audio mixing.
+
+Both tracks are decoded once by ffmpeg straight to float32 PCM. The music
+is then tiled to length, gained (optionally ducked under video1's speech),
+summed with video1's audio and peak limited in whole-array NumPy
+operations. This replaces the per-chunk clip tree MoviePy builds for
+looping, volumex and CompositeVideoClip audio.
+
+Renders stream the same mix (mixed_chunks): whole tracks of a long video
+come to hundreds of MB per array, so only the per-block levels are kept
+for the whole duration and the samples are produced about a second at a
+time from a single decode of each source. Ducking and the limiter only
+look a block or two ahead, so each second waits for the next to be decoded
+and mixed, and its levels are worked out over the blocks around it alone.
+The result is identical to mix_tracks.
+"""
+import collections
+import subprocess
+
+import numpy as np
+from moviepy.config import get_setting
+
+from .streaming import EncoderPipe
+
+AUDIO_FPS = 44100
+AUDIO_CHANNELS = 2
+
+# Ducking: the music drops by DUCK_GAIN while video1 is louder than the threshold
+DUCK_THRESHOLD = 10 ** (-30 / 20)     # block RMS, -30 dBFS
+DUCK_GAIN = 10 ** (-10 / 20)
+DUCK_BLOCK_SECONDS = 0.05
+DUCK_HOLD_SECONDS = 0.3               # stay ducked through short pauses
+DUCK_RAMP_SECONDS = 0.15
+
+# Peak limiter: keeps the sum under the ceiling so 16 bit output never wraps
+LIMITER_CEILING = 10 ** (-1 / 20)
+LIMITER_BLOCK_SECONDS = 0.01
+
+
+def pcm_command(path, duration=None, fps=AUDIO_FPS, nchannels=AUDIO_CHANNELS):
+    """ffmpeg command writing the first audio stream of `path` to stdout as float32 PCM"""
+    cmd = [get_setting("FFMPEG_BINARY"), '-v', 'error', '-i', path]
+    if duration is not None:
+        cmd += ['-t', str(duration)]
+    return cmd + ['-vn', '-f', 'f32le', '-acodec', 'pcm_f32le', '-ar', str(fps), '-ac', str(nchannels), '-']
+
+
+def decode_pcm(path, duration=None, fps=AUDIO_FPS, nchannels=AUDIO_CHANNELS):
+    """Decode the first audio stream of `path` to a float32 (samples, channels) array"""
+    cmd = pcm_command(path, duration, fps, nchannels)
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        error = result.stderr.decode('utf-8', errors='replace').strip()
+        raise RuntimeError(f"Could not decode audio from {path}: {error[-500:]}")
+    return np.frombuffer(result.stdout, dtype='<f4').reshape(-1, nchannels)
+
+
+def _block_view(signal, block):
+    """Zero-pad a 1-D signal to whole blocks and reshape it to (blocks, block)"""
+    nblocks = -(-len(signal) // block)
+    padded = np.zeros(nblocks * block, dtype=signal.dtype)
+    padded[:len(signal)] = signal
+    return padded.reshape(nblocks, block)
+
+
+def _block_centers(nblocks, block):
+    return (np.arange(nblocks) + 0.5) * block
+
+
+def speech_blocks(voice, fps=AUDIO_FPS):
+    """Whether each DUCK_BLOCK_SECONDS block of `voice` is above DUCK_THRESHOLD"""
+    blocks = _block_view(voice.mean(axis=1), int(fps * DUCK_BLOCK_SECONDS))
+    return np.sqrt(np.mean(blocks ** 2, axis=1)) > DUCK_THRESHOLD
+
+
+def ducking_levels(speech):
+    """Music gain per ducking block for the speech blocks of a whole track"""
+    # Keep ducking for the hold time after each speech block
+    hold = int(round(DUCK_HOLD_SECONDS / DUCK_BLOCK_SECONDS))
+    held = np.convolve(speech, np.ones(hold + 1))[:len(speech)] > 0
+    gain = np.where(held, DUCK_GAIN, 1.0)
+
+    # Ramp between the levels instead of switching
+    ramp = max(1, int(round(DUCK_RAMP_SECONDS / DUCK_BLOCK_SECONDS)))
+    return np.convolve(np.pad(gain, (ramp // 2, ramp - 1 - ramp // 2), mode='edge'), np.ones(ramp) / ramp, mode='valid')
+
+
+def block_gain(levels, block, start, stop, first=0):
+    """
+    Per-sample gain of samples [start, stop), interpolated between the block
+    centres of `levels`, the levels of the blocks from number `first` on
+    """
+    return np.interp(np.arange(start, stop), _block_centers(first + len(levels), block)[first:], levels)
+
+
+def ducking_gain(voice, fps=AUDIO_FPS):
+    """Per-sample music gain (0..1) that dips while `voice` is above DUCK_THRESHOLD"""
+    levels = ducking_levels(speech_blocks(voice, fps))
+    return block_gain(levels, int(fps * DUCK_BLOCK_SECONDS), 0, len(voice)).astype('float32')
+
+
+def block_peaks(samples, fps=AUDIO_FPS):
+    """Largest absolute sample of each LIMITER_BLOCK_SECONDS block"""
+    peaks = np.abs(samples).max(axis=1) if len(samples) else np.zeros(0)
+    return _block_view(peaks, int(fps * LIMITER_BLOCK_SECONDS)).max(axis=1)
+
+
+def limiter_levels(peaks, ceiling=LIMITER_CEILING):
+    """
+    Gain per limiter block for the block peaks of a whole track: the
+    required reduction, lowered to its neighbours' so it is already down
+    when a peak arrives. Interpolated between block centres, every sample
+    ends up at or under the ceiling.
+    """
+    required = np.minimum(1.0, ceiling / np.maximum(peaks, 1e-9))
+    return np.minimum(required, np.minimum(np.r_[required[1:], 1.0], np.r_[1.0, required[:-1]]))
+
+
+def limit_peaks(samples, fps=AUDIO_FPS, ceiling=LIMITER_CEILING):
+    """Scale `samples` in place so no sample exceeds `ceiling`"""
+    peaks = block_peaks(samples, fps)
+    if not len(peaks) or peaks.max() <= ceiling:
+        return samples
+
+    gain = limiter_levels(peaks, ceiling)
+    samples *= block_gain(gain, int(fps * LIMITER_BLOCK_SECONDS), 0, len(samples))[:, None].astype('float32')
+    return samples
+
+
+def mix_tracks(voice, music, duration, fps=AUDIO_FPS, music_volume=0.3, duck=False, limit=True):
+    """
+    Mix video1's audio with music looped to `duration` seconds.
+
+    voice and music are float32 (samples, channels) arrays or None. Returns
+    a new float32 array of exactly `duration` seconds.
+    """
+    length = int(round(duration * fps))
+    mixed = np.zeros((length, AUDIO_CHANNELS), dtype='float32')
+    if voice is not None:
+        used = min(length, len(voice))
+        mixed[:used] = voice[:used]
+
+    if music is not None and len(music):
+        gain = music_volume
+        if duck and voice is not None:
+            gain = ducking_gain(mixed, fps)[:, None] * music_volume
+
+        # Add the music one loop at a time rather than materializing the tiled track
+        for start in range(0, length, len(music)):
+            stop = min(length, start + len(music))
+            loop_gain = gain if np.ndim(gain) == 0 else gain[start:stop]
+            mixed[start:stop] += music[:stop - start] * loop_gain
+
+    if limit:
+        limit_peaks(mixed, fps)
+    return mixed
+
+
+class PCMDecoder:
+    """An ffmpeg process decoding the first audio stream of `path` to float32 PCM, read in pieces"""
+
+    def __init__(self, path, duration=None, fps=AUDIO_FPS, nchannels=AUDIO_CHANNELS):
+        self.path = path
+        self.nchannels = nchannels
+        self.finished = False
+        self.proc = subprocess.Popen(pcm_command(path, duration, fps, nchannels),
+                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def read(self, count):
+        """The next `count` samples; fewer only at the end of the track"""
+        data = self.proc.stdout.read(count * self.nchannels * 4)
+        if len(data) < count * self.nchannels * 4:
+            self.finished = True
+        return np.frombuffer(data, dtype='<f4').reshape(-1, self.nchannels)
+
+    def close(self):
+        """Stop decoding; raises RuntimeError if ffmpeg failed before the end of the track"""
+        if not self.finished:
+            self.proc.kill()
+        self.proc.stdout.close()
+        error = self.proc.stderr.read()
+        self.proc.stderr.close()
+        if self.proc.wait() != 0 and self.finished:
+            error = error.decode('utf-8', errors='replace').strip()
+            raise RuntimeError(f"Could not decode audio from {self.path}: {error[-500:]}")
+
+
+class LoopedTrack:
+    """
+    A track repeated end to end, read in consecutive pieces. The first loop
+    is kept when it fits in max_bytes, so short music is decoded once;
+    longer music is decoded again for each loop.
+    """
+
+    def __init__(self, path=None, samples=None, duration=None, max_bytes=0, nchannels=AUDIO_CHANNELS):
+        self.path = path
+        self.duration = duration
+        self.max_bytes = max_bytes
+        self.nchannels = nchannels
+        self.samples = samples
+        self.decoder = None
+        self.rewind()
+
+    def rewind(self):
+        """Start again from the beginning of the first loop"""
+        self.close()
+        self.position = 0
+        self.first_loop = [] if self.samples is None else None
+        self.first_loop_bytes = 0
+
+    def close(self):
+        if self.decoder is not None:
+            self.decoder.close()
+            self.decoder = None
+
+    def read(self, count):
+        """The next `count` samples, or none if the track is empty"""
+        pieces = []
+        while count:
+            piece = self._next(count)
+            if piece is None:
+                break
+            pieces.append(piece)
+            count -= len(piece)
+        if len(pieces) == 1:
+            return pieces[0]
+        return np.concatenate(pieces) if pieces else np.zeros((0, self.nchannels), dtype='float32')
+
+    def _next(self, count):
+        if self.samples is not None:
+            if not len(self.samples):
+                return None
+            piece = self.samples[self.position:self.position + count]
+            self.position = (self.position + len(piece)) % len(self.samples)
+            return piece
+
+        if self.decoder is None:
+            self.decoder = PCMDecoder(self.path, self.duration, nchannels=self.nchannels)
+        piece = self.decoder.read(count)
+        self.position += len(piece)
+
+        if self.first_loop is not None:
+            self.first_loop_bytes += piece.nbytes
+            if self.first_loop_bytes <= self.max_bytes:
+                self.first_loop.append(piece)
+            else:
+                self.first_loop = None
+        if self.decoder.finished:
+            self.close()
+            if self.first_loop is not None:
+                # The whole loop fitted: play the rest from memory
+                self.samples = (np.concatenate(self.first_loop) if self.first_loop
+                                else np.zeros((0, self.nchannels), dtype='float32'))
+                self.first_loop = None
+            elif self.position == 0:
+                # Nothing decoded: an empty track
+                self.samples = np.zeros((0, self.nchannels), dtype='float32')
+            self.position = 0
+        return piece
+
+
+def _voice_chunks(voice_path, duration, length, chunk, fps):
+    """video1's audio in `chunk` sample pieces, padded with silence or cut to `length` samples"""
+    decoder = PCMDecoder(voice_path, duration, fps) if voice_path else None
+    try:
+        for start in range(0, length, chunk):
+            size = min(chunk, length - start)
+            samples = np.zeros((size, AUDIO_CHANNELS), dtype='float32')
+            if decoder is not None and not decoder.finished:
+                piece = decoder.read(size)
+                samples[:len(piece)] = piece
+            yield start, samples
+    finally:
+        if decoder is not None:
+            decoder.close()
+
+
+class BlockLevels:
+    """
+    Levels per block of a whole track, `levels_of(values)`, worked out a few
+    blocks at a time as the per-block values arrive. A level depends on the
+    values up to `before` blocks earlier and `after` blocks later, so each
+    is computed from that window alone and comes out as it would from the
+    whole track.
+    """
+
+    def __init__(self, levels_of, block, nblocks, before, after, dtype):
+        self.levels_of = levels_of
+        self.block = block
+        self.before = before
+        self.after = after
+        self.values = np.zeros(nblocks, dtype=dtype)
+        self.known = 0
+
+    def add(self, values):
+        self.values[self.known:self.known + len(values)] = values
+        self.known += len(values)
+
+    def _blocks(self, start, stop):
+        """Blocks whose levels the samples [start, stop) are interpolated between"""
+        return max(0, start // self.block - 1), min(len(self.values), (stop - 1) // self.block + 2)
+
+    def ready(self, start, stop):
+        """Whether the values the gain of samples [start, stop) depends on have all arrived"""
+        last = self._blocks(start, stop)[1]
+        return self.known >= min(len(self.values), last + self.after)
+
+    def gain(self, start, stop):
+        """Per-sample gain of samples [start, stop); needs ready(start, stop)"""
+        first, last = self._blocks(start, stop)
+        low, high = max(0, first - self.before), min(len(self.values), last + self.after)
+        levels = self.levels_of(self.values[low:high])[first - low:last - low]
+        return block_gain(levels, self.block, start, stop, first)
+
+
+def mixed_chunks(voice_path, music, duration, fps=AUDIO_FPS, music_volume=0.3, duck=False, limit=True):
+    """
+    mix_tracks of video1's audio file (or None) and music, a LoopedTrack,
+    yielded in pieces of about a second.
+
+    Each source is decoded once. A piece is mixed once the speech flags of
+    the piece after it are known, and limited once that piece's peaks are,
+    so memory does not grow with the duration beyond the per-block values.
+    """
+    length = int(round(duration * fps))
+    duck_block = int(fps * DUCK_BLOCK_SECONDS)
+    limit_block = int(fps * LIMITER_BLOCK_SECONDS)
+    # Whole blocks of both kinds in every chunk but the last
+    chunk = int(np.lcm(duck_block, limit_block))
+    chunk *= max(1, fps // chunk)
+
+    music.rewind()
+    has_music = len(music.read(1)) > 0
+    music.rewind()
+
+    speech = None
+    if duck and voice_path and has_music:
+        # Held for DUCK_HOLD_SECONDS after each speech block, then ramped over the neighbours
+        hold = int(round(DUCK_HOLD_SECONDS / DUCK_BLOCK_SECONDS))
+        ramp = max(1, int(round(DUCK_RAMP_SECONDS / DUCK_BLOCK_SECONDS)))
+        speech = BlockLevels(ducking_levels, duck_block, -(-length // duck_block),
+                             hold + ramp // 2, ramp - 1 - ramp // 2, bool)
+    peaks = None
+    if limit:
+        # float32 like block_peaks, so the levels round as they do in mix_tracks
+        peaks = BlockLevels(limiter_levels, limit_block, -(-length // limit_block), 1, 1, 'float32')
+
+    decoded = collections.deque()
+    mixed_pieces = collections.deque()
+
+    def mix_ready():
+        while decoded and (speech is None or speech.ready(*decoded[0][:2])):
+            start, stop, mixed, samples = decoded.popleft()
+            if samples is not None:
+                gain = music_volume
+                if speech is not None:
+                    gain = speech.gain(start, stop).astype('float32')[:, None] * music_volume
+                mixed += samples * gain
+            if peaks is not None:
+                peaks.add(block_peaks(mixed, fps))
+            mixed_pieces.append((start, stop, mixed))
+
+        while mixed_pieces and (peaks is None or peaks.ready(*mixed_pieces[0][:2])):
+            start, stop, mixed = mixed_pieces.popleft()
+            if peaks is not None:
+                gain = peaks.gain(start, stop)
+                # A gain of 1 everywhere leaves the samples as they are
+                if gain.min() < 1.0:
+                    mixed *= gain[:, None].astype('float32')
+            yield mixed
+
+    for start, voice in _voice_chunks(voice_path, duration, length, chunk, fps):
+        if speech is not None:
+            speech.add(speech_blocks(voice, fps))
+        samples = music.read(len(voice)) if has_music else None
+        decoded.append((start, start + len(voice), voice, samples))
+        yield from mix_ready()
+    music.close()
+    yield from mix_ready()
+
+
+def write_mix(output_path, voice_path, music, duration, fps=AUDIO_FPS, codec='aac', **mix_options):
+    """Encode the mixed_chunks of a render to output_path as write_audiofile (nbytes=4) would"""
+    cmd = [get_setting("FFMPEG_BINARY"), '-y', '-loglevel', 'error',
+           '-f', 's32le', '-acodec', 'pcm_s32le', '-ar', str(fps), '-ac', str(AUDIO_CHANNELS), '-i', '-',
+           '-vn', '-acodec', codec, '-ar', str(fps), '-strict', '-2', output_path]
+
+    # write_audiofile counts fps * duration samples, which can round one short
+    length = int(round(duration * fps))
+    remaining = int(fps * (length / fps))
+    with EncoderPipe(cmd, "Audio encoding") as pipe:
+        for mixed in mixed_chunks(voice_path, music, duration, fps=fps, **mix_options):
+            mixed = mixed[:remaining]
+            remaining -= len(mixed)
+            quantized = (2 ** 31 * np.maximum(-0.99, np.minimum(0.99, mixed))).astype('int32')
+            pipe.write(quantized)
+    return output_path
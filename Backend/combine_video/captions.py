@@ -0,0 +1,417 @@
+"""
+Timed captions burned into the video.
+
+Captions come as an SRT or WebVTT file. Giving every cue its own TextClip,
+as create_text_overlay does for the static text, costs an ImageMagick run
+per cue and a masked blit of every clip on every frame. Instead:
+
+- the cues are parsed once into a CueIndex: the timeline cut at every cue
+  start and end, so the cues showing at t are one bisect away
+- each font and size is rasterized with Pillow/FreeType into a GlyphAtlas,
+  one alpha array holding every glyph side by side, shared by all renders
+  in the process
+- CaptionTrack lays out the lines showing at t by copying glyph slices out
+  of the atlas, outlines them, and keeps the result premultiplied like the
+  compositor's StaticPlate, so a caption costs one multiply-add over its
+  band per frame and is only rasterized again when the cues change
+
+Glyphs are placed by their advance widths without kerning or shaping, which
+suits the Latin text captions are usually in; scripts that need shaping
+(Arabic, Indic) render with their isolated glyph forms.
+"""
+import bisect
+import html
+import math
+import os
+import re
+import subprocess
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+from .compositor import blit_bounds
+
+CAPTION_POSITIONS = ('bottom', 'top')
+
+# Rasterized with every new atlas; other characters are added when a cue uses them
+ATLAS_CHARACTERS = ''.join(chr(code) for code in range(32, 127))
+# Cue sets whose rasterized bands a track keeps, for cues that overlap and alternate
+CAPTION_CACHE_BANDS = 8
+# Lines of caption text the memory estimate allows for
+CAPTION_MAX_LINES = 4
+# Share of the frame width a caption line may take before it wraps
+CAPTION_MAX_WIDTH = 0.9
+ATLAS_CACHE_ITEMS = 8
+
+_timestamp_re = re.compile(r'^(?:(\d+):)?(\d{1,2}):(\d{2})[.,](\d{1,3})$')
+_timing_re = re.compile(r'^\s*(\S+)\s+-->\s+(\S+)')
+# VTT/HTML style tags (<i>, <c.yellow>, <00:01.000>) and SSA overrides ({\an8})
+_tag_re = re.compile(r'<[^>]*>|\{\\[^}]*\}')
+# Font names as fontconfig and libass take them; never paths, nor ASS style separators
+_font_name_re = re.compile(r'^[A-Za-z0-9][A-Za-z0-9 _+-]{0,63}$')
+
+_atlases = OrderedDict()
+_atlases_lock = threading.Lock()
+_font_files = {}
+
+
+class InvalidCaptions(ValueError):
+    """Raised when a caption file cannot be read"""
+
+
+class Cue:
+    """Text shown from `start` to `end` seconds"""
+
+    __slots__ = ('start', 'end', 'text')
+
+    def __init__(self, start, end, text):
+        self.start = start
+        self.end = end
+        self.text = text
+
+
+def parse_timestamp(value):
+    """Seconds of an SRT (00:01:02,500) or WebVTT (01:02.500) timestamp"""
+    match = _timestamp_re.match(value)
+    if match is None:
+        raise InvalidCaptions(f"has an invalid timestamp {value!r}")
+    hours, minutes, seconds, fraction = match.groups()
+    if int(minutes) > 59 or int(seconds) > 59:
+        raise InvalidCaptions(f"has an invalid timestamp {value!r}")
+    return int(hours or 0) * 3600 + int(minutes) * 60 + int(seconds) + int(fraction.ljust(3, '0')) / 1000
+
+
+def parse_captions(text):
+    """
+    Cues of an SRT or WebVTT document, in file order. Styling tags are
+    dropped; VTT headers, NOTE, STYLE and REGION blocks are skipped.
+    """
+    text = text.lstrip('\ufeff').replace('\r\n', '\n').replace('\r', '\n')
+    cues = []
+    for number, block in enumerate(re.split(r'\n[ \t]*\n', text.strip()), start=1):
+        lines = block.split('\n')
+        timing = next((i for i, line in enumerate(lines) if '-->' in line), None)
+        if timing is None:
+            if lines[0].startswith(('WEBVTT', 'NOTE', 'STYLE', 'REGION')):
+                continue
+            raise InvalidCaptions(f"block {number} has no timing line")
+        match = _timing_re.match(lines[timing])
+        if match is None:
+            raise InvalidCaptions(f"block {number} has an invalid timing line")
+        start, end = parse_timestamp(match.group(1)), parse_timestamp(match.group(2))
+        if end <= start:
+            raise InvalidCaptions(f"block {number} ends before it starts")
+        cue_text = html.unescape(_tag_re.sub('', '\n'.join(lines[timing + 1:]))).strip()
+        if cue_text:
+            cues.append(Cue(start, end, cue_text))
+        if len(cues) > settings.MAX_CAPTION_CUES:
+            raise InvalidCaptions(f"has more than {settings.MAX_CAPTION_CUES} cues")
+    if not cues:
+        raise InvalidCaptions("has no cues")
+    return cues
+
+
+def load_captions(path):
+    """Parse the caption file at `path`; raises InvalidCaptions if it is not usable"""
+    if os.path.getsize(path) > settings.MAX_CAPTION_FILE_SIZE:
+        raise InvalidCaptions(f"is larger than {settings.MAX_CAPTION_FILE_SIZE} bytes")
+    with open(path, 'rb') as f:
+        data = f.read()
+    try:
+        text = data.decode('utf-8')
+    except UnicodeDecodeError:
+        # Older SRT files are often in a Windows code page
+        text = data.decode('cp1252', errors='replace')
+    return parse_captions(text)
+
+
+class CueIndex:
+    """
+    Cues by time. The timeline is cut at every cue start and end; each
+    piece lists the cues showing throughout it, so a lookup is one bisect
+    over the cut points however many cues there are.
+    """
+
+    def __init__(self, cues):
+        self.cues = cues
+        self.bounds = sorted({t for cue in cues for t in (cue.start, cue.end)})
+        by_start = sorted(range(len(cues)), key=lambda i: cues[i].start)
+        self.pieces = []
+        active = []
+        next_cue = 0
+        for bound in self.bounds[:-1]:
+            while next_cue < len(by_start) and cues[by_start[next_cue]].start <= bound:
+                active.append(by_start[next_cue])
+                next_cue += 1
+            active = [i for i in active if cues[i].end > bound]
+            self.pieces.append(tuple(active))
+
+    def at(self, t):
+        """Indexes of the cues showing at `t`, earliest first; empty between cues"""
+        piece = bisect.bisect_right(self.bounds, t) - 1
+        if 0 <= piece < len(self.pieces):
+            return self.pieces[piece]
+        return ()
+
+
+def font_file(font):
+    """
+    Path of the font file for an ImageMagick-style font name such as
+    'Arial-Bold', as fontconfig matches it, or of CAPTION_FONT_PATH when it
+    cannot. The name comes from the request, so only the files fontconfig
+    knows and the configured one are ever opened.
+    """
+    check_font_name(font)
+    if font not in _font_files:
+        from .ffmpeg_backend import fontconfig_pattern
+
+        path = None
+        try:
+            result = subprocess.run(['fc-match', '-f', '%{file}', fontconfig_pattern(font)],
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=10)
+            path = result.stdout.decode('utf-8', errors='replace').strip() if result.returncode == 0 else None
+        except (OSError, subprocess.TimeoutExpired):
+            pass
+        _font_files[font] = path if path and os.path.isfile(path) else None
+
+    path = _font_files[font] or settings.CAPTION_FONT_PATH
+    if not path or not os.path.isfile(path):
+        raise RuntimeError(f"No font file found for {font!r}; install fontconfig or set CAPTION_FONT_PATH")
+    return path
+
+
+class GlyphAtlas:
+    """
+    The glyphs of one font at one size as alpha masks, packed side by side
+    in a single array one line high. Glyphs are added as new characters
+    turn up and never change once added.
+    """
+
+    def __init__(self, path, fontsize):
+        self.font = ImageFont.truetype(path, fontsize)
+        ascent, descent = self.font.getmetrics()
+        self.line_height = ascent + descent
+        # (alpha array, character -> (column in it, width, offset from the pen, advance)),
+        # replaced as one tuple so a reader never pairs a glyph table with another array
+        self.table = (np.zeros((self.line_height, 0), dtype='uint8'), {})
+        self.lock = threading.Lock()
+        self.add(ATLAS_CHARACTERS)
+
+    def add(self, characters):
+        """Rasterize the characters not in the atlas yet"""
+        with self.lock:
+            atlas, glyphs = self.table
+            missing = [c for c in dict.fromkeys(characters) if c not in glyphs and c.isprintable()]
+            if not missing:
+                return
+            column = atlas.shape[1]
+            tiles = [atlas]
+            added = {}
+            for character in missing:
+                left, _, right, _ = self.font.getbbox(character, anchor='la')
+                width = max(0, right - left)
+                image = Image.new('L', (max(1, width), self.line_height))
+                ImageDraw.Draw(image).text((-left, 0), character, font=self.font, fill=255, anchor='la')
+                tiles.append(np.asarray(image)[:, :width])
+                added[character] = (column, width, left, self.font.getlength(character))
+                column += width
+            # Readers keep using the old pair until the new one is in place
+            self.table = (np.concatenate(tiles, axis=1), dict(glyphs, **added))
+
+    def width(self, text, glyphs=None):
+        if glyphs is None:
+            glyphs = self.table[1]
+        return sum(glyphs[c][3] for c in text if c in glyphs)
+
+    def wrap(self, text, max_width):
+        """Lines of `text` broken at spaces to fit max_width; a longer word keeps a line to itself"""
+        lines = []
+        for paragraph in text.split('\n'):
+            line = ''
+            for word in paragraph.split():
+                candidate = f"{line} {word}" if line else word
+                if line and self.width(candidate) > max_width:
+                    lines.append(line)
+                    line = word
+                else:
+                    line = candidate
+            lines.append(line)
+        return lines
+
+    def render(self, lines):
+        """Alpha mask of `lines`, each centred, copied glyph by glyph out of the atlas"""
+        atlas, glyphs = self.table
+        widths = [math.ceil(self.width(line, glyphs)) for line in lines]
+        width = max(1, max(widths))
+        mask = np.zeros((self.line_height * len(lines), width), dtype='uint8')
+        for row, (line, line_width) in enumerate(zip(lines, widths)):
+            top = row * self.line_height
+            pen = (width - line_width) / 2
+            for character in line:
+                glyph = glyphs.get(character)
+                if glyph is None:
+                    continue
+                column, glyph_width, offset, advance = glyph
+                x = int(round(pen)) + offset
+                x0, x1 = max(0, x), min(width, x + glyph_width)
+                if x0 < x1:
+                    target = mask[top:top + self.line_height, x0:x1]
+                    # Neighbouring glyphs may overlap by a pixel or two
+                    np.maximum(target, atlas[:, column + x0 - x:column + x1 - x], out=target)
+                pen += advance
+        return mask
+
+
+def get_atlas(path, fontsize):
+    """The process's atlas of the font at `path` and `fontsize`, built on first use"""
+    key = (path, fontsize)
+    with _atlases_lock:
+        atlas = _atlases.get(key)
+        if atlas is not None:
+            _atlases.move_to_end(key)
+            return atlas
+    atlas = GlyphAtlas(path, fontsize)
+    with _atlases_lock:
+        atlas = _atlases.setdefault(key, atlas)
+        while len(_atlases) > ATLAS_CACHE_ITEMS:
+            _atlases.popitem(last=False)
+    return atlas
+
+
+def _dilate(mask, radius):
+    """`mask` grown by `radius` pixels in every direction (a disc), padded to fit"""
+    height, width = mask.shape
+    grown = np.zeros((height + 2 * radius, width + 2 * radius), dtype=mask.dtype)
+    for dy in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            if dx * dx + dy * dy <= radius * radius:
+                target = grown[radius + dy:radius + dy + height, radius + dx:radius + dx + width]
+                np.maximum(target, mask, out=target)
+    return grown
+
+
+class CaptionTrack:
+    """
+    The cues of a caption file drawn over frames of `frame_size`: white (or
+    `color`) text with a black outline, centred near the bottom or top.
+
+    Like compositor.StaticPlate it is drawn with draw(frame, t) and, since
+    the band it covers changes from cue to cue, clear() puts the background
+    back under the last band drawn.
+    """
+
+    def __init__(self, cues, frame_size, font='Arial-Bold', fontsize=40, color='white', position='bottom'):
+        check_caption_style(font, color, position)
+        self.index = CueIndex(cues)
+        self.frame_size = frame_size
+        self.atlas = get_atlas(font_file(font), fontsize)
+        self.atlas.add(''.join(cue.text for cue in cues))
+        self.color = np.array(ImageColor.getrgb(color)[:3], dtype='float32')
+        self.position = position
+        self.margin = fontsize
+        self.outline = max(1, fontsize // 16)
+        self.bands = OrderedDict()
+        self.drawn = None
+
+    def band(self, showing):
+        """(frame slices, premultiplied colour, inverse alpha) of the cues in `showing`"""
+        if showing in self.bands:
+            self.bands.move_to_end(showing)
+            return self.bands[showing]
+
+        frame_width, frame_height = self.frame_size
+        text = '\n'.join(self.index.cues[i].text for i in showing)
+        mask = self.atlas.render(self.atlas.wrap(text, frame_width * CAPTION_MAX_WIDTH))
+        outline = _dilate(mask, self.outline).astype('float32') / 255
+        alpha = np.zeros_like(outline)
+        alpha[self.outline:-self.outline, self.outline:-self.outline] = mask / 255.0
+
+        height, width = alpha.shape
+        x = (frame_width - width) // 2
+        y = frame_height - height - self.margin if self.position == 'bottom' else self.margin
+        bounds = blit_bounds((x, y), self.frame_size, (width, height))
+        band = None
+        if bounds is not None:
+            frame_slice, (sy, sx) = bounds
+            alpha, outline = alpha[sy, sx, None], outline[sy, sx, None]
+            # Text over a black outline: the outline only darkens
+            band = (frame_slice, alpha * self.color, (1 - alpha) * (1 - outline))
+        self.bands[showing] = band
+        while len(self.bands) > CAPTION_CACHE_BANDS:
+            self.bands.popitem(last=False)
+        return band
+
+    def clear(self, frame, color):
+        """Put the background back under the caption drawn last"""
+        if self.drawn is not None:
+            frame[self.drawn] = color
+
+    def draw(self, frame, t):
+        self.drawn = None
+        showing = self.index.at(t)
+        if not showing:
+            return
+        band = self.band(showing)
+        if band is None:
+            return
+        (fy, fx), premultiplied, inverse = band
+        frame[fy, fx] = premultiplied + inverse * frame[fy, fx]
+        self.drawn = (fy, fx)
+
+
+def check_captions(path):
+    """Reject a caption file that cannot be parsed, naming it in the error"""
+    try:
+        load_captions(path)
+    except InvalidCaptions as e:
+        raise InvalidCaptions(f"captions {e}") from None
+
+
+def check_font_name(font):
+    """Raise ValueError unless `font` is a plain font name such as 'Arial-Bold'"""
+    if not _font_name_re.match(font):
+        raise ValueError(f"caption_font {font!r} is not a font name")
+
+
+def check_caption_style(font, color, position):
+    """Raise ValueError for a caption font, colour or position CaptionTrack cannot draw"""
+    check_font_name(font)
+    if position not in CAPTION_POSITIONS:
+        raise ValueError(f"caption_position must be one of {', '.join(CAPTION_POSITIONS)}")
+    try:
+        ImageColor.getrgb(color)
+    except ValueError:
+        raise ValueError(f"caption_color {color!r} is not a colour name or #rrggbb value") from None
+
+
+def caption_track(captions_path, frame_size, font='Arial-Bold', fontsize=40, color='white', position='bottom'):
+    """The CaptionTrack of a caption file, or None without one"""
+    if not captions_path:
+        return None
+    return CaptionTrack(load_captions(captions_path), frame_size, font=font, fontsize=fontsize,
+                        color=color, position=position)
+
+
+def ass_style(font, fontsize, color, position, frame_height):
+    """
+    force_style for ffmpeg's subtitles filter matching CaptionTrack. libass
+    lays SRT and VTT out on a 288 line script, so sizes are scaled to it.
+    """
+    scale = 288 / frame_height
+    name, _, style = font.partition('-')
+    red, green, blue = ImageColor.getrgb(color)[:3]
+    return ','.join([
+        f"FontName={name}",
+        f"Bold={-1 if style.lower() == 'bold' else 0}",
+        f"FontSize={fontsize * scale:.2f}",
+        f"PrimaryColour=&H00{blue:02X}{green:02X}{red:02X}",
+        "OutlineColour=&H00000000",
+        "BorderStyle=1",
+        f"Outline={max(1, fontsize // 16) * scale:.2f}",
+        "Shadow=0",
+        f"Alignment={2 if position == 'bottom' else 8}",
+        f"MarginV={int(round(fontsize * scale))}",
+    ])
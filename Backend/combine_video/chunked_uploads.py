@@ -0,0 +1,210 @@
+"""
+Resumable uploads sent in chunks.
+
+A client opens an UploadSession with the file's size and sha256, PUTs the
+bytes in chunks at the offset the server reports, and finalizes. Chunks
+are written in place into MEDIA_ROOT/uploads/<session>.part and the offset
+only advances once a chunk has arrived whole, so after a dropped
+connection the client asks for the offset and carries on from there.
+
+Finalizing claims the session, checks the checksum and links the file to
+its content address in the input directory, the same place multipart
+uploads end up; if identical content is stored there already, that file
+is kept and the upload's copy dropped, as upload_handlers does. Its
+sha256 is then an asset id that the combine, batch and preview endpoints
+accept instead of a file. Asset files are kept for renders and previews
+until they go unused for UPLOAD_ASSET_TTL seconds.
+"""
+import hashlib
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .jobs import active_input_paths
+from .models import UploadSession
+from .upload_handlers import UploadTooLarge, input_dir, link_to_address, safe_extension, stored_upload_path
+
+READ_BLOCK_SIZE = 1024 * 1024
+
+
+class UploadConflict(Exception):
+    """Raised when a chunk does not start at the session's current offset"""
+
+
+class UnknownAsset(Exception):
+    """Raised when an asset id does not name a stored file"""
+
+
+def upload_dir():
+    path = os.path.join(settings.MEDIA_ROOT, 'uploads')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def part_path(session):
+    return os.path.join(upload_dir(), f"{session.id}.part")
+
+
+def create_session(filename, size, sha256):
+    """Open an upload of `size` bytes whose content must hash to `sha256`"""
+    sha256 = sha256.lower()
+    if len(sha256) != 64 or any(c not in '0123456789abcdef' for c in sha256):
+        raise ValueError("sha256 must be 64 hex digits")
+    if size <= 0:
+        raise ValueError("size must be positive")
+    if size > settings.MAX_UPLOAD_FILE_SIZE:
+        raise UploadTooLarge(f"{filename} exceeds the {settings.MAX_UPLOAD_FILE_SIZE} byte upload limit")
+
+    remove_expired_uploads()
+    session = UploadSession.objects.create(filename=filename[:255], size=size, sha256=sha256)
+    open(part_path(session), 'wb').close()
+    return session
+
+
+def write_chunk(session, offset, stream, length):
+    """
+    Write `length` bytes read from `stream` at `offset`. The offset only
+    advances if all of them arrive; a short chunk is simply sent again.
+    """
+    if session.status == UploadSession.STATUS_COMPLETE:
+        raise UploadConflict("Upload is already complete")
+    if session.status != UploadSession.STATUS_UPLOADING:
+        raise UploadConflict("Upload is being finalized")
+    if offset != session.received:
+        raise UploadConflict(f"Chunk starts at {offset} but the upload continues at {session.received}")
+    if length > settings.UPLOAD_CHUNK_MAX_SIZE:
+        raise UploadTooLarge(f"Chunks are limited to {settings.UPLOAD_CHUNK_MAX_SIZE} bytes")
+    if offset + length > session.size:
+        raise ValueError(f"Chunk ends past the declared size of {session.size} bytes")
+
+    written = 0
+    with open(part_path(session), 'r+b') as f:
+        f.seek(offset)
+        while written < length:
+            data = stream.read(min(READ_BLOCK_SIZE, length - written))
+            if not data:
+                break
+            f.write(data)
+            written += len(data)
+    if written < length:
+        raise ValueError(f"Chunk ended after {written} of {length} bytes")
+
+    # A concurrent retry of the same chunk may have advanced it already
+    UploadSession.objects.filter(pk=session.pk, received=offset).update(
+        received=offset + length, updated_at=timezone.now()
+    )
+    session.refresh_from_db()
+    return session
+
+
+def finalize_session(session):
+    """
+    Check the checksum and store the file under its content address.
+    Finalizing a complete upload again returns it as it is; while another
+    request is finalizing it, raises UploadConflict.
+    """
+    if session.status == UploadSession.STATUS_COMPLETE:
+        return session
+    if session.received != session.size:
+        raise UploadConflict(f"Upload has {session.received} of {session.size} bytes")
+
+    # Only one request checks and stores the file
+    claimed = UploadSession.objects.filter(
+        pk=session.pk, status=UploadSession.STATUS_UPLOADING, received=session.size
+    ).update(status=UploadSession.STATUS_FINALIZING, updated_at=timezone.now())
+    if not claimed:
+        try:
+            session.refresh_from_db()
+        except UploadSession.DoesNotExist:
+            raise UploadConflict("Upload was discarded while being finalized") from None
+        if session.status == UploadSession.STATUS_COMPLETE:
+            return session
+        raise UploadConflict("Upload is being finalized")
+    session.status = UploadSession.STATUS_FINALIZING
+
+    path = part_path(session)
+    try:
+        hasher = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(READ_BLOCK_SIZE), b''):
+                hasher.update(block)
+        if hasher.hexdigest() != session.sha256:
+            # The data is wrong somewhere; start over rather than guess where
+            os.remove(path)
+            session.delete()
+            raise ValueError("Uploaded data does not match the sha256 given when the upload was opened")
+
+        # Never written over: multipart uploads and queued jobs may hold the stored file
+        session.path = os.path.join(input_dir(), f"{session.sha256}{safe_extension(session.filename)}")
+        link_to_address(path, session.path)
+        session.status = UploadSession.STATUS_COMPLETE
+        session.save(update_fields=['path', 'status', 'updated_at'])
+    except Exception:
+        if session.pk is not None and session.status != UploadSession.STATUS_COMPLETE:
+            # Let the client try again
+            UploadSession.objects.filter(pk=session.pk).update(status=UploadSession.STATUS_UPLOADING)
+            session.status = UploadSession.STATUS_UPLOADING
+        raise
+    # Now an asset, the stored file no longer needs the part's link
+    os.remove(path)
+    return session
+
+
+def remove_session(session):
+    """Abort an upload in progress"""
+    if session.status != UploadSession.STATUS_COMPLETE:
+        try:
+            os.remove(part_path(session))
+        except OSError:
+            pass
+    session.delete()
+
+
+def asset_path(asset_id):
+    """Path of a stored asset (or earlier upload) by its sha256; marks the asset as used"""
+    path = stored_upload_path(asset_id)
+    if path is None:
+        raise UnknownAsset(f"No stored file has id {asset_id}; upload it again")
+    UploadSession.objects.filter(sha256=asset_id, status=UploadSession.STATUS_COMPLETE).update(
+        updated_at=timezone.now()
+    )
+    os.utime(path)
+    return path
+
+
+def asset_paths():
+    """Paths of finished uploads that must outlive the renders using them"""
+    return set(
+        UploadSession.objects.filter(status=UploadSession.STATUS_COMPLETE).values_list('path', flat=True)
+    )
+
+
+def remove_expired_uploads():
+    """Drop abandoned uploads and assets unused for UPLOAD_ASSET_TTL seconds"""
+    now = timezone.now()
+    # Finalizing ones too, left behind by a process that stopped
+    abandoned = UploadSession.objects.filter(
+        status__in=[UploadSession.STATUS_UPLOADING, UploadSession.STATUS_FINALIZING],
+        updated_at__lt=now - timedelta(seconds=settings.UPLOAD_SESSION_TTL),
+    )
+    for session in abandoned:
+        remove_session(session)
+
+    expired = list(UploadSession.objects.filter(
+        status=UploadSession.STATUS_COMPLETE,
+        updated_at__lt=now - timedelta(seconds=settings.UPLOAD_ASSET_TTL),
+    ))
+    if not expired:
+        return
+    UploadSession.objects.filter(pk__in=[session.pk for session in expired]).delete()
+
+    # Files a queued or running job still reads go once that job finishes
+    in_use = asset_paths() | active_input_paths()
+    for session in expired:
+        if session.path not in in_use:
+            try:
+                os.remove(session.path)
+            except OSError:
+                pass
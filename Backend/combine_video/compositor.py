@@ -0,0 +1,259 @@
+"""
+Single-pass frame compositor for the layouts (see layouts.py).
+
+CompositeVideoClip blits every layer onto a fresh copy of the frame and
+converts the result back to uint8 after each one. For our layout the
+background is a solid colour, the video regions are opaque and the text
+layers never change, so most of that work can be skipped:
+
+- one output buffer is allocated up front and reused for every frame,
+  and the background is only repainted under the overlays
+- the regions are copied straight into their slices of that buffer,
+  bottom to top
+- the time-invariant layers (watermark, text) are flattened once into a
+  premultiplied plate, so each frame takes a single masked blend over the
+  rows they cover, however many layers there are
+- timed captions (captions.CaptionTrack) are blended the same way, from
+  bands rasterized once per cue
+
+The arithmetic mirrors moviepy.video.tools.drawing.blit, so the output is
+identical to the CompositeVideoClip version frame for frame as long as
+the static overlays do not overlap. Where they do, the plate skips the
+rounding to uint8 between layers, so a pixel under n overlays can differ
+by up to n - 1 levels.
+"""
+import numpy as np
+from moviepy.editor import ImageClip, VideoClip
+
+
+def resolve_position(pos, frame_size, clip_size):
+    """Turn a moviepy position (tuple, keyword or mixed) into integer (x, y)"""
+    wf, hf = frame_size
+    wi, hi = clip_size
+
+    if isinstance(pos, str):
+        pos = {'center': ['center', 'center'],
+               'left': ['left', 'center'],
+               'right': ['right', 'center'],
+               'top': ['center', 'top'],
+               'bottom': ['center', 'bottom']}[pos]
+    else:
+        pos = list(pos)
+
+    if isinstance(pos[0], str):
+        pos[0] = {'left': 0, 'center': (wf - wi) / 2, 'right': wf - wi}[pos[0]]
+    if isinstance(pos[1], str):
+        pos[1] = {'top': 0, 'center': (hf - hi) / 2, 'bottom': hf - hi}[pos[1]]
+
+    return int(pos[0]), int(pos[1])
+
+
+def blit_bounds(pos, frame_size, clip_size):
+    """
+    Return the (frame slice, clip slice) pair for a clip drawn at `pos`,
+    clipped to the frame, or None when nothing is visible.
+    """
+    xp, yp = pos
+    w2, h2 = frame_size
+    w1, h1 = clip_size
+
+    x1, y1 = max(0, -xp), max(0, -yp)
+    x2, y2 = min(w1, w2 - xp), min(h1, h2 - yp)
+    xp1, yp1 = max(0, xp), max(0, yp)
+    xp2, yp2 = min(w2, xp + w1), min(h2, yp + h1)
+
+    if xp1 >= xp2 or yp1 >= yp2:
+        return None
+    return (slice(yp1, yp2), slice(xp1, xp2)), (slice(y1, y2), slice(x1, x2))
+
+
+def is_static(clip, duration):
+    """
+    Whether a layer is the same image at the same place for the whole
+    composite: an ImageClip (with an ImageClip mask, if any) shown from
+    start to end at a position that does not move.
+    """
+    if not isinstance(clip, ImageClip):
+        return False
+    if clip.mask is not None and not isinstance(clip.mask, ImageClip):
+        return False
+    if clip.start > 0 or (clip.end is not None and duration is not None and clip.end < duration):
+        return False
+    end = duration or 0
+    return clip.pos(0) == clip.pos(end / 2) == clip.pos(end)
+
+
+class StaticPlate:
+    """
+    Time-invariant overlays flattened into one premultiplied layer.
+
+    `premultiplied` is the overlays' colour times their combined alpha and
+    `inverse` the share of the frame that shows through, so drawing the
+    plate is one multiply-add however many layers went into it. Both are
+    kept only for the bands of rows the overlays cover.
+
+    Where the overlays do not overlap, drawing the plate gives exactly the
+    pixels CompositeVideoClip does. Where they overlap it skips the
+    rounding to uint8 between layers, so a pixel under n overlays is within
+    n - 1 levels (±1 where two overlap).
+    """
+
+    def __init__(self, overlays, frame_size):
+        layers = []
+        for clip in overlays:
+            rgb = clip.get_frame(0)
+            h, w = rgb.shape[:2]
+            bounds = blit_bounds(resolve_position(clip.pos(0), frame_size, (w, h)), frame_size, (w, h))
+            if bounds is not None:
+                mask = clip.mask.get_frame(0) if clip.mask is not None else None
+                layers.append((rgb, mask, bounds))
+
+        self.bands = []
+        if not layers:
+            return
+
+        # Flatten over the bounding box of all layers, bottom to top
+        frame_slices = [frame_slice for _, _, (frame_slice, _) in layers]
+        y0 = min(fy.start for fy, _ in frame_slices)
+        y1 = max(fy.stop for fy, _ in frame_slices)
+        x0 = min(fx.start for _, fx in frame_slices)
+        x1 = max(fx.stop for _, fx in frame_slices)
+        premultiplied = np.zeros((y1 - y0, x1 - x0, 3))
+        inverse = np.ones((y1 - y0, x1 - x0, 1))
+        for rgb, mask, ((fy, fx), (sy, sx)) in layers:
+            py = slice(fy.start - y0, fy.stop - y0)
+            px = slice(fx.start - x0, fx.stop - x0)
+            if mask is None:
+                # Opaque layer: replaces everything below it
+                premultiplied[py, px] = rgb[sy, sx]
+                inverse[py, px] = 0.0
+            else:
+                # Same arithmetic as moviepy's blit, so a lone layer blends identically
+                mask = mask[sy, sx][..., None]
+                premultiplied[py, px] = 1.0 * mask * rgb[sy, sx] + (1.0 - mask) * premultiplied[py, px]
+                inverse[py, px] = (1.0 - mask) * inverse[py, px]
+
+        # Keep the runs of rows something is drawn on, each cropped to its columns
+        covered = inverse[..., 0] < 1.0
+        rows = np.flatnonzero(covered.any(axis=1))
+        runs = np.split(rows, np.flatnonzero(np.diff(rows) > 1) + 1)
+        for run in runs:
+            band_rows = slice(run[0], run[-1] + 1)
+            columns = np.flatnonzero(covered[band_rows].any(axis=0))
+            band_columns = slice(columns[0], columns[-1] + 1)
+            self.bands.append((
+                (slice(y0 + band_rows.start, y0 + band_rows.stop),
+                 slice(x0 + band_columns.start, x0 + band_columns.stop)),
+                premultiplied[band_rows, band_columns].copy(),
+                inverse[band_rows, band_columns].copy(),
+            ))
+
+    def clear(self, frame, color):
+        """Put the background back under the plate"""
+        for (fy, fx), _, _ in self.bands:
+            frame[fy, fx] = color
+
+    def draw(self, frame):
+        for (fy, fx), premultiplied, inverse in self.bands:
+            frame[fy, fx] = premultiplied + inverse * frame[fy, fx]
+
+
+class FrameOverlay:
+    """A layer that may change over time, blitted every frame"""
+
+    def __init__(self, clip, frame_size):
+        self.clip = clip
+        self.frame_size = frame_size
+
+    def draw(self, frame, t):
+        clip = self.clip
+        if not clip.is_playing(t):
+            return
+        t = t - clip.start
+        rgb = clip.get_frame(t)
+        h, w = rgb.shape[:2]
+        bounds = blit_bounds(resolve_position(clip.pos(t), self.frame_size, (w, h)), self.frame_size, (w, h))
+        if bounds is None:
+            return
+        (fy, fx), (sy, sx) = bounds
+        if clip.mask is None:
+            frame[fy, fx] = rgb[sy, sx]
+        else:
+            mask = clip.mask.get_frame(t)[sy, sx][..., None]
+            frame[fy, fx] = 1.0 * mask * rgb[sy, sx] + (1.0 - mask) * frame[fy, fx]
+
+
+class LayerStackClip(VideoClip):
+    """
+    Composite opaque video layers and static overlays into a reused buffer.
+
+    Parameters:
+    -----------
+    layers : list
+        Positioned opaque video clips, bottom to top
+    overlays : list
+        Positioned clips (text, watermark) drawn over the layers. Static
+        ones are flattened once into a StaticPlate; any others, and all
+        layers above them, are drawn every frame.
+    size : tuple
+        (width, height) of the output
+    duration : float
+        Duration of the composite
+    bg_color : tuple
+        Colour of the area not covered by any layer
+    captions : CaptionTrack
+        Timed captions drawn over everything else (see captions.py)
+
+    Positions are resolved once at construction. The background outside
+    the layers and the plate is filled once, not per frame, so the frame
+    returned by get_frame must not be modified, and it is overwritten by the
+    next call: callers that keep frames around must copy them.
+    """
+
+    def __init__(self, layers, overlays=(), size=None, duration=None, bg_color=(0, 0, 0), captions=None):
+        VideoClip.__init__(self, duration=duration)
+        self.size = tuple(size) if size is not None else tuple(layers[0].size)
+        self.layers = []
+        for clip in layers:
+            pos = resolve_position(clip.pos(0), self.size, clip.size)
+            self.layers.append((clip, blit_bounds(pos, self.size, clip.size)))
+        overlays = list(overlays)
+        static = 0
+        while static < len(overlays) and is_static(overlays[static], duration):
+            static += 1
+        self.plate = StaticPlate(overlays[:static], self.size)
+        self.overlays = [FrameOverlay(clip, self.size) for clip in overlays[static:]]
+        self.captions = captions
+        self.bg_color = np.array(bg_color, dtype='uint8')
+
+        fpss = [clip.fps for clip in layers if getattr(clip, 'fps', None)]
+        self.fps = max(fpss) if fpss else None
+
+        width, height = self.size
+        self._buffer = np.empty((height, width, 3), dtype='uint8')
+        self._buffer[...] = self.bg_color
+        self.make_frame = self._make_frame
+
+    def _make_frame(self, t):
+        frame = self._buffer
+        playing = [(clip, bounds) for clip, bounds in self.layers
+                   if bounds is not None and clip.is_playing(t)]
+        if self.overlays or len(playing) < len(self.layers):
+            # Whatever the last frame drew may not be covered this time
+            frame[...] = self.bg_color
+        else:
+            # Only the layers, the plate and the captions ever change the buffer
+            self.plate.clear(frame, self.bg_color)
+            if self.captions is not None:
+                self.captions.clear(frame, self.bg_color)
+
+        for clip, ((fy, fx), (sy, sx)) in playing:
+            frame[fy, fx] = clip.get_frame(t - clip.start)[sy, sx]
+
+        self.plate.draw(frame)
+        for overlay in self.overlays:
+            overlay.draw(frame, t)
+        if self.captions is not None:
+            self.captions.draw(frame, t)
+
+        return frame
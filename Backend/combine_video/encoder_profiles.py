@@ -0,0 +1,141 @@
+"""
+Named x264 encoder profiles.
+
+- draft: renders at half resolution with ultrafast/CRF for quick previews
+- standard: bitrate scaled to the output pixel rate (8 Mbps at 1080x1920/30)
+- archive: slow preset with a CRF picked by output size
+
+Threads are derived from the cores available to each render worker instead
+of a fixed count, and every profile sets a keyframe interval so players can
+seek in the output.
+"""
+import os
+
+from django.conf import settings
+
+DEFAULT_ENCODER_PROFILE = 'standard'
+
+ENCODER_PROFILES = {
+    'draft': {
+        'preset': 'ultrafast',
+        'tune': 'fastdecode',
+        'crf': 30,
+        'resolution_scale': 0.5,
+        'keyint_seconds': 2,
+    },
+    'standard': {
+        'preset': 'faster',
+        # bits per pixel per frame; 1080x1920 at 30 fps comes to ~8 Mbps
+        'bits_per_pixel': 0.13,
+        'resolution_scale': 1.0,
+        'keyint_seconds': 2,
+    },
+    'archive': {
+        'preset': 'slow',
+        'tune': 'film',
+        # (max output pixels, crf): smaller frames get a lower CRF
+        'crf_by_pixels': [(640 * 640, 18), (1080 * 1920, 19), (None, 20)],
+        'resolution_scale': 1.0,
+        'keyint_seconds': 5,
+    },
+}
+
+
+def get_encoder_profile(name):
+    if name not in ENCODER_PROFILES:
+        raise ValueError(f"encoder_profile must be one of {', '.join(ENCODER_PROFILES)}")
+    return ENCODER_PROFILES[name]
+
+
+def encoder_threads():
+    """Cores available to one render worker"""
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    return max(1, cores // max(1, settings.RENDER_MAX_WORKERS))
+
+
+def scaled_resolution(target_resolution, profile_name):
+    """Output height for a profile, kept even for 4:2:0 encoding"""
+    scale = get_encoder_profile(profile_name)['resolution_scale']
+    if scale == 1.0:
+        return target_resolution
+    return max(2, int(target_resolution * scale) // 2 * 2)
+
+
+# Render parameters measured in output pixels
+LAYOUT_LENGTH_PARAMS = (
+    'video1_offset', 'video2_offset', 'text_fontsize', 'text_x_offset', 'text_y_offset', 'watermark_fontsize',
+    'caption_fontsize',
+)
+
+
+def scale_for_profile(params, profile_name):
+    """Return render params with the output size and pixel lengths scaled for the profile"""
+    target_resolution = params.get('target_resolution', 1080)
+    return scale_layout(params, scaled_resolution(target_resolution, profile_name))
+
+
+def scale_layout(params, resolution):
+    """Return render params for an output `resolution` pixels high, with pixel lengths scaled to match"""
+    target_resolution = params.get('target_resolution', 1080)
+    if resolution == target_resolution:
+        return params
+
+    scale = resolution / target_resolution
+    params = dict(params, target_resolution=resolution)
+    params.setdefault('watermark_fontsize', 30)
+    for key in LAYOUT_LENGTH_PARAMS:
+        if key in params:
+            params[key] = int(round(params[key] * scale))
+    params['watermark_fontsize'] = max(1, params['watermark_fontsize'])
+    for key in ('text_fontsize', 'caption_fontsize'):
+        if key in params:
+            params[key] = max(1, params[key])
+    if isinstance(params.get('text_position'), (tuple, list)):
+        params['text_position'] = tuple(int(round(v * scale)) for v in params['text_position'])
+    return params
+
+
+def encoder_settings(profile_name, output_size, fps, threads=None):
+    """Resolve a profile into concrete x264 settings for one output"""
+    profile = get_encoder_profile(profile_name)
+    width, height = output_size
+    pixels = width * height
+
+    crf = profile.get('crf')
+    for max_pixels, value in profile.get('crf_by_pixels', []):
+        if max_pixels is None or pixels <= max_pixels:
+            crf = value
+            break
+
+    bitrate = None
+    if 'bits_per_pixel' in profile:
+        bitrate = f"{int(pixels * fps * profile['bits_per_pixel'] / 1000)}k"
+
+    return {
+        'preset': profile['preset'],
+        'tune': profile.get('tune'),
+        'crf': crf,
+        'bitrate': bitrate,
+        'keyint': max(1, int(round(profile['keyint_seconds'] * fps))),
+        'threads': threads or encoder_threads(),
+    }
+
+
+# Write the index (moov atom) first so playback and seeking start before the whole file arrives
+MP4_MUXER_ARGS = ['-movflags', '+faststart']
+
+
+def ffmpeg_output_args(encoding):
+    """Video encoder arguments for an ffmpeg command line, shared by both render backends"""
+    args = ['-c:v', 'libx264', '-preset', encoding['preset'], '-threads', str(encoding['threads'])]
+    if encoding['bitrate']:
+        args += ['-b:v', encoding['bitrate']]
+    args += ['-g', str(encoding['keyint'])]
+    if encoding['crf'] is not None:
+        args += ['-crf', str(encoding['crf'])]
+    if encoding['tune']:
+        args += ['-tune', encoding['tune']]
+    return args + MP4_MUXER_ARGS
@@ -0,0 +1,363 @@
+"""
+ffmpeg filter_complex render backend.
+
+Builds the same layout (layouts.py) as combine_videos_vertically as a
+single ffmpeg filtergraph (crop, scale, overlay, drawtext, subtitles, amix)
+and runs it in one ffmpeg process, so decoded frames never pass through
+Python. Text is drawn with drawtext/FreeType rather than ImageMagick, and
+captions with libass rather than the glyph atlas, so glyph shapes differ
+slightly from the MoviePy backend; the layout and timing are the same.
+"""
+import os
+import subprocess
+import tempfile
+import threading
+
+from django.conf import settings
+from moviepy.config import get_setting
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+
+from .audio import DUCK_THRESHOLD, DUCK_HOLD_SECONDS, LIMITER_CEILING
+from .captions import ass_style
+from .layouts import DEFAULT_LAYOUT, compile_layout, output_size
+from .metrics import stage, add_frames
+from .progress import advance_frames, set_total_frames
+from .passthrough import passthrough_audio
+from .encoder_profiles import DEFAULT_ENCODER_PROFILE, encoder_settings, ffmpeg_output_args
+
+
+def escape_filter_value(value):
+    """Escape a filter option value for both levels of filtergraph parsing"""
+    value = str(value)
+    # Option value level
+    for ch in "\\':":
+        value = value.replace(ch, '\\' + ch)
+    # Filtergraph level
+    for ch in "\\'[],;":
+        value = value.replace(ch, '\\' + ch)
+    return value
+
+
+def fontconfig_pattern(font):
+    """Map an ImageMagick font name such as 'Arial-Bold' to a fontconfig pattern"""
+    if font.endswith('-Bold'):
+        return f"{font[:-len('-Bold')]}:style=Bold"
+    return font
+
+
+def probe_video(path):
+    """Return (size, duration, fps, has_audio) without decoding any frames"""
+    infos = ffmpeg_parse_infos(path)
+    width, height = infos['video_size']
+    # Rotated phone footage is decoded upright, as in FFMPEG_VideoReader
+    if infos.get('video_rotation') in (90, 270):
+        width, height = height, width
+    return (width, height), infos['video_duration'], infos['video_fps'], infos['audio_found']
+
+
+def crop_box(size, region_size, crop=None):
+    """
+    (x, y, width, height) of the part of a `size` frame shown in a region:
+    `crop` (fractions of the frame) if given, then center-cropped to the
+    region's aspect ratio, as fit_to_region crops.
+    """
+    width, height = size
+    x = y = 0
+    if crop:
+        x, y = int(round(crop[0] * width)), int(round(crop[1] * height))
+        width = max(1, min(width - x, int(round(crop[2] * width))))
+        height = max(1, min(height - y, int(round(crop[3] * height))))
+
+    region_width, region_height = region_size
+    if width * region_height > height * region_width:
+        # Wider than the region: trim the sides
+        crop_width = (width - height * region_width // region_height) // 2
+        return x + crop_width, y, width - 2 * crop_width, height
+    crop_height = (height - width * region_height // region_width) // 2
+    return x, y + crop_height, width, height - 2 * crop_height
+
+
+def fit_filter(size, region_size, crop=None):
+    """
+    Crop a `size` frame to what a region shows (crop_box) and scale it to
+    the region.
+
+    MoviePy crops and scales RGB frames, so convert first; scaling the
+    subsampled YUV planes shifts chroma and costs ~20 dB of PSNR.
+    """
+    x, y, width, height = crop_box(size, region_size, crop)
+    region_width, region_height = region_size
+    return (f"format=rgb24,crop={width}:{height}:{x}:{y},"
+            f"scale={region_width}:{region_height}:flags=lanczos,setsar=1")
+
+
+def drawtext_filter(textfile, font, fontsize, color, x, y):
+    return (
+        f"drawtext=textfile={escape_filter_value(textfile)}"
+        f":font={escape_filter_value(fontconfig_pattern(font))}"
+        f":fontsize={fontsize}"
+        f":fontcolor={escape_filter_value(color)}"
+        f":x={escape_filter_value(x)}:y={escape_filter_value(y)}"
+    )
+
+
+def subtitles_filter(captions_path, font, fontsize, color, position, frame_height):
+    """Burn in a caption file with libass, styled like captions.CaptionTrack"""
+    style = ass_style(font, fontsize, color, position, frame_height)
+    options = f"filename={escape_filter_value(captions_path)}:force_style={escape_filter_value(style)}"
+    if settings.CAPTION_FONT_PATH:
+        options += f":fontsdir={escape_filter_value(os.path.dirname(settings.CAPTION_FONT_PATH))}"
+    return f"subtitles={options}"
+
+
+def text_overlay_position(position, x_offset=0, y_offset=0):
+    """drawtext x/y expressions equivalent to create_text_overlay's placement"""
+    if isinstance(position, (tuple, list)):
+        x_pos, y_pos = position
+    else:
+        x_pos = "trunc((w-text_w)/2)"
+        if position == 'bottom':
+            y_pos = "h-text_h-20"
+        else:  # 'top' and anything unrecognised
+            y_pos = "40"
+    return f"{x_pos}+{x_offset}", f"{y_pos}+{y_offset}"
+
+
+def build_filtergraph(
+    sizes,
+    plan,
+    duration,
+    fps,
+    text_layers=(),
+    has_video1_audio=True,
+    has_music=False,
+    bg_music_volume=0.3,
+    duck_music=False,
+):
+    """
+    Build the filter_complex graph for a compiled layout (layouts.LayoutPlan).
+
+    Inputs are expected as the plan's sources in order (video1 first, the
+    others looped with -stream_loop), then the background music (looped,
+    optional); `sizes` maps each source to its probed frame size. Produces
+    [vout] and, when any audio is available, [aout].
+    """
+    output_width, output_height = plan.size
+    # libx264 cannot encode 4:2:0 at odd sizes; moviepy falls back to 4:4:4 there too
+    even = output_width % 2 == 0 and output_height % 2 == 0
+    pix_fmt = 'yuv420p' if even else 'yuv444p'
+    inputs = {source: index for index, source in enumerate(plan.sources)}
+    music_input = len(inputs)
+
+    # Composite in RGB like CompositeVideoClip; overlay defaults to yuv420
+    graph = [f"color=c=black:s={output_width}x{output_height}:r={fps}:d={duration}[bg]"]
+
+    # A source shown in several regions is decoded once and split
+    streams = {}
+    for source, index in inputs.items():
+        shown = [i for i, region in enumerate(plan.regions) if region.source == source]
+        if len(shown) == 1:
+            streams[shown[0]] = f"{index}:v"
+            continue
+        graph.append(f"[{index}:v]split={len(shown)}" + "".join(f"[s{i}]" for i in shown))
+        streams.update((i, f"s{i}") for i in shown)
+
+    last = 'bg'
+    for i, region in enumerate(plan.regions):
+        # Other sources are looped by their input and cut to video1's duration
+        trim = '' if region.source == 'video1' else f",trim=duration={duration}"
+        graph.append(
+            f"[{streams[i]}]{fit_filter(sizes[region.source], region.size, region.crop)}{trim},"
+            f"setpts=PTS-STARTPTS[r{i}]"
+        )
+        graph.append(f"[{last}][r{i}]overlay={region.x}:{region.y}:eof_action=pass:format=rgb[l{i}]")
+        last = f"l{i}"
+
+    for i, layer in enumerate(text_layers):
+        graph.append(f"[{last}]{layer}[t{i}]")
+        last = f"t{i}"
+    graph.append(f"[{last}]fps={fps},format={pix_fmt}[vout]")
+
+    if has_music:
+        music = f"[{music_input}:a]volume={bg_music_volume},atrim=0:{duration},asetpts=PTS-STARTPTS"
+        if has_video1_audio:
+            graph.append(f"[0:a]atrim=0:{duration},asetpts=PTS-STARTPTS[a1]")
+            graph.append(f"{music}[a2]")
+            voice, music_out = 'a1', 'a2'
+            if duck_music:
+                # Compress the music keyed on video1, roughly DUCK_GAIN while it is audible
+                graph.append("[a1]asplit=2[voice][sc]")
+                graph.append(
+                    f"[a2][sc]sidechaincompress=threshold={DUCK_THRESHOLD:.6f}:ratio=20"
+                    f":attack=20:release={int(DUCK_HOLD_SECONDS * 1000)}[ducked]"
+                )
+                voice, music_out = 'voice', 'ducked'
+            # amix divides every input by the input count; undo that to get a plain sum
+            graph.append(
+                f"[{voice}][{music_out}]amix=inputs=2:duration=first:dropout_transition=0,volume=2,"
+                f"alimiter=limit={LIMITER_CEILING:.6f}:level=0[aout]"
+            )
+        else:
+            # Limited like the sum, as mix_tracks does with music alone
+            graph.append(f"{music},alimiter=limit={LIMITER_CEILING:.6f}:level=0[aout]")
+    elif has_video1_audio:
+        graph.append(f"[0:a]atrim=0:{duration},asetpts=PTS-STARTPTS[aout]")
+
+    return ";".join(graph), (has_video1_audio or has_music)
+
+
+def run_with_progress(cmd):
+    """Run an ffmpeg command given '-progress pipe:1', passing its frame count to progress.py"""
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # Errors are few lines with -v error, but drain them so ffmpeg never blocks on a full pipe
+    errors = []
+    reader = threading.Thread(target=lambda: errors.append(proc.stderr.read()), daemon=True)
+    reader.start()
+
+    frames = 0
+    for line in proc.stdout:
+        if line.startswith(b'frame='):
+            try:
+                done = int(line[len(b'frame='):])
+            except ValueError:
+                continue
+            if done > frames:
+                advance_frames(done - frames)
+                frames = done
+    proc.wait()
+    reader.join()
+    return proc.returncode, errors[0] if errors else b''
+
+
+def combine_videos_ffmpeg(
+    video1_path,
+    video2_path,
+    output_path,
+    video3_path=None,
+    target_resolution=1080,
+    aspect_ratio=(9, 16),
+    watermark="",
+    watermark_opacity=0.7,
+    text_overlay="",
+    text_position='top',
+    text_fontsize=40,
+    text_font='Arial-Bold',
+    text_color='white',
+    text_x_offset=0,
+    text_y_offset=0,
+    background_music_path=None,
+    bg_music_volume=0.3,
+    video1_offset=34,
+    video2_offset=34,
+    watermark_fontsize=30,
+    encoder_profile=DEFAULT_ENCODER_PROFILE,
+    prepared_dir=None,
+    duck_music=False,
+    layout=DEFAULT_LAYOUT,
+    captions_path=None,
+    caption_font='Arial-Bold',
+    caption_fontsize=40,
+    caption_color='white',
+    caption_position='bottom'
+):
+    """
+    Render a layout with a single ffmpeg process.
+
+    prepared_dir is accepted for parity with the MoviePy backend; ffmpeg
+    decodes and scales inside its own filtergraph, so batches do not
+    prepare assets for it.
+    """
+    plan = compile_layout(layout, output_size(target_resolution, aspect_ratio),
+                          {'video1_offset': video1_offset, 'video2_offset': video2_offset})
+    paths = {'video1': video1_path, 'video2': video2_path, 'video3': video3_path}
+
+    with stage('probe'):
+        sizes = {}
+        for source in plan.sources:
+            sizes[source], source_duration, source_fps, source_audio = probe_video(paths[source])
+            if source == 'video1':
+                duration, fps, has_video1_audio = source_duration, source_fps, source_audio
+
+    has_music = bool(background_music_path) and os.path.exists(background_music_path)
+    # A soundtrack that needs no mixing is copied from its source, not re-encoded
+    copy_audio = passthrough_audio(video1_path, background_music_path)
+    if copy_audio:
+        has_video1_audio = has_music = False
+
+    textfiles = []
+    try:
+        # drawtext reads the text from files so it needs no escaping
+        def write_textfile(text):
+            fd, path = tempfile.mkstemp(suffix='.txt')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(text)
+            textfiles.append(path)
+            return path
+
+        # In the layout's order, where it places them
+        text_layers = []
+        for overlay in plan.overlays:
+            if overlay.type == 'watermark' and watermark:
+                x, y = overlay.ffmpeg_position() if overlay.placed else ("40", "trunc((h-text_h)/2)+60")
+                text_layers.append(drawtext_filter(
+                    write_textfile(watermark), 'Arial-Bold', watermark_fontsize,
+                    f"white@{watermark_opacity}", x, y
+                ))
+            elif overlay.type == 'text' and text_overlay:
+                if overlay.placed:
+                    x, y = overlay.ffmpeg_position()
+                    x, y = f"{x}+{text_x_offset}", f"{y}+{text_y_offset}"
+                else:
+                    x, y = text_overlay_position(text_position, text_x_offset, text_y_offset)
+                text_layers.append(drawtext_filter(
+                    write_textfile(text_overlay), text_font, text_fontsize, text_color, x, y
+                ))
+        if captions_path:
+            text_layers.append(subtitles_filter(
+                captions_path, caption_font, caption_fontsize, caption_color, caption_position, plan.size[1]
+            ))
+
+        graph, has_audio = build_filtergraph(
+            sizes, plan, duration, fps,
+            text_layers=text_layers,
+            has_video1_audio=has_video1_audio,
+            has_music=has_music,
+            bg_music_volume=bg_music_volume,
+            duck_music=duck_music,
+        )
+
+        cmd = [get_setting("FFMPEG_BINARY"), '-v', 'error', '-y', '-i', video1_path]
+        for source in plan.sources[1:]:
+            cmd += ['-stream_loop', '-1', '-i', paths[source]]
+        extra_input = len(plan.sources)
+        if has_music:
+            cmd += ['-stream_loop', '-1', '-i', background_music_path]
+        elif copy_audio and copy_audio != video1_path:
+            cmd += ['-i', copy_audio]
+        cmd += ['-filter_complex', graph, '-map', '[vout]']
+        if copy_audio == video1_path:
+            cmd += ['-map', '0:a:0', '-c:a', 'copy']
+        elif copy_audio:
+            cmd += ['-map', f'{extra_input}:a:0', '-c:a', 'copy']
+        elif has_audio:
+            cmd += ['-map', '[aout]', '-c:a', 'aac', '-ar', '44100']
+        encoding = encoder_settings(encoder_profile, plan.size, fps)
+        cmd += ['-t', str(duration)] + ffmpeg_output_args(encoding) + [output_path]
+
+        # Decode, composite and encode all happen inside this one process,
+        # which reports the frames it has encoded on stdout
+        cmd[1:1] = ['-nostats', '-progress', 'pipe:1']
+        set_total_frames(int(duration * fps))
+        with stage('ffmpeg'):
+            returncode, stderr = run_with_progress(cmd)
+        if returncode != 0:
+            error = stderr.decode('utf-8', errors='replace').strip()
+            print(f"Error processing videos with ffmpeg: {error}")
+            raise RuntimeError(f"ffmpeg render failed: {error[-500:]}")
+        add_frames(int(duration * fps))
+    finally:
+        for path in textfiles:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
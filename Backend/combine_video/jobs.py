@@ -0,0 +1,402 @@
+"""
+Background execution of render jobs.
+
+Renders run on a process pool owned by the web process so the request that
+queued them can return straight away. The pool size is capped by
+RENDER_MAX_WORKERS; extra jobs wait in the executor queue as 'queued'.
+
+With a RENDER_MEMORY_BUDGET, jobs are handed to the pool in arrival order
+only while the memory ceilings of the jobs already handed over, plus
+theirs, fit in it (see memory.py); the rest wait here, also as 'queued'.
+
+That queue lives in this process only, so a monitor thread, started on the
+process's first request, stamps the jobs it holds with a heartbeat every
+RENDER_HEARTBEAT_INTERVAL seconds. A queued or running job whose heartbeat
+is older than RENDER_JOB_STALE_SECONDS was left by a process that stopped
+or crashed: the monitor hands it to this process's pool, whether it was
+queued or running (its worker went with that process). A running job is
+only started RENDER_JOB_MAX_ATTEMPTS times, so one that keeps taking its
+process down is failed instead of bringing down the next.
+"""
+import collections
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# Parameters naming the files a render reads
+INPUT_PARAMS = ('video1_path', 'video2_path', 'video3_path', 'background_music_path', 'captions_path')
+
+# Jobs waiting for memory, and the ceilings of those handed to the pool
+_admission_lock = threading.Lock()
+_waiting = collections.deque()
+_admitted = {}
+# Jobs of batches whose shared assets are being decoded
+_preparing = set()
+
+_monitor = None
+_monitor_lock = threading.Lock()
+
+
+def _init_worker():
+    """Prepare a freshly spawned worker process to use the ORM"""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Backend.settings')
+    import django
+    django.setup()
+
+
+def get_executor():
+    """Return the shared render pool, creating it on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.RENDER_MAX_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+            )
+        return _executor
+
+
+def _reset_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=False)
+        _executor = None
+
+
+def submit_render_job(job):
+    """Queue a RenderJob; it goes to the worker pool once its memory ceiling fits the budget"""
+    start_job_monitor()
+    with _admission_lock:
+        _waiting.append((str(job.id), job.memory_ceiling))
+    _admit_jobs()
+
+
+def _admit_jobs():
+    """Hand waiting jobs to the pool, oldest first, while they fit in RENDER_MEMORY_BUDGET"""
+    budget = settings.RENDER_MEMORY_BUDGET
+    admitted = []
+    with _admission_lock:
+        while _waiting:
+            job_id, ceiling = _waiting[0]
+            # A job larger than the whole budget still runs, on its own
+            if budget and _admitted and sum(_admitted.values()) + ceiling > budget:
+                break
+            _waiting.popleft()
+            _admitted[job_id] = ceiling
+            admitted.append(job_id)
+
+    # Outside the lock: a callback on a finished future runs straight away
+    for job_id in admitted:
+        future = get_executor().submit(run_render_job, job_id)
+        future.add_done_callback(lambda f, job_id=job_id: _on_job_finished(job_id, f))
+
+
+def submit_render_batch(jobs, prepared_dir=None):
+    """
+    Queue the jobs of a batch. With a prepared_dir, one task first decodes
+    the shared video2 and music into it, then the jobs fan out.
+    """
+    if not prepared_dir:
+        for job in jobs:
+            submit_render_job(job)
+        return
+
+    job_ids = [str(job.id) for job in jobs]
+    with _admission_lock:
+        _preparing.update(job_ids)
+    future = get_executor().submit(prepare_batch_assets, job_ids[0])
+    future.add_done_callback(lambda f: _on_batch_prepared(job_ids, f))
+    return future
+
+
+def _on_batch_prepared(job_ids, future):
+    """Fan the batch out; if preparing failed each job decodes the sources itself"""
+    from concurrent.futures.process import BrokenProcessPool
+    from .models import RenderJob
+
+    exc = future.exception()
+    if exc is not None:
+        print(f"Error preparing batch assets: {str(exc)}")
+        if isinstance(exc, BrokenProcessPool):
+            _reset_executor()
+
+    jobs = {str(pk): job for pk, job in RenderJob.objects.in_bulk(job_ids).items()}
+    for job_id in job_ids:
+        submit_render_job(jobs[job_id])
+    with _admission_lock:
+        _preparing.difference_update(job_ids)
+
+
+def prepare_batch_assets(job_id):
+    """Worker entry point: decode the assets shared by a batch job's siblings"""
+    from .models import RenderJob
+    from .prepared import prepare_assets
+
+    return prepare_assets(**RenderJob.objects.get(pk=job_id).params)
+
+
+def _on_job_finished(job_id, future):
+    """Release the job's memory for waiting jobs; record it if its worker died before updating the row"""
+    with _admission_lock:
+        _admitted.pop(job_id, None)
+
+    exc = future.exception()
+    if exc is not None:
+        _record_worker_failure(job_id, exc)
+    _admit_jobs()
+
+
+def _record_worker_failure(job_id, exc):
+    from concurrent.futures.process import BrokenProcessPool
+    from .models import RenderJob
+    from .render_cache import forget_render
+
+    print(f"Render worker failed for job {job_id}: {str(exc)}")
+    if isinstance(exc, BrokenProcessPool):
+        _reset_executor()
+    RenderJob.objects.filter(
+        pk=job_id,
+        status__in=[RenderJob.STATUS_QUEUED, RenderJob.STATUS_RUNNING],
+    ).update(status=RenderJob.STATUS_FAILED, error=str(exc), finished_at=timezone.now())
+    forget_render(job_id)
+    try:
+        job = RenderJob.objects.get(pk=job_id)
+    except RenderJob.DoesNotExist:
+        return  # pruned meanwhile
+    remove_unused_inputs(job)
+    remove_prepared_assets(job)
+
+
+def run_render_job(job_id):
+    """Worker entry point: render one job and store the outcome"""
+    from .memory import memory_limit
+    from .metrics import profiling, record_job_metrics
+    from .models import RenderJob
+    from .progress import reporting_progress
+    from .render_cache import record_render, forget_render
+    from .tasks import render_video
+
+    job = RenderJob.objects.get(pk=job_id)
+    # A job two processes re-queued at once runs once
+    started_at = timezone.now()
+    if not RenderJob.objects.filter(pk=job_id, status=RenderJob.STATUS_QUEUED).update(
+            status=RenderJob.STATUS_RUNNING, started_at=started_at, attempts=F('attempts') + 1):
+        return job.status
+    job.status = RenderJob.STATUS_RUNNING
+    job.started_at = started_at
+    job.attempts += 1
+
+    try:
+        params = dict(job.params)
+        params['aspect_ratio'] = tuple(params['aspect_ratio'])
+        with profiling() as profile, reporting_progress(job.pk), memory_limit(job.memory_ceiling):
+            try:
+                render_video(**params)
+            finally:
+                job.metrics = profile.summary()
+        job.status = RenderJob.STATUS_DONE
+    except MemoryError:
+        job.status = RenderJob.STATUS_FAILED
+        job.error = f"Render exceeded its memory ceiling of {job.memory_ceiling // 2 ** 20} MiB"
+    except Exception as e:
+        job.status = RenderJob.STATUS_FAILED
+        job.error = str(e)
+    finally:
+        remove_unused_inputs(job)
+        remove_prepared_assets(job)
+        job.finished_at = timezone.now()
+        job.save(update_fields=['status', 'error', 'metrics', 'finished_at'])
+        try:
+            record_job_metrics(job.status, job.params, job.metrics)
+        except Exception as e:
+            print(f"Error recording metrics of job {job.pk}: {str(e)}")
+
+        if job.status == RenderJob.STATUS_DONE:
+            record_render(job)
+        else:
+            forget_render(job.pk)
+
+    return job.status
+
+
+def _live_job_ids():
+    """Ids of the jobs this process is holding: waiting, handed to the pool or being prepared"""
+    with _admission_lock:
+        return {job_id for job_id, _ in _waiting} | set(_admitted) | _preparing
+
+
+def job_is_live(job):
+    """Whether a queued or running job is held by this process or by one still sending its heartbeat"""
+    if str(job.pk) in _live_job_ids():
+        return True
+    last_seen = job.heartbeat_at or job.created_at
+    return timezone.now() - last_seen < timedelta(seconds=settings.RENDER_JOB_STALE_SECONDS)
+
+
+def recover_job(job):
+    """
+    Take over a queued or running job no live process holds: it is handed
+    to this process's pool, unless it was running and has been started
+    RENDER_JOB_MAX_ATTEMPTS times, in which case it is failed. Returns
+    False if another process recovered it first.
+    """
+    from .models import RenderJob
+    from .render_cache import forget_render
+
+    # Compare-and-set on the heartbeat, so only one process recovers the job
+    claim = RenderJob.objects.filter(pk=job.pk, status=job.status, heartbeat_at=job.heartbeat_at)
+    now = timezone.now()
+    if job.status == RenderJob.STATUS_QUEUED or job.attempts < settings.RENDER_JOB_MAX_ATTEMPTS:
+        if not claim.update(status=RenderJob.STATUS_QUEUED, heartbeat_at=now):
+            return False
+        print(f"Re-queueing render job {job.pk} left {job.status} by a stopped process")
+        job.status = RenderJob.STATUS_QUEUED
+        job.heartbeat_at = now
+        submit_render_job(job)
+        return True
+
+    error = f"Render worker stopped before the job finished, {job.attempts} times"
+    if not claim.update(status=RenderJob.STATUS_FAILED, error=error, finished_at=now):
+        return False
+    print(f"Render job {job.pk} failed: {error}")
+    job.status = RenderJob.STATUS_FAILED
+    # Its inputs are left to remove_stale_inputs: being content-addressed, they
+    # may be the very files the request recovering it has just uploaded
+    forget_render(job.pk)
+    remove_prepared_assets(job)
+    return True
+
+
+def recover_stale_jobs():
+    """Recover the queued and running jobs whose heartbeat is older than RENDER_JOB_STALE_SECONDS"""
+    from django.db.models import Q
+    from .models import RenderJob
+
+    cutoff = timezone.now() - timedelta(seconds=settings.RENDER_JOB_STALE_SECONDS)
+    stale = (RenderJob.objects
+             .filter(status__in=[RenderJob.STATUS_QUEUED, RenderJob.STATUS_RUNNING])
+             .filter(Q(heartbeat_at__lt=cutoff) | Q(heartbeat_at__isnull=True, created_at__lt=cutoff))
+             .order_by('created_at'))
+    live = _live_job_ids()
+    for job in stale:
+        if str(job.pk) not in live:
+            recover_job(job)
+
+
+def start_job_monitor():
+    """Start this process's heartbeat and recovery thread, once"""
+    global _monitor
+    if not settings.RENDER_HEARTBEAT_INTERVAL:
+        return
+    with _monitor_lock:
+        if _monitor is None:
+            _monitor = threading.Thread(target=_monitor_jobs, name='render-job-monitor', daemon=True)
+            _monitor.start()
+
+
+def _monitor_jobs():
+    from django.db import close_old_connections
+    from .models import RenderJob
+
+    while True:
+        try:
+            live = _live_job_ids()
+            if live:
+                RenderJob.objects.filter(
+                    pk__in=live, status__in=[RenderJob.STATUS_QUEUED, RenderJob.STATUS_RUNNING]
+                ).update(heartbeat_at=timezone.now())
+            recover_stale_jobs()
+        except Exception as e:
+            print(f"Error checking render jobs: {str(e)}")
+        finally:
+            close_old_connections()
+        time.sleep(settings.RENDER_HEARTBEAT_INTERVAL)
+
+
+def job_input_paths(params, uploads=()):
+    """
+    The files to record as a job's input_paths: the request's `uploads` and
+    every input the render reads, assets from chunked uploads included
+    """
+    paths = list(uploads) + [params[key] for key in INPUT_PARAMS if params.get(key)]
+    return list(dict.fromkeys(paths))
+
+
+def active_input_paths(exclude=None):
+    """Input files of the queued and running jobs, other than job `exclude`"""
+    from .models import RenderJob
+
+    active = (RenderJob.objects
+              .filter(status__in=[RenderJob.STATUS_QUEUED, RenderJob.STATUS_RUNNING])
+              .exclude(pk=exclude)
+              .values_list('input_paths', flat=True))
+    return {path for paths in active for path in paths}
+
+
+def remove_unused_inputs(job):
+    """
+    Delete a finished job's input files. Uploads are stored by content hash,
+    so files still referenced by another queued or running job, or kept as
+    reusable assets, stay.
+    """
+    from .chunked_uploads import asset_paths
+
+    in_use = active_input_paths(exclude=job.pk) | asset_paths()
+
+    for path in job.input_paths:
+        if path in in_use:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def remove_prepared_assets(job):
+    """Delete a batch's prepared assets once none of its jobs is queued or running"""
+    from .models import RenderJob
+
+    prepared_dir = job.params.get('prepared_dir')
+    if not prepared_dir:
+        return
+    pending = (RenderJob.objects
+               .filter(status__in=[RenderJob.STATUS_QUEUED, RenderJob.STATUS_RUNNING],
+                       params__prepared_dir=prepared_dir)
+               .exclude(pk=job.pk))
+    if not pending.exists():
+        shutil.rmtree(prepared_dir, ignore_errors=True)
+
+
+def remove_stale_inputs(max_age):
+    """
+    Delete input files nobody has used for max_age seconds, such as files
+    uploaded only for previews, unless a queued or running job needs them.
+    Assets from chunked uploads expire on their own schedule.
+    """
+    from .chunked_uploads import asset_paths
+    from .upload_handlers import input_dir
+
+    in_use = active_input_paths() | asset_paths()
+
+    cutoff = time.time() - max_age
+    directory = input_dir()
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if path not in in_use and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,439 @@
+"""
+Declarative output layouts and their compiler.
+
+A layout is a JSON object saying where each source video goes on the
+output frame and where the watermark and text overlay sit:
+
+    {
+      "vars": {"s": "H // 2"},
+      "regions": [
+        {"source": "video2", "x": "(W - s) // 2", "y": "s - video2_offset", "width": "s", "height": "s"},
+        {"source": "video1", "x": "(W - s) // 2", "y": "video1_offset", "width": "s", "height": "s"}
+      ],
+      "overlays": [
+        {"type": "watermark", "x": 40, "y": "(H - h) // 2 + 60"},
+        {"type": "text"}
+      ]
+    }
+
+Geometry is given as numbers or arithmetic expressions (+ - * / // %,
+min, max) over the output size W x H, the request's video1_offset and
+video2_offset, and the layout's vars, each of which may use the ones
+before it. Overlay positions may also use the overlay's own size w x h; an
+overlay without x and y keeps its usual placement (text_position).
+
+Each region shows one source (video1, video2 or video3), optionally cut
+to `crop` (x, y, width, height in fractions of the source frame), then
+center-cropped to the region's aspect ratio and scaled to fill it. Regions
+are drawn over a black background by ascending `z`, in list order when
+equal, and the overlays over all of them in list order. Sources other
+than video1 loop or are cut to video1's duration.
+
+compile_layout checks a layout once, before anything is decoded, and
+turns it into a LayoutPlan of integer rectangles the compositor
+(compositor.LayerStackClip) and the ffmpeg backend read as they are; no
+layout math is left for the frame loop. Requests name a built-in template
+(TEMPLATES) or send their own layout; vertical-stack, the default, is the
+original two-square layout.
+"""
+import ast
+import json
+import operator
+
+DEFAULT_LAYOUT = 'vertical-stack'
+
+SOURCES = ('video1', 'video2', 'video3')
+OVERLAY_TYPES = ('watermark', 'text')
+
+# Request parameters layouts may refer to
+LAYOUT_NAMES = ('video1_offset', 'video2_offset')
+
+MAX_REGIONS = 8
+MAX_VARS = 16
+MAX_EXPRESSION_LENGTH = 200
+MAX_LAYOUT_JSON_LENGTH = 10000
+# Largest value an expression may come to, in pixels
+MAX_LAYOUT_VALUE = 100000
+
+TEMPLATES = {
+    # Two squares stacked in the middle of the frame, video1 on top
+    'vertical-stack': {
+        'vars': {'s': 'H // 2', 'x': '(W - s) // 2'},
+        'regions': [
+            {'source': 'video2', 'x': 'x', 'y': 's - video2_offset', 'width': 's', 'height': 's'},
+            {'source': 'video1', 'x': 'x', 'y': 'video1_offset', 'width': 's', 'height': 's'},
+        ],
+        'overlays': [
+            {'type': 'watermark', 'x': '40', 'y': '(H - h) // 2 + 60'},
+            {'type': 'text'},
+        ],
+    },
+    # video1 on the left half, video2 on the right
+    'side-by-side': {
+        'vars': {'half': 'W // 2'},
+        'regions': [
+            {'source': 'video1', 'x': 0, 'y': 0, 'width': 'half', 'height': 'H'},
+            {'source': 'video2', 'x': 'half', 'y': 0, 'width': 'W - half', 'height': 'H'},
+        ],
+        'overlays': [
+            {'type': 'watermark', 'x': '40', 'y': '(H - h) // 2 + 60'},
+            {'type': 'text'},
+        ],
+    },
+    # video1 fills the frame, video2 in a third-size inset at the top right
+    'picture-in-picture': {
+        'vars': {'margin': 'min(W, H) // 24', 'inset_w': 'W // 3', 'inset_h': 'H // 3'},
+        'regions': [
+            {'source': 'video1', 'x': 0, 'y': 0, 'width': 'W', 'height': 'H'},
+            {'source': 'video2', 'x': 'W - inset_w - margin', 'y': 'margin',
+             'width': 'inset_w', 'height': 'inset_h'},
+        ],
+        'overlays': [
+            {'type': 'watermark', 'x': '40', 'y': '(H - h) // 2 + 60'},
+            {'type': 'text'},
+        ],
+    },
+    # Three full-width bands: video1, video2, video3 from the top
+    'three-up': {
+        'vars': {'band': 'H // 3'},
+        'regions': [
+            {'source': 'video1', 'x': 0, 'y': 0, 'width': 'W', 'height': 'band'},
+            {'source': 'video2', 'x': 0, 'y': 'band', 'width': 'W', 'height': 'band'},
+            {'source': 'video3', 'x': 0, 'y': '2 * band', 'width': 'W', 'height': 'H - 2 * band'},
+        ],
+        'overlays': [
+            {'type': 'watermark', 'x': '40', 'y': '(H - h) // 2 + 60'},
+            {'type': 'text'},
+        ],
+    },
+}
+
+
+class InvalidLayout(ValueError):
+    """Raised when a layout cannot be rendered"""
+
+
+_BINARY_OPERATORS = {
+    ast.Add: (operator.add, '{}+{}'),
+    ast.Sub: (operator.sub, '{}-{}'),
+    ast.Mult: (operator.mul, '{}*{}'),
+    ast.Div: (operator.truediv, '{}/{}'),
+    ast.FloorDiv: (operator.floordiv, 'floor({}/{})'),
+    ast.Mod: (operator.mod, 'mod({},{})'),
+}
+_UNARY_OPERATORS = {
+    ast.USub: (operator.neg, '-{}'),
+    ast.UAdd: (operator.pos, '{}'),
+}
+_FUNCTIONS = {'min': min, 'max': max}
+
+
+class Expression:
+    """An arithmetic expression over layout names, parsed and checked once"""
+
+    def __init__(self, source, names, where):
+        if isinstance(source, bool) or not isinstance(source, (int, float, str)):
+            raise InvalidLayout(f"{where} must be a number or an expression")
+        self.source = str(source)
+        if len(self.source) > MAX_EXPRESSION_LENGTH:
+            raise InvalidLayout(f"{where} is longer than {MAX_EXPRESSION_LENGTH} characters")
+        try:
+            self.tree = ast.parse(self.source.strip(), mode='eval').body
+        except SyntaxError:
+            raise InvalidLayout(f"{where} is not a valid expression: {self.source!r}") from None
+        self.where = where
+        self._check(self.tree, names)
+
+    def _check(self, node, names):
+        if isinstance(node, ast.Constant):
+            if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+                raise InvalidLayout(f"{self.where} may only contain numbers: {self.source!r}")
+        elif isinstance(node, ast.Name):
+            if node.id not in names:
+                raise InvalidLayout(f"{self.where} uses unknown name {node.id!r}")
+        elif isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+            self._check(node.left, names)
+            self._check(node.right, names)
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPERATORS:
+            self._check(node.operand, names)
+        elif (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _FUNCTIONS
+              and len(node.args) >= 2 and not node.keywords):
+            for arg in node.args:
+                self._check(arg, names)
+        else:
+            raise InvalidLayout(f"{self.where} may only use numbers, names, + - * / // %, min and max: "
+                                f"{self.source!r}")
+
+    def evaluate(self, values):
+        try:
+            value = self._evaluate(self.tree, values)
+        except ZeroDivisionError:
+            raise InvalidLayout(f"{self.where} divides by zero: {self.source!r}") from None
+        except OverflowError:
+            value = None
+        # Also keeps vars built on each other from growing without bound
+        if value is None or not -MAX_LAYOUT_VALUE <= value <= MAX_LAYOUT_VALUE:
+            raise InvalidLayout(f"{self.where} comes to more than {MAX_LAYOUT_VALUE}: {self.source!r}")
+        return value
+
+    def _evaluate(self, node, values):
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.Name):
+            return values[node.id]
+        if isinstance(node, ast.BinOp):
+            return _BINARY_OPERATORS[type(node.op)][0](
+                self._evaluate(node.left, values), self._evaluate(node.right, values)
+            )
+        if isinstance(node, ast.UnaryOp):
+            return _UNARY_OPERATORS[type(node.op)][0](self._evaluate(node.operand, values))
+        return _FUNCTIONS[node.func.id](*(self._evaluate(arg, values) for arg in node.args))
+
+    def ffmpeg(self, values, variables):
+        """
+        The expression in ffmpeg's expression syntax, with `values`
+        substituted and `variables` mapping names to ffmpeg's (drawtext's
+        text_w and text_h, for instance)
+        """
+        return self._ffmpeg(self.tree, values, variables)
+
+    def _ffmpeg(self, node, values, variables):
+        if isinstance(node, ast.Constant):
+            return repr(node.value)
+        if isinstance(node, ast.Name):
+            if node.id in variables:
+                return variables[node.id]
+            return repr(values[node.id])
+        if isinstance(node, ast.BinOp):
+            template = _BINARY_OPERATORS[type(node.op)][1]
+            return template.format(self._ffmpeg_operand(node.left, values, variables),
+                                   self._ffmpeg_operand(node.right, values, variables))
+        if isinstance(node, ast.UnaryOp):
+            return _UNARY_OPERATORS[type(node.op)][1].format(self._ffmpeg_operand(node.operand, values, variables))
+        args = [self._ffmpeg(arg, values, variables) for arg in node.args]
+        # ffmpeg's min and max take two arguments
+        result = args[0]
+        for arg in args[1:]:
+            result = f"{node.func.id}({result},{arg})"
+        return result
+
+    def _ffmpeg_operand(self, node, values, variables):
+        text = self._ffmpeg(node, values, variables)
+        if isinstance(node, (ast.BinOp, ast.UnaryOp)):
+            return f"({text})"
+        return text
+
+
+class LayoutRegion:
+    """Where one source is drawn: an integer rectangle of the output and the part of the source it shows"""
+
+    def __init__(self, source, x, y, width, height, crop=None, z=0):
+        self.source = source
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.crop = crop
+        self.z = z
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    @property
+    def position(self):
+        return self.x, self.y
+
+
+class LayoutOverlay:
+    """A watermark or text overlay, placed by the layout or left to its usual position"""
+
+    def __init__(self, type, x=None, y=None, values=None):
+        self.type = type
+        self.x = x
+        self.y = y
+        self.values = values or {}
+
+    @property
+    def placed(self):
+        return self.x is not None
+
+    def position(self, overlay_size):
+        """Integer (x, y) of an overlay of `overlay_size` on the output"""
+        w, h = overlay_size
+        values = dict(self.values, w=w, h=h)
+        return int(self.x.evaluate(values)), int(self.y.evaluate(values))
+
+    def ffmpeg_position(self):
+        """drawtext x and y expressions for the same position"""
+        variables = {'W': 'w', 'H': 'h', 'w': 'text_w', 'h': 'text_h'}
+        return (f"trunc({self.x.ffmpeg(self.values, variables)})",
+                f"trunc({self.y.ffmpeg(self.values, variables)})")
+
+
+class LayoutPlan:
+    """A compiled layout: regions bottom to top and overlays in drawing order"""
+
+    def __init__(self, size, regions, overlays):
+        self.size = size
+        self.regions = regions
+        self.overlays = overlays
+
+    @property
+    def sources(self):
+        """The sources the layout shows, each once, video1 first"""
+        return [source for source in SOURCES if any(region.source == source for region in self.regions)]
+
+
+def output_size(target_resolution, aspect_ratio):
+    """(width, height) of the output frame"""
+    return int(target_resolution * aspect_ratio[0] / aspect_ratio[1]), target_resolution
+
+
+def parse_layout(value):
+    """
+    Read a request's layout: the name of a template, or a layout given as
+    a JSON object or string. Returns the name or the layout object.
+    """
+    if value is None or value == '':
+        return DEFAULT_LAYOUT
+    if isinstance(value, str) and not value.lstrip().startswith('{'):
+        if value not in TEMPLATES:
+            raise InvalidLayout(f"layout must be a layout object or one of {', '.join(TEMPLATES)}")
+        return value
+    if isinstance(value, str):
+        if len(value) > MAX_LAYOUT_JSON_LENGTH:
+            raise InvalidLayout(f"layout is longer than {MAX_LAYOUT_JSON_LENGTH} characters")
+        try:
+            value = json.loads(value)
+        except ValueError as e:
+            raise InvalidLayout(f"layout is not valid JSON: {str(e)}") from None
+    if not isinstance(value, dict):
+        raise InvalidLayout("layout must be a JSON object")
+    if len(json.dumps(value)) > MAX_LAYOUT_JSON_LENGTH:
+        raise InvalidLayout(f"layout is longer than {MAX_LAYOUT_JSON_LENGTH} characters")
+    return value
+
+
+def _check_keys(item, allowed, where):
+    if not isinstance(item, dict):
+        raise InvalidLayout(f"{where} must be an object")
+    unknown = set(item) - set(allowed)
+    if unknown:
+        raise InvalidLayout(f"{where} has unknown keys: {', '.join(sorted(unknown))}")
+
+
+def _compile_crop(crop, where):
+    if crop is None:
+        return None
+    if (not isinstance(crop, (list, tuple)) or len(crop) != 4
+            or not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in crop)):
+        raise InvalidLayout(f"{where}.crop must be [x, y, width, height] in fractions of the source")
+    x, y, width, height = (float(v) for v in crop)
+    if not (0 <= x < 1 and 0 <= y < 1 and 0 < width <= 1 - x and 0 < height <= 1 - y):
+        raise InvalidLayout(f"{where}.crop must lie inside the source frame (fractions from 0 to 1)")
+    if (x, y, width, height) == (0, 0, 1, 1):
+        return None
+    return x, y, width, height
+
+
+def compile_layout(layout, size, params=None):
+    """
+    Check `layout` (a template name or layout object) for an output of
+    `size` and the request's `params`, and resolve it to a LayoutPlan.
+    Raises InvalidLayout saying what is wrong.
+    """
+    spec = TEMPLATES.get(layout) if isinstance(layout, str) else layout
+    if spec is None:
+        raise InvalidLayout(f"layout must be a layout object or one of {', '.join(TEMPLATES)}")
+    _check_keys(spec, ('vars', 'regions', 'overlays'), 'layout')
+    params = params or {}
+
+    width, height = size
+    values = {'W': width, 'H': height}
+    for name in LAYOUT_NAMES:
+        values[name] = params.get(name, 34)
+
+    variables = spec.get('vars', {})
+    if not isinstance(variables, dict) or len(variables) > MAX_VARS:
+        raise InvalidLayout(f"layout vars must be an object of at most {MAX_VARS} names")
+    for name, source in variables.items():
+        # w and h are kept for the overlays' own size
+        if not name.isidentifier() or name in values or name in _FUNCTIONS or name in ('w', 'h'):
+            raise InvalidLayout(f"layout var {name!r} is not a usable name")
+        values[name] = Expression(source, values, f"vars.{name}").evaluate(values)
+
+    regions_spec = spec.get('regions')
+    if not isinstance(regions_spec, list) or not 1 <= len(regions_spec) <= MAX_REGIONS:
+        raise InvalidLayout(f"layout needs a list of 1 to {MAX_REGIONS} regions")
+    regions = []
+    for index, item in enumerate(regions_spec):
+        where = f"regions[{index}]"
+        _check_keys(item, ('source', 'x', 'y', 'width', 'height', 'crop', 'z'), where)
+        if item.get('source') not in SOURCES:
+            raise InvalidLayout(f"{where}.source must be one of {', '.join(SOURCES)}")
+        geometry = {}
+        for key in ('x', 'y', 'width', 'height'):
+            if key not in item:
+                raise InvalidLayout(f"{where} needs {key}")
+            geometry[key] = int(Expression(item[key], values, f"{where}.{key}").evaluate(values))
+        if geometry['width'] < 2 or geometry['height'] < 2:
+            raise InvalidLayout(f"{where} is {geometry['width']}x{geometry['height']}; "
+                                f"regions must be at least 2x2 pixels")
+        if (geometry['x'] >= width or geometry['y'] >= height
+                or geometry['x'] + geometry['width'] <= 0 or geometry['y'] + geometry['height'] <= 0):
+            raise InvalidLayout(f"{where} lies outside the {width}x{height} frame")
+        z = item.get('z', 0)
+        if isinstance(z, bool) or not isinstance(z, int):
+            raise InvalidLayout(f"{where}.z must be an integer")
+        regions.append(LayoutRegion(item['source'], crop=_compile_crop(item.get('crop'), where), z=z, **geometry))
+    if not any(region.source == 'video1' for region in regions):
+        raise InvalidLayout("layout must show video1, which sets the duration and the soundtrack")
+    # Stable: regions with equal z keep their list order
+    regions.sort(key=lambda region: region.z)
+
+    overlays_spec = spec.get('overlays', [{'type': overlay_type} for overlay_type in OVERLAY_TYPES])
+    if not isinstance(overlays_spec, list):
+        raise InvalidLayout("layout overlays must be a list")
+    overlays = []
+    overlay_names = dict.fromkeys(values, None)
+    overlay_names.update(w=None, h=None)
+    for index, item in enumerate(overlays_spec):
+        where = f"overlays[{index}]"
+        _check_keys(item, ('type', 'x', 'y'), where)
+        if item.get('type') not in OVERLAY_TYPES:
+            raise InvalidLayout(f"{where}.type must be one of {', '.join(OVERLAY_TYPES)}")
+        if any(overlay.type == item['type'] for overlay in overlays):
+            raise InvalidLayout(f"{where}: the {item['type']} appears twice")
+        if ('x' in item) != ('y' in item):
+            raise InvalidLayout(f"{where} needs both x and y, or neither")
+        if 'x' not in item:
+            overlays.append(LayoutOverlay(item['type']))
+            continue
+        overlay = LayoutOverlay(
+            item['type'],
+            Expression(item['x'], overlay_names, f"{where}.x"),
+            Expression(item['y'], overlay_names, f"{where}.y"),
+            values,
+        )
+        # Catch division by zero and the like now rather than mid-render
+        overlay.position((1, 1))
+        overlays.append(overlay)
+
+    return LayoutPlan(size, regions, overlays)
+
+
+def check_layout(params):
+    """
+    Compile the layout of render `params` for its output size, and check
+    that every source it shows was given. Returns the plan.
+    """
+    plan = compile_layout(
+        params.get('layout', DEFAULT_LAYOUT),
+        output_size(params.get('target_resolution', 1080), params.get('aspect_ratio', (9, 16))),
+        params,
+    )
+    missing = [source for source in plan.sources if not params.get(f'{source}_path')]
+    if missing:
+        raise InvalidLayout(f"this layout shows {' and '.join(missing)}, which was not given")
+    return plan
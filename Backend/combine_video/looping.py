@@ -0,0 +1,110 @@
+"""
+Looping clips that map t to t mod duration.
+
+concatenate_videoclips([clip] * n) builds a structure that grows with the
+repeat count and seeks the reader back to zero at every boundary. These
+clips keep a single source and wrap the time instead. When a loop is short
+enough to fit in LOOP_CACHE_MAX_BYTES its decoded frames (or samples) are
+kept, so a 3 second B-roll under a 10 minute video is decoded once. Frames
+already decoded (a PreparedVideoClip from a batch or the asset pool) are
+read in place rather than copied.
+"""
+import numpy as np
+from django.conf import settings
+from moviepy.editor import VideoClip, AudioClip
+
+from .prepared import PreparedVideoClip
+
+
+class LoopedVideoClip(VideoClip):
+    """Play `clip` repeatedly for `duration` seconds"""
+
+    def __init__(self, clip, duration, cache_max_bytes=None):
+        VideoClip.__init__(self, duration=duration)
+        self.clip = clip
+        self.loop_duration = clip.duration
+        self.size = clip.size
+        self.fps = clip.fps
+
+        if cache_max_bytes is None:
+            cache_max_bytes = settings.LOOP_CACHE_MAX_BYTES
+        width, height = clip.size
+        loop_frames = int(np.ceil(self.loop_duration * clip.fps)) + 1
+        cached = not isinstance(clip, PreparedVideoClip) and loop_frames * width * height * 3 <= cache_max_bytes
+        self._frames = {} if cached else None
+
+        if clip.audio is not None:
+            self.audio = loop_audio(clip.audio, duration, cache_max_bytes=0)
+        if clip.mask is not None:
+            self.mask = LoopedVideoClip(clip.mask, duration, cache_max_bytes=0)
+
+        self.make_frame = self._make_frame
+
+    def _make_frame(self, t):
+        t = t % self.loop_duration
+        if self._frames is None:
+            return self.clip.get_frame(t)
+
+        # Same frame index the ffmpeg reader would pick for this time
+        index = int(self.fps * t + 0.00001)
+        frame = self._frames.get(index)
+        if frame is None:
+            # A copy: readers may decode the next frames into the same buffer
+            frame = np.array(self.clip.get_frame(t))
+            frame.setflags(write=False)
+            self._frames[index] = frame
+        return frame
+
+
+def _decode_samples(clip, fps, chunk_size=2000):
+    """
+    Decode a whole audio clip to a (samples, channels) float array.
+
+    Reads in the chunk size write_audiofile uses: the ffmpeg reader returns
+    slightly different samples for much larger requests on short files.
+    """
+    tt = np.arange(0, clip.duration, 1.0 / fps)
+    chunks = [
+        np.asarray(clip.get_frame(tt[i:i + chunk_size])).reshape(-1, clip.nchannels)
+        for i in range(0, len(tt), chunk_size)
+    ]
+    return np.vstack(chunks)
+
+
+def loop_audio(clip, duration, cache_max_bytes=None):
+    """Return an AudioClip playing `clip` repeatedly for `duration` seconds"""
+    loop_duration = clip.duration
+    fps = clip.fps
+    nchannels = clip.nchannels
+
+    if cache_max_bytes is None:
+        cache_max_bytes = settings.LOOP_CACHE_MAX_BYTES
+    if loop_duration * fps * nchannels * 8 <= cache_max_bytes:
+        return looped_samples_clip(_decode_samples(clip, fps), fps, loop_duration, duration)
+
+    def make_frame(t):
+        if np.ndim(t) == 0:
+            return clip.get_frame(t % loop_duration)
+
+        # The reader buffers one contiguous range, so read each cycle separately
+        cycles = np.floor_divide(t, loop_duration)
+        result = np.zeros((len(t), nchannels))
+        for cycle in np.unique(cycles):
+            selected = cycles == cycle
+            result[selected] = clip.get_frame(t[selected] - cycle * loop_duration)
+        return result
+
+    looped = AudioClip(make_frame, duration=duration, fps=fps)
+    looped.nchannels = nchannels
+    return looped
+
+
+def looped_samples_clip(samples, fps, loop_duration, duration):
+    """Return an AudioClip playing decoded (samples, channels) audio repeatedly for `duration` seconds"""
+    def make_frame(t):
+        index = np.round(fps * np.mod(t, loop_duration)).astype(int)
+        return samples[np.minimum(index, len(samples) - 1)]
+
+    looped = AudioClip(make_frame, duration=duration, fps=fps)
+    looped.nchannels = samples.shape[1]
+    return looped
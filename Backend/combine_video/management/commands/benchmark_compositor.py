@@ -0,0 +1,111 @@
+import os
+import tempfile
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from moviepy.editor import VideoFileClip, CompositeVideoClip, ColorClip, ImageClip
+
+from combine_video.compositor import LayerStackClip
+from combine_video.layouts import DEFAULT_LAYOUT, TEMPLATES, compile_layout, output_size
+from combine_video.synthetic import make_test_clip
+from combine_video.tasks import place_regions
+
+
+def make_overlay(size, position, duration, opacity):
+    """
+    A masked overlay shaped like a text layer. It stands in for TextClip so
+    the benchmark does not depend on ImageMagick.
+    """
+    w, h = size
+    rgb = np.zeros((h, w, 3), dtype='uint8')
+    rgb[..., 0] = 255
+    rgb[..., 1] = np.linspace(0, 255, w, dtype='uint8')[None, :]
+    alpha = np.tile(np.linspace(0, 1, h)[:, None], (1, w))
+    mask = ImageClip(alpha, ismask=True)
+    return (ImageClip(rgb).set_mask(mask).set_opacity(opacity)
+            .set_duration(duration).set_position(position))
+
+
+class Command(BaseCommand):
+    help = "Compare LayerStackClip against CompositeVideoClip for speed and frame equality"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--video1', help="Main video (a synthetic clip is generated if omitted)")
+        parser.add_argument('--video2', help="Secondary video (a synthetic clip is generated if omitted)")
+        parser.add_argument('--video3', help="Third video, for layouts that show one (generated if omitted)")
+        parser.add_argument('--layout', choices=list(TEMPLATES), default=DEFAULT_LAYOUT)
+        parser.add_argument('--resolution', type=int, default=1080)
+        parser.add_argument('--aspect-ratio', default='9:16')
+        parser.add_argument('--frames', type=int, default=60)
+
+    def handle(self, *args, **options):
+        aspect_ratio = tuple(map(int, options['aspect_ratio'].split(':')))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            video1_path = options['video1'] or make_test_clip(os.path.join(tmp, 'video1.mp4'), (1920, 1080), 4)
+            video2_path = options['video2'] or make_test_clip(os.path.join(tmp, 'video2.mp4'), (1080, 1920), 2)
+            plan = compile_layout(options['layout'], output_size(options['resolution'], aspect_ratio),
+                                  {'video1_offset': 30, 'video2_offset': 30})
+            sources = {'video1': VideoFileClip(video1_path), 'video2': VideoFileClip(video2_path)}
+            if 'video3' in plan.sources:
+                video3_path = options['video3'] or make_test_clip(os.path.join(tmp, 'video3.mp4'), (1280, 720), 3)
+                sources['video3'] = VideoFileClip(video3_path)
+            video1 = sources['video1']
+
+            try:
+                size = plan.size
+                duration = video1.duration
+                layers = place_regions(plan, [sources[region.source] for region in plan.regions], duration)
+                overlays = [
+                    make_overlay((300, 60), (40, (size[1] - 60) // 2 + 60), duration, 0.6),
+                    make_overlay((size[0] - 80, 120), ('center', 'bottom'), duration, 1.0),
+                ]
+
+                background = ColorClip(size=size, color=(0, 0, 0), duration=duration)
+                reference = CompositeVideoClip([background] + layers + overlays, size=size)
+                compositor = LayerStackClip(layers, overlays, size=size, duration=duration)
+
+                fps = video1.fps
+                times = [i / fps for i in range(options['frames']) if i / fps < duration]
+
+                # Decode each source frame once so only compositing is timed
+                for clip in layers:
+                    clip.get_frame = _memoize_frames(clip.get_frame)
+
+                mismatches = 0
+                reference_time = compositor_time = 0.0
+                for t in times:
+                    start = time.perf_counter()
+                    expected = reference.get_frame(t)
+                    reference_time += time.perf_counter() - start
+
+                    start = time.perf_counter()
+                    actual = compositor.get_frame(t)
+                    compositor_time += time.perf_counter() - start
+
+                    if expected.dtype != actual.dtype or not np.array_equal(expected, actual):
+                        mismatches += 1
+            finally:
+                for clip in sources.values():
+                    clip.close()
+
+        n = len(times)
+        self.stdout.write(f"Output size: {size[0]}x{size[1]}, frames compared: {n}")
+        self.stdout.write(f"CompositeVideoClip: {1000 * reference_time / n:.2f} ms/frame")
+        self.stdout.write(f"LayerStackClip:     {1000 * compositor_time / n:.2f} ms/frame")
+        self.stdout.write(f"Speedup: {reference_time / compositor_time:.2f}x")
+        if mismatches:
+            raise CommandError(f"{mismatches} frame(s) differ from CompositeVideoClip")
+        self.stdout.write(self.style.SUCCESS("All frames identical"))
+
+
+def _memoize_frames(get_frame):
+    cache = {}
+
+    def cached(t):
+        if t not in cache:
+            cache[t] = get_frame(t)
+        return cache[t]
+
+    return cached
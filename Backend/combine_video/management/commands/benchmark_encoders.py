@@ -0,0 +1,65 @@
+import json
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from combine_video.encoder_profiles import ENCODER_PROFILES
+from combine_video.ffmpeg_backend import probe_video
+from combine_video.synthetic import make_test_clip
+from combine_video.tasks import RENDER_BACKENDS, render_video
+
+
+class Command(BaseCommand):
+    help = "Render the same synthetic input with every encoder profile and report fps and file size"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', choices=list(RENDER_BACKENDS), default='ffmpeg')
+        parser.add_argument('--resolution', type=int, default=1080)
+        parser.add_argument('--duration', type=float, default=10)
+        parser.add_argument('--profiles', nargs='+', choices=list(ENCODER_PROFILES), default=list(ENCODER_PROFILES))
+        parser.add_argument('--json', action='store_true', help="Print the results as JSON")
+
+    def handle(self, *args, **options):
+        results = []
+
+        with tempfile.TemporaryDirectory() as tmp:
+            video1_path = make_test_clip(os.path.join(tmp, 'video1.mp4'), (1920, 1080), options['duration'], with_audio=True)
+            video2_path = make_test_clip(os.path.join(tmp, 'video2.mp4'), (1080, 1920), 3)
+            _, _, fps, _ = probe_video(video1_path)
+
+            for profile in options['profiles']:
+                output_path = os.path.join(tmp, f'{profile}.mp4')
+                start = time.perf_counter()
+                render_video(
+                    render_backend=options['backend'],
+                    encoder_profile=profile,
+                    video1_path=video1_path,
+                    video2_path=video2_path,
+                    output_path=output_path,
+                    target_resolution=options['resolution'],
+                    aspect_ratio=(9, 16),
+                )
+                elapsed = time.perf_counter() - start
+
+                (width, height), duration, _, _ = probe_video(output_path)
+                frames = int(duration * fps)
+                results.append({
+                    'profile': profile,
+                    'output_size': f"{width}x{height}",
+                    'seconds': round(elapsed, 2),
+                    'fps': round(frames / elapsed, 1),
+                    'realtime_factor': round(duration / elapsed, 2),
+                    'bytes': os.path.getsize(output_path),
+                })
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        for r in results:
+            self.stdout.write(
+                f"{r['profile']:>9}  {r['output_size']:>9}  {r['fps']:>7} fps  "
+                f"{r['realtime_factor']:>5}x realtime  {r['bytes'] / 1e6:7.2f} MB"
+            )
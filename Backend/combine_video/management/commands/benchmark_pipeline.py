@@ -0,0 +1,200 @@
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+
+import moviepy
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from combine_video.asset_pool import get_pool
+from combine_video.encoder_profiles import ENCODER_PROFILES, DEFAULT_ENCODER_PROFILE, encoder_threads
+from combine_video.ffmpeg_backend import probe_video
+from combine_video.memory import estimate_render_memory
+from combine_video.metrics import profiling
+from combine_video.probe import probe_media
+from combine_video.synthetic import make_test_clip, make_test_tone
+from combine_video.tasks import RENDER_BACKENDS, render_video
+
+# (name, video1 size, video1 duration, video2 size, video2 duration, extra params)
+BENCHMARK_SUITES = {
+    'quick': [
+        ('480p-landscape-5s', (854, 480), 5, (480, 854), 2, {'target_resolution': 480}),
+        ('480p-music-5s', (854, 480), 5, (480, 854), 2, {'target_resolution': 480, 'background_music': True}),
+    ],
+    'standard': [
+        ('720p-landscape-10s', (1280, 720), 10, (720, 1280), 3, {'target_resolution': 720}),
+        ('1080p-landscape-10s', (1920, 1080), 10, (1080, 1920), 3, {'target_resolution': 1080}),
+        ('1080p-portrait-10s', (1080, 1920), 10, (1920, 1080), 3, {'target_resolution': 1080}),
+        ('1080p-square-output', (1920, 1080), 10, (1080, 1920), 3, {'target_resolution': 1080, 'aspect_ratio': (1, 1)}),
+        ('1080p-music-10s', (1920, 1080), 10, (1080, 1920), 3, {'target_resolution': 1080, 'background_music': True}),
+        ('1080p-long-loop-30s', (1920, 1080), 30, (1080, 1920), 2, {'target_resolution': 1080, 'background_music': True}),
+    ],
+    # Phone footage into small squares: decode cost dominates
+    '4k': [
+        ('2160p-landscape-to-512', (3840, 2160), 5, (2160, 3840), 2, {'target_resolution': 1024}),
+        ('2160p-portrait-to-512', (2160, 3840), 5, (3840, 2160), 2, {'target_resolution': 1024}),
+    ],
+    # Peak memory must not grow with the duration and stay under the job's ceiling
+    'long': [
+        ('480p-music-1min', (854, 480), 60, (480, 854), 3, {'target_resolution': 480, 'background_music': True}),
+        ('480p-music-10min', (854, 480), 600, (480, 854), 3, {'target_resolution': 480, 'background_music': True}),
+        ('1080p-duck-2min', (1920, 1080), 120, (1080, 1920), 3,
+         {'target_resolution': 1080, 'background_music': True, 'duck_music': True}),
+    ],
+}
+
+# Case metrics compared against a baseline, and whether higher is better
+COMPARED_METRICS = {
+    'fps': True,
+    'peak_rss_bytes': False,
+}
+
+
+def git_commit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def environment():
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'moviepy': moviepy.__version__,
+        'machine': platform.machine(),
+        'encoder_threads': encoder_threads(),
+    }
+
+
+def find_regressions(results, baseline, threshold):
+    """Compare case metrics with a baseline run; returns readable regression lines"""
+    baseline_cases = {case['name']: case for case in baseline.get('cases', [])}
+    regressions = []
+    for case in results['cases']:
+        previous = baseline_cases.get(case['name'])
+        if previous is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = previous.get(metric), case.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append(f"{case['name']}: {metric} {old} -> {new} ({change:+.1%})")
+    return regressions
+
+
+class Command(BaseCommand):
+    help = "Render synthetic inputs under a parameter matrix and report fps, memory and output size as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--suite', choices=list(BENCHMARK_SUITES), default='quick')
+        parser.add_argument('--backend', choices=list(RENDER_BACKENDS), default='moviepy')
+        parser.add_argument('--encoder-profile', choices=list(ENCODER_PROFILES), default=DEFAULT_ENCODER_PROFILE)
+        parser.add_argument('--repeat', type=int, default=3, help="Runs per case; the median is reported")
+        parser.add_argument('--output', help="Write the JSON report to this file instead of stdout")
+        parser.add_argument('--baseline', help="JSON report of an earlier run to compare against")
+        parser.add_argument('--threshold', type=float, default=0.10,
+                            help="Relative change in fps or peak memory counted as a regression")
+
+    def handle(self, *args, **options):
+        results = {
+            'suite': options['suite'],
+            'backend': options['backend'],
+            'encoder_profile': options['encoder_profile'],
+            'environment': environment(),
+            'cases': [],
+        }
+
+        over_ceiling = []
+        with tempfile.TemporaryDirectory() as tmp:
+            music_path = make_test_tone(os.path.join(tmp, 'music.mp3'), 7)
+
+            for name, size1, duration1, size2, duration2, extra in BENCHMARK_SUITES[options['suite']]:
+                params = {
+                    'video1_path': make_test_clip(os.path.join(tmp, f'{name}-1.mp4'), size1, duration1, with_audio=True),
+                    'video2_path': make_test_clip(os.path.join(tmp, f'{name}-2.mp4'), size2, duration2),
+                    'output_path': os.path.join(tmp, f'{name}-out.mp4'),
+                    'aspect_ratio': (9, 16),
+                    'watermark': '',
+                    'text_overlay': '',
+                }
+                params.update(extra)
+                if params.pop('background_music', False):
+                    params['background_music_path'] = music_path
+
+                infos = {'video1': probe_media(params['video1_path']), 'video2': probe_media(params['video2_path'])}
+                if params.get('background_music_path'):
+                    infos['background_music'] = probe_media(params['background_music_path'])
+                ceiling = estimate_render_memory(
+                    dict(params, render_backend=options['backend'], encoder_profile=options['encoder_profile']), infos
+                )
+
+                runs = []
+                for _ in range(options['repeat']):
+                    # Every run starts cold, as in a fresh worker
+                    get_pool().clear()
+                    with profiling() as profile:
+                        render_video(
+                            render_backend=options['backend'],
+                            encoder_profile=options['encoder_profile'],
+                            **params
+                        )
+                    runs.append(profile.summary())
+
+                run = sorted(runs, key=lambda r: r['wall_seconds'])[len(runs) // 2]
+                (width, height), duration, _, _ = probe_video(params['output_path'])
+                wall = statistics.median(r['wall_seconds'] for r in runs)
+                case = {
+                    'name': name,
+                    'video1': {'size': list(size1), 'duration': duration1},
+                    'video2': {'size': list(size2), 'duration': duration2},
+                    'output_size': [width, height],
+                    'frames': run['frames'],
+                    'wall_seconds': wall,
+                    'fps': round(run['frames'] / wall, 2),
+                    'realtime_factor': round(duration / wall, 3),
+                    'peak_rss_bytes': max(r['peak_rss_bytes'] for r in runs),
+                    'memory_ceiling_bytes': ceiling,
+                    'output_bytes': os.path.getsize(params['output_path']),
+                    'stages': {stage: entry['wall_seconds'] for stage, entry in run['stages'].items()},
+                }
+                results['cases'].append(case)
+                if case['peak_rss_bytes'] > ceiling:
+                    over_ceiling.append(f"{name}: peak RSS {case['peak_rss_bytes'] / 2 ** 20:.0f} MiB "
+                                        f"over its {ceiling / 2 ** 20:.0f} MiB ceiling")
+                self.stderr.write(
+                    f"{name}: {case['fps']} fps, {case['realtime_factor']}x realtime, "
+                    f"{case['peak_rss_bytes'] / 2 ** 20:.0f} MiB peak of {ceiling / 2 ** 20:.0f} MiB ceiling, "
+                    f"{case['output_bytes'] / 1e6:.2f} MB"
+                )
+
+        report = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(report + "\n")
+        else:
+            self.stdout.write(report)
+
+        if over_ceiling:
+            for line in over_ceiling:
+                self.stderr.write(self.style.ERROR(line))
+            raise CommandError(f"{len(over_ceiling)} case(s) over their memory ceiling")
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            regressions = find_regressions(results, baseline, options['threshold'])
+            if regressions:
+                for line in regressions:
+                    self.stderr.write(self.style.ERROR(line))
+                raise CommandError(f"{len(regressions)} regression(s) beyond {options['threshold']:.0%}")
+            self.stderr.write(self.style.SUCCESS(f"No regressions beyond {options['threshold']:.0%} against {options['baseline']}"))
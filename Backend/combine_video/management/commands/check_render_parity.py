@@ -0,0 +1,100 @@
+import os
+import re
+import subprocess
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from moviepy.config import get_setting
+
+from combine_video.ffmpeg_backend import probe_video
+from combine_video.synthetic import make_test_clip, make_test_tone
+from combine_video.tasks import render_video
+
+# (name, video1 size, video1 duration, video2 size, video2 duration, extra params);
+# a 'video3' extra is the (size, duration) of a third clip
+PARITY_CASES = [
+    ('landscape-over-portrait', (1280, 720), 4, (720, 1280), 1.5, {}),
+    ('portrait-over-landscape', (720, 1280), 3, (1280, 720), 5, {}),
+    ('square-output', (640, 480), 3, (480, 640), 2, {'aspect_ratio': (1, 1)}),
+    ('with-music', (1280, 720), 4, (720, 1280), 2, {'background_music': True, 'bg_music_volume': 0.5}),
+    ('shifted-squares', (1280, 720), 3, (720, 1280), 2, {'video1_offset': 0, 'video2_offset': 80}),
+    ('side-by-side', (1280, 720), 3, (720, 1280), 2, {'layout': 'side-by-side'}),
+    ('picture-in-picture', (720, 1280), 3, (1280, 720), 2, {'layout': 'picture-in-picture'}),
+    ('three-up', (1280, 720), 3, (720, 1280), 2, {'layout': 'three-up', 'video3': ((640, 480), 1.5)}),
+]
+
+
+def measure_psnr(reference_path, candidate_path):
+    """Average PSNR (dB) of the candidate's video against the reference"""
+    result = subprocess.run(
+        [get_setting("FFMPEG_BINARY"), '-v', 'info', '-i', candidate_path, '-i', reference_path,
+         '-lavfi', '[0:v][1:v]psnr', '-f', 'null', '-'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+    match = re.search(r'average:(inf|[\d.]+)', result.stderr.decode('utf-8', errors='replace'))
+    if result.returncode != 0 or match is None:
+        raise CommandError(f"Could not measure PSNR of {candidate_path}")
+    return float('inf') if match.group(1) == 'inf' else float(match.group(1))
+
+
+def case_params(directory, case, music_path, resolution, with_text=False):
+    """Encode the synthetic inputs of a PARITY_CASES entry and return its render params"""
+    name, size1, duration1, size2, duration2, extra = case
+    params = {
+        'video1_path': make_test_clip(os.path.join(directory, f'{name}-1.mp4'), size1, duration1, with_audio=True),
+        'video2_path': make_test_clip(os.path.join(directory, f'{name}-2.mp4'), size2, duration2),
+        'target_resolution': resolution,
+        'aspect_ratio': (9, 16),
+        'video1_offset': 30,
+        'video2_offset': 30,
+        'watermark': '@KunalChaudhary2' if with_text else '',
+        'text_overlay': 'Follow for more!' if with_text else '',
+    }
+    params.update(extra)
+    if params.pop('background_music', False):
+        params['background_music_path'] = music_path
+    if 'video3' in params:
+        size3, duration3 = params.pop('video3')
+        params['video3_path'] = make_test_clip(os.path.join(directory, f'{name}-3.mp4'), size3, duration3)
+    return params
+
+
+class Command(BaseCommand):
+    help = "Render synthetic inputs with the moviepy and ffmpeg backends and compare them by PSNR"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-psnr', type=float, default=35.0,
+                            help="Lowest acceptable average PSNR in dB")
+        parser.add_argument('--resolution', type=int, default=480)
+        parser.add_argument('--with-text', action='store_true',
+                            help="Also draw the watermark and text overlay (needs ImageMagick and fonts)")
+
+    def handle(self, *args, **options):
+        failures = []
+
+        with tempfile.TemporaryDirectory() as tmp:
+            music_path = make_test_tone(os.path.join(tmp, 'music.mp3'), 1.5)
+
+            for case in PARITY_CASES:
+                name = case[0]
+                params = case_params(tmp, case, music_path, options['resolution'], options['with_text'])
+
+                outputs = {}
+                for backend in ('moviepy', 'ffmpeg'):
+                    outputs[backend] = os.path.join(tmp, f'{name}-{backend}.mp4')
+                    render_video(render_backend=backend, output_path=outputs[backend], **params)
+
+                psnr = measure_psnr(outputs['moviepy'], outputs['ffmpeg'])
+                _, reference_duration, _, _ = probe_video(outputs['moviepy'])
+                _, candidate_duration, _, _ = probe_video(outputs['ffmpeg'])
+                duration_delta = abs(reference_duration - candidate_duration)
+
+                line = f"{name}: PSNR {psnr:.2f} dB, duration delta {duration_delta:.3f}s"
+                if psnr < options['min_psnr'] or duration_delta > 0.1:
+                    failures.append(name)
+                    self.stdout.write(self.style.ERROR(line))
+                else:
+                    self.stdout.write(self.style.SUCCESS(line))
+
+        if failures:
+            raise CommandError(f"Backends diverge for: {', '.join(failures)}")
@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from combine_video.render_cache import evict_renders, remove_orphan_outputs
+
+
+class Command(BaseCommand):
+    help = "Delete outputs past RENDER_OUTPUT_TTL or over RENDER_CACHE_MAX_BYTES; run from cron when renders are rare"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-bytes', type=int, default=settings.RENDER_CACHE_MAX_BYTES)
+        parser.add_argument('--max-age', type=int, default=settings.RENDER_OUTPUT_TTL,
+                            help="Seconds an output may go unrequested")
+
+    def handle(self, *args, **options):
+        evict_renders(options['max_bytes'], max_age=options['max_age'])
+        remove_orphan_outputs(options['max_age'])
@@ -0,0 +1,311 @@
+"""
+Per-job memory ceilings.
+
+With frames streamed through fixed buffers (streaming.py) and the audio
+mixed a second at a time (audio.mixed_chunks), what a render needs depends
+on its sizes, not its duration: the worker's frame buffers, the ffmpeg
+processes decoding the inputs and encoding the output, a looped video2,
+video3 or music kept in memory up to LOOP_CACHE_MAX_BYTES, and the
+per-block audio levels. estimate_render_memory adds these up from the probed inputs when a
+job is queued, with constants measured on x264 and h264 decoding.
+
+The scheduler (jobs.py) admits jobs while their ceilings fit in
+RENDER_MEMORY_BUDGET, and memory_limit holds the job to its ceiling while
+it runs. RLIMIT_DATA counts each process on its own, and the ffmpeg
+processes and segment workers a render starts would each inherit the whole
+allowance, so the limit only backs up the worker itself. The job as a whole
+is held by a MemoryWatch: a thread that sums the resident memory of the
+worker and every process it started, and kills those processes once their
+growth since the job started passes the ceiling. Either way the render
+fails on its own with a MemoryError instead of pushing the host into the
+OOM killer.
+"""
+import contextlib
+import math
+import os
+import signal
+import threading
+
+from django.conf import settings
+
+from .audio import AUDIO_CHANNELS, AUDIO_FPS, DUCK_BLOCK_SECONDS, LIMITER_BLOCK_SECONDS
+from .captions import CAPTION_CACHE_BANDS, CAPTION_MAX_LINES
+from .encoder_profiles import DEFAULT_ENCODER_PROFILE, encoder_settings, scale_for_profile
+from .layouts import DEFAULT_LAYOUT, compile_layout, output_size
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+MIB = 1024 * 1024
+
+# Python, Django, NumPy and MoviePy in a render worker
+WORKER_BASE_BYTES = 112 * MIB
+# One ffmpeg process before any frames
+FFMPEG_BASE_BYTES = 24 * MIB
+# Source frames (YUV 4:2:0) an h264 decoder holds: references plus one per thread
+DECODER_FRAMES = 12
+# x264 frames per preset (lookahead, references) and per extra thread, in output YUV frames
+ENCODER_FRAMES = {
+    'ultrafast': (18, 4),
+    'superfast': (30, 4),
+    'veryfast': (50, 10),
+    'faster': (75, 10),
+    'fast': (100, 10),
+    'medium': (120, 10),
+    'slow': (140, 10),
+    'slower': (200, 10),
+    'veryslow': (260, 10),
+}
+# Float64 bytes per overlay pixel: the flattened plate and its blend temporaries (compositor.py)
+PLATE_BYTES_PER_PIXEL = 80
+# Float32 bytes per caption pixel: the cached bands (colour and alpha) and one blend's temporaries
+CAPTION_BYTES_PER_PIXEL = 16 * CAPTION_CACHE_BANDS + 32
+# Samples of mix buffers held at once: a chunk in each of a few arrays, and the encoder pipe
+AUDIO_CHUNK_BYTES = 16 * AUDIO_FPS * AUDIO_CHANNELS * 4
+# Added to every estimate for what the model leaves out
+MARGIN = 1.25
+# Seconds between two measurements of a job's processes
+WATCH_INTERVAL = 0.2
+
+
+def _yuv_frame(width, height):
+    """Bytes of a frame as x264 stores it: 4:2:0, or 4:4:4 for odd sizes (see streaming.encoder_command)"""
+    if width % 2 == 0 and height % 2 == 0:
+        return width * height * 3 // 2
+    return width * height * 3
+
+
+def decoder_bytes(video):
+    """An ffmpeg process decoding a probed video stream"""
+    threads = min(16, os.cpu_count() or 1)
+    return FFMPEG_BASE_BYTES + video['width'] * video['height'] * 3 // 2 * (DECODER_FRAMES + threads)
+
+
+def encoder_bytes(size, preset, threads):
+    """The ffmpeg process encoding frames of `size` with x264"""
+    frames, per_thread = ENCODER_FRAMES.get(preset, ENCODER_FRAMES['veryslow'])
+    return FFMPEG_BASE_BYTES + _yuv_frame(*size) * (frames + per_thread * (threads - 1))
+
+
+def overlay_rows(params):
+    """Output rows the watermark and text overlay may cover, by their font sizes and lines"""
+    rows = 0
+    if params.get('watermark'):
+        rows += params.get('watermark_fontsize', 30) * 2 * (params['watermark'].count('\n') + 1)
+    if params.get('text_overlay'):
+        rows += params.get('text_fontsize', 40) * 2 * (params['text_overlay'].count('\n') + 1)
+    return rows
+
+
+def audio_bytes(params, infos, duration):
+    """The streamed music mix: chunk buffers, looped music kept in memory and per-block levels"""
+    if not params.get('background_music_path') or 'background_music' not in infos:
+        return 0
+    music_seconds = min(infos['background_music']['duration'] or duration, duration)
+    music = music_seconds * AUDIO_FPS * AUDIO_CHANNELS * 4
+    blocks = duration * (1 / DUCK_BLOCK_SECONDS + 1 / LIMITER_BLOCK_SECONDS)
+    return (AUDIO_CHUNK_BYTES + (music if music <= settings.LOOP_CACHE_MAX_BYTES else 0)
+            + int(blocks * 8 * 4) + FFMPEG_BASE_BYTES * 2)
+
+
+def frame_bytes(params, infos, plan, duration, fps):
+    """
+    The worker's frame buffers: output, reader pools, cached loops of short
+    sources, the overlay plate and the caption bands
+    """
+    width, height = plan.size
+    total = width * height * 3
+    for region in plan.regions:
+        region_frame = region.width * region.height * 3
+        # Two pool frames and the pipe buffer per reader
+        total += 3 * region_frame
+        source = infos[region.source]
+        if region.source != 'video1' and source['duration'] < duration:
+            loop = (math.ceil(source['duration'] * fps) + 1) * region_frame
+            if loop <= settings.LOOP_CACHE_MAX_BYTES:
+                total += loop
+    total += min(height, overlay_rows(params)) * width * PLATE_BYTES_PER_PIXEL
+    if params.get('captions_path'):
+        rows = params.get('caption_fontsize', 40) * 2 * CAPTION_MAX_LINES
+        total += min(height, rows) * width * CAPTION_BYTES_PER_PIXEL
+    return total
+
+
+def estimate_render_memory(params, infos):
+    """
+    Bytes a render of `params` needs at most, its ffmpeg processes
+    included, given the probe infos of its inputs (probe.probe_inputs)
+    """
+    from .segments import segment_workers
+
+    backend = params.get('render_backend', 'moviepy')
+    profile = params.get('encoder_profile', DEFAULT_ENCODER_PROFILE)
+    scaled = scale_for_profile(params, profile)
+    plan = compile_layout(
+        params.get('layout', DEFAULT_LAYOUT),
+        output_size(scaled.get('target_resolution', 1080), params.get('aspect_ratio', (9, 16))),
+        scaled,
+    )
+    size = plan.size
+
+    video1 = infos['video1']
+    duration, fps = video1['duration'], video1['video']['fps']
+    encoding = encoder_settings(profile, size, fps)
+
+    # The MoviePy backends open a reader per region, ffmpeg one input per source
+    if backend == 'ffmpeg':
+        decoders = sum(decoder_bytes(infos[source]['video']) for source in plan.sources)
+    else:
+        decoders = sum(decoder_bytes(infos[region.source]['video']) for region in plan.regions)
+    audio = audio_bytes(params, infos, duration)
+
+    if backend == 'ffmpeg':
+        # One ffmpeg process decodes, composites and encodes; the worker only waits
+        total = (WORKER_BASE_BYTES + decoders + encoder_bytes(size, encoding['preset'], encoding['threads'])
+                 + size[0] * size[1] * 3 * 4 + audio)
+    else:
+        parts = 1
+        if backend == 'segmented':
+            parts = max(1, min(segment_workers(), int(duration // settings.RENDER_SEGMENT_MIN_SECONDS)))
+        threads = max(1, encoding['threads'] // parts)
+        # Each segment runs in its own worker process with its own readers and encoder
+        part = (WORKER_BASE_BYTES + frame_bytes(params, infos, plan, duration, fps) + decoders
+                + encoder_bytes(size, encoding['preset'], threads))
+        total = part * parts + audio + (WORKER_BASE_BYTES if parts > 1 else 0)
+
+    return int(total * MARGIN)
+
+
+def _data_segment_bytes():
+    """Size of this process's data segment (VmData), what RLIMIT_DATA counts"""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmData:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def _parent_pids():
+    """Parent pid of every process, from /proc/<pid>/stat"""
+    parents = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name is in parentheses and may itself contain spaces or ')'
+        parents[int(name)] = int(stat[stat.rindex(')') + 2:].split()[1])
+    return parents
+
+
+def descendant_pids(pid):
+    """Pids of the processes `pid` started, and theirs"""
+    children = {}
+    for child, parent in _parent_pids().items():
+        children.setdefault(parent, []).append(child)
+    found = []
+    pending = list(children.get(pid, ()))
+    while pending:
+        child = pending.pop()
+        found.append(child)
+        pending.extend(children.get(child, ()))
+    return found
+
+
+def resident_bytes(pids):
+    """Resident memory of the processes in `pids` that still exist"""
+    page = os.sysconf('SC_PAGE_SIZE')
+    total = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/statm') as f:
+                total += int(f.read().split()[1]) * page
+        except (OSError, IndexError, ValueError):
+            pass
+    return total
+
+
+class MemoryWatch:
+    """
+    Holds this process and the processes it starts to `ceiling` bytes of
+    resident memory on top of what they used when the watch started.
+    Processes already running then, such as pooled readers (asset_pool.py),
+    count only by their growth and are never killed; the ones started since
+    are killed when the total passes the ceiling, which makes the render
+    fail on a broken pipe that memory_limit reports as a MemoryError.
+    """
+
+    def __init__(self, ceiling):
+        self.ceiling = ceiling
+        self.pid = os.getpid()
+        self.existing = set(descendant_pids(self.pid))
+        self.baseline = resident_bytes([self.pid, *self.existing])
+        self.peak = 0
+        self.exceeded = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='memory-watch', daemon=True)
+
+    def measure(self):
+        """Bytes the job's processes have grown by, and the processes started since the watch began"""
+        started = [pid for pid in descendant_pids(self.pid) if pid not in self.existing]
+        used = resident_bytes([self.pid, *self.existing, *started]) - self.baseline
+        return used, started
+
+    def run(self):
+        while not self.stopped.wait(WATCH_INTERVAL):
+            used, started = self.measure()
+            self.peak = max(self.peak, used)
+            if used > self.ceiling:
+                self.exceeded = True
+                for pid in started:
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+
+@contextlib.contextmanager
+def memory_limit(ceiling):
+    """
+    Hold the render inside the block, this process and the processes it
+    starts together, to `ceiling` bytes more than they used before it.
+    Going past it raises MemoryError. Yields the MemoryWatch, or None when
+    there is nothing to hold: no ceiling, or no /proc and RLIMIT_DATA.
+    """
+    if not ceiling or resource is None or not os.path.exists('/proc/self/status'):
+        yield None
+        return
+
+    # A backstop for this process alone; children inherit it, hence the watch
+    soft, hard = resource.getrlimit(resource.RLIMIT_DATA)
+    limit = _data_segment_bytes() + ceiling
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_DATA, (limit, hard))
+    try:
+        with MemoryWatch(ceiling) as watch:
+            try:
+                yield watch
+            except Exception as e:
+                if watch.exceeded and not isinstance(e, MemoryError):
+                    raise MemoryError(f"processes of the render used more than {ceiling} bytes") from e
+                raise
+        if watch.exceeded:
+            # Killed processes that failed quietly, e.g. a decoder at the end of its input
+            raise MemoryError(f"processes of the render used more than {ceiling} bytes")
+    finally:
+        resource.setrlimit(resource.RLIMIT_DATA, (soft, hard))
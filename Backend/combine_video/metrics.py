@@ -0,0 +1,274 @@
+"""
+Per-stage profiling of renders and a Prometheus text view of it.
+
+run_render_job wraps each render in profiling(); pipeline code marks its
+stages with `with stage('decode'):` or timed_clip(), which are no-ops when
+nothing is being profiled. Stages nest and each one is charged exclusive
+time, so for the MoviePy backend the frame loop splits into decode,
+crop_resize, composite and encode (the remainder of write_videofile).
+CPU time includes child processes such as ffmpeg once they have exited.
+Segmented renders merge the profiles of their segment processes, so stage
+times there are summed across processes and can exceed the job's wall time.
+
+The summary is stored on RenderJob.metrics. Workers are separate
+processes, so when a job finishes its summary is also added to running
+counters and histograms kept in MetricSeries rows (record_job_metrics).
+The /metrics endpoint reads those, one row per series, and counts jobs by
+status in one grouped query, so a scrape costs the same however many jobs
+the table holds.
+"""
+import bisect
+import contextlib
+import contextvars
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Seconds; shared by job and stage durations
+DURATION_BUCKETS = (0.05, 0.25, 1, 5, 15, 60, 300, 900, 3600)
+FPS_BUCKETS = (1, 2, 5, 10, 15, 30, 60, 120, 240)
+RSS_BUCKETS = tuple(2 ** n * 1024 * 1024 for n in range(7, 14))  # 128 MiB .. 8 GiB
+
+_current = contextvars.ContextVar('render_profile', default=None)
+
+
+def _cpu_seconds():
+    """CPU time of this process plus its reaped children"""
+    times = os.times()
+    return time.process_time() + times.children_user + times.children_system
+
+
+def _peak_rss():
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _reset_peak_rss():
+    """Start a new peak RSS window; render workers are reused across jobs"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+class RenderProfile:
+    """Wall time, CPU time and peak RSS per stage of one render"""
+
+    def __init__(self):
+        self.stages = {}
+        self.frames = 0
+        self._stack = []
+        self._wall_start = time.perf_counter()
+        self._cpu_start = _cpu_seconds()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall_start = time.perf_counter()
+        cpu_start = _cpu_seconds()
+        # Time spent in nested stages, charged to them instead of this one
+        self._stack.append([0.0, 0.0])
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = _cpu_seconds() - cpu_start
+            child_wall, child_cpu = self._stack.pop()
+            if self._stack:
+                self._stack[-1][0] += wall
+                self._stack[-1][1] += cpu
+
+            entry = self.stages.setdefault(
+                name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'calls': 0, 'peak_rss_bytes': 0}
+            )
+            entry['wall_seconds'] += wall - child_wall
+            entry['cpu_seconds'] += cpu - child_cpu
+            entry['calls'] += 1
+            entry['peak_rss_bytes'] = max(entry['peak_rss_bytes'], _peak_rss())
+
+    def merge(self, summary):
+        """Add the frames and stages of a profile summary from another process"""
+        self.frames += summary['frames']
+        for name, other in summary['stages'].items():
+            entry = self.stages.setdefault(
+                name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'calls': 0, 'peak_rss_bytes': 0}
+            )
+            entry['wall_seconds'] += other['wall_seconds']
+            entry['cpu_seconds'] += other['cpu_seconds']
+            entry['calls'] += other['calls']
+            entry['peak_rss_bytes'] = max(entry['peak_rss_bytes'], other['peak_rss_bytes'])
+
+    def summary(self):
+        wall = time.perf_counter() - self._wall_start
+        return {
+            'wall_seconds': round(wall, 4),
+            'cpu_seconds': round(_cpu_seconds() - self._cpu_start, 4),
+            'peak_rss_bytes': _peak_rss(),
+            'frames': self.frames,
+            'fps': round(self.frames / wall, 2) if wall > 0 else 0.0,
+            'stages': {
+                name: dict(entry, wall_seconds=round(entry['wall_seconds'], 4),
+                           cpu_seconds=round(entry['cpu_seconds'], 4))
+                for name, entry in self.stages.items()
+            },
+        }
+
+
+@contextlib.contextmanager
+def profiling():
+    """Profile the stages run inside this block"""
+    _reset_peak_rss()
+    profile = RenderProfile()
+    token = _current.set(profile)
+    try:
+        yield profile
+    finally:
+        _current.reset(token)
+
+
+def stage(name):
+    """Context manager charging its block to `name` in the active profile, if any"""
+    profile = _current.get()
+    return profile.stage(name) if profile is not None else contextlib.nullcontext()
+
+
+def add_frames(count):
+    profile = _current.get()
+    if profile is not None:
+        profile.frames += count
+
+
+def merge_profile(summary):
+    profile = _current.get()
+    if profile is not None:
+        profile.merge(summary)
+
+
+def timed_clip(clip, name, count_frames=False):
+    """A copy of `clip` whose get_frame calls are charged to stage `name`"""
+    profile = _current.get()
+    if profile is None:
+        return clip
+
+    def make_frame(t):
+        with profile.stage(name):
+            frame = clip.get_frame(t)
+        if count_frames:
+            profile.frames += 1
+        return frame
+
+    # Not clip.fl(), which reads a frame for the new clip's size that would be counted
+    timed = clip.copy()
+    timed.make_frame = make_frame
+    return timed
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+# Series kept by record_job_metrics: (name, help, histogram buckets or None for a counter)
+SERIES = (
+    ('render_frames_total', "Video frames rendered", None),
+    ('render_stage_cpu_seconds_total', "CPU time per pipeline stage, children included", None),
+    ('render_job_duration_seconds', "Wall time of a render job", DURATION_BUCKETS),
+    ('render_stage_duration_seconds', "Wall time per pipeline stage of a job", DURATION_BUCKETS),
+    ('render_job_fps', "Frames per second of finished jobs", FPS_BUCKETS),
+    ('render_job_peak_rss_bytes', "Peak resident memory of the worker during a job", RSS_BUCKETS),
+)
+_buckets = {name: buckets for name, _, buckets in SERIES}
+
+
+def _observe(name, labels, value):
+    """Add one observation to a stored series: a histogram's buckets, sum and count, or a counter"""
+    from django.db import transaction
+    from .models import MetricSeries
+
+    buckets = _buckets[name]
+    with transaction.atomic():
+        series, _ = MetricSeries.objects.select_for_update().get_or_create(
+            name=name, labels=_format_labels(labels), defaults={'buckets': [0] * len(buckets or ())}
+        )
+        if buckets:
+            # Counted in the first bucket whose bound is not below it; cumulated on output
+            index = bisect.bisect_left(buckets, value)
+            if index < len(buckets):
+                series.buckets[index] += 1
+        series.sum += value
+        series.count += 1
+        series.save()
+
+
+def record_job_metrics(status, params, metrics):
+    """Add the profile of a job that just finished to the series /metrics reports"""
+    from .models import RenderJob
+
+    if not metrics:
+        return
+    backend = (('backend', params.get('render_backend', 'moviepy')),)
+    _observe('render_job_duration_seconds', backend + (('status', status),), metrics['wall_seconds'])
+    _observe('render_job_peak_rss_bytes', backend, metrics['peak_rss_bytes'])
+    _observe('render_frames_total', backend, metrics['frames'])
+    if status == RenderJob.STATUS_DONE and metrics['frames']:
+        _observe('render_job_fps', backend, metrics['fps'])
+    for name, entry in metrics['stages'].items():
+        labels = backend + (('stage', name),)
+        _observe('render_stage_duration_seconds', labels, entry['wall_seconds'])
+        _observe('render_stage_cpu_seconds_total', labels, entry['cpu_seconds'])
+
+
+def _with_label(labels, key, value):
+    """Add a label to labels formatted by _format_labels"""
+    pair = f'{key}="{value}"'
+    return '{' + pair + '}' if not labels else labels[:-1] + ',' + pair + '}'
+
+
+def _format_value(value):
+    return int(value) if float(value).is_integer() else round(value, 4)
+
+
+def prometheus_text():
+    """Render job counts and profiles in the Prometheus text exposition format"""
+    from django.db.models import Count
+    from .models import MetricSeries, RenderJob
+
+    status_counts = {choice: 0 for choice, _ in RenderJob.STATUS_CHOICES}
+    for status, count in RenderJob.objects.order_by().values_list('status').annotate(Count('pk')):
+        status_counts[status] = count
+
+    lines = [
+        "# HELP render_jobs Render jobs by current status",
+        "# TYPE render_jobs gauge",
+    ]
+    for status, count in status_counts.items():
+        lines.append(f'render_jobs{{status="{status}"}} {count}')
+
+    stored = {}
+    for series in MetricSeries.objects.order_by('name', 'labels'):
+        stored.setdefault(series.name, []).append(series)
+
+    for name, help_text, buckets in SERIES:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {'histogram' if buckets else 'counter'}")
+        for series in stored.get(name, ()):
+            if not buckets:
+                lines.append(f"{name}{series.labels} {_format_value(series.sum)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets, series.buckets):
+                cumulative += count
+                lines.append(f"{name}_bucket{_with_label(series.labels, 'le', bound)} {cumulative}")
+            lines.append(f"{name}_bucket{_with_label(series.labels, 'le', '+Inf')} {series.count}")
+            lines.append(f"{name}_sum{series.labels} {_format_value(series.sum)}")
+            lines.append(f"{name}_count{series.labels} {series.count}")
+    return "\n".join(lines) + "\n"
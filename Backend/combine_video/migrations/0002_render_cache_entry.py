@@ -0,0 +1,26 @@
+# Generated by Django 5.1.3 on 2026-10-17 23:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('combine_video', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RenderCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cache_key', models.CharField(max_length=64, unique=True)),
+                ('output_size', models.BigIntegerField(default=0)),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('job', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='cache_entry', to='combine_video.renderjob')),
+            ],
+        ),
+    ]
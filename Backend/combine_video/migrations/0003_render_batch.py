@@ -0,0 +1,39 @@
+# Generated by Django 5.1.3 on 2026-10-17 23:13
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('combine_video', '0002_render_cache_entry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RenderBatch',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='RenderBatchItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('source_name', models.CharField(blank=True, max_length=255)),
+                ('batch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='combine_video.renderbatch')),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='batch_items', to='combine_video.renderjob')),
+            ],
+            options={
+                'ordering': ['index'],
+                'constraints': [models.UniqueConstraint(fields=('batch', 'index'), name='unique_batch_item_index')],
+            },
+        ),
+    ]
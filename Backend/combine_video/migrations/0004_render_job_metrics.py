@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-17 23:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('combine_video', '0003_render_batch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='renderjob',
+            name='metrics',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
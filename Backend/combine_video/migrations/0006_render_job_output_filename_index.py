@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-17 23:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('combine_video', '0005_upload_session'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='renderjob',
+            name='output_filename',
+            field=models.CharField(blank=True, db_index=True, max_length=255),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.3 on 2026-10-17 23:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('combine_video', '0006_render_job_output_filename_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaProbe',
+            fields=[
+                ('sha256', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('info', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
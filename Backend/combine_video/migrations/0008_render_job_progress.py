@@ -0,0 +1,28 @@
+# Generated by Django 5.1.3 on 2026-10-17 23:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('combine_video', '0007_media_probe'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='renderjob',
+            name='frames_done',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='renderjob',
+            name='frames_total',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='renderjob',
+            name='progress_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-18 00:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('combine_video', '0008_render_job_progress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='renderjob',
+            name='memory_ceiling',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
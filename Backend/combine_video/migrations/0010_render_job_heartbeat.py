@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-18 12:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('combine_video', '0009_render_job_memory_ceiling'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='renderjob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.3 on 2026-10-18 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('combine_video', '0010_render_job_heartbeat'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetricSeries',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64)),
+                ('labels', models.CharField(blank=True, max_length=255)),
+                ('buckets', models.JSONField(default=list)),
+                ('sum', models.FloatField(default=0)),
+                ('count', models.PositiveBigIntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('name', 'labels'), name='unique_metric_series')],
+            },
+        ),
+    ]
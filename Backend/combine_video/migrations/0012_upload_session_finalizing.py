@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-18 13:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('combine_video', '0011_metric_series'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='uploadsession',
+            name='status',
+            field=models.CharField(choices=[('uploading', 'Uploading'), ('finalizing', 'Finalizing'), ('complete', 'Complete')], default='uploading', max_length=16),
+        ),
+    ]
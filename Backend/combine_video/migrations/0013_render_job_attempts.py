@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-18 13:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('combine_video', '0012_upload_session_finalizing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='renderjob',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
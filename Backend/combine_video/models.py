@@ -1,3 +1,150 @@
 from django.db import models
+from django.conf import settings
+import uuid
 
-# Create your models here.
+
+class RenderJob(models.Model):
+    """A queued render of combine_videos_vertically and its current state"""
+
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_QUEUED, db_index=True)
+    params = models.JSONField(default=dict)          # kwargs for combine_videos_vertically
+    input_paths = models.JSONField(default=list)     # files the render reads; uploads removed once the job finishes
+    output_filename = models.CharField(max_length=255, blank=True, db_index=True)
+    error = models.TextField(blank=True)
+    metrics = models.JSONField(default=dict, blank=True)  # per-stage profile, see metrics.py
+    frames_done = models.PositiveIntegerField(default=0)   # progress reported by the worker, see progress.py
+    frames_total = models.PositiveIntegerField(default=0)
+    progress_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True, db_index=True)  # last seen queued or running, see jobs.py
+    memory_ceiling = models.BigIntegerField(default=0)  # bytes the render may use, see memory.py; 0 = unknown
+    attempts = models.PositiveSmallIntegerField(default=0)  # times a worker started it, see jobs.py
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.id} ({self.status})"
+
+    @property
+    def output_url(self):
+        if self.status != self.STATUS_DONE or not self.output_filename:
+            return None
+        return f"{settings.MEDIA_URL}output_videos/{self.output_filename}"
+
+
+class RenderCacheEntry(models.Model):
+    """Maps a hash of a render's inputs and parameters to the job that produced it"""
+
+    cache_key = models.CharField(max_length=64, unique=True)
+    job = models.OneToOneField(RenderJob, on_delete=models.CASCADE, related_name='cache_entry')
+    output_size = models.BigIntegerField(default=0)
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.cache_key[:12]} -> {self.job_id}"
+
+
+class RenderBatch(models.Model):
+    """Renders of many video1 clips against one shared video2 and music track"""
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return str(self.id)
+
+
+class RenderBatchItem(models.Model):
+    """One video1 of a batch and the job rendering it (possibly shared through the render cache)"""
+
+    batch = models.ForeignKey(RenderBatch, on_delete=models.CASCADE, related_name='items')
+    job = models.ForeignKey(RenderJob, on_delete=models.CASCADE, related_name='batch_items')
+    index = models.PositiveIntegerField()
+    source_name = models.CharField(max_length=255, blank=True)
+
+    class Meta:
+        ordering = ['index']
+        constraints = [
+            models.UniqueConstraint(fields=['batch', 'index'], name='unique_batch_item_index'),
+        ]
+
+    def __str__(self):
+        return f"{self.batch_id}[{self.index}]"
+
+
+class UploadSession(models.Model):
+    """A resumable upload sent in chunks; once complete its sha256 is an asset id renders accept"""
+
+    STATUS_UPLOADING = 'uploading'
+    STATUS_FINALIZING = 'finalizing'
+    STATUS_COMPLETE = 'complete'
+    STATUS_CHOICES = [
+        (STATUS_UPLOADING, 'Uploading'),
+        (STATUS_FINALIZING, 'Finalizing'),
+        (STATUS_COMPLETE, 'Complete'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    filename = models.CharField(max_length=255, blank=True)
+    size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)     # bytes stored so far; the next chunk's offset
+    sha256 = models.CharField(max_length=64, db_index=True)  # declared when opened, checked on finalize
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_UPLOADING)
+    path = models.CharField(max_length=1024, blank=True)  # content-addressed file once complete
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)  # last chunk, or last use as an asset
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.filename or self.id} ({self.status})"
+
+
+class MetricSeries(models.Model):
+    """A running Prometheus counter or histogram, added to as render jobs finish (see metrics.py)"""
+
+    name = models.CharField(max_length=64)
+    labels = models.CharField(max_length=255, blank=True)  # formatted, e.g. {backend="moviepy"}
+    buckets = models.JSONField(default=list)  # observations per histogram bucket, not cumulative
+    sum = models.FloatField(default=0)
+    count = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['name', 'labels'], name='unique_metric_series'),
+        ]
+
+    def __str__(self):
+        return f"{self.name}{self.labels}"
+
+
+class MediaProbe(models.Model):
+    """Stream report of an input file, cached by content hash (see probe.py)"""
+
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    info = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.sha256[:12]
@@ -0,0 +1,32 @@
+"""
+Stream copy of audio that needs no processing.
+
+Without background music the soundtrack of a render is video1's audio cut
+to video1's length. Decoding it to PCM and encoding it to AAC again costs
+CPU and a generation of quality, so when its codec can go into an MP4 as
+it is, the backends encode the video alone and mux video1's audio packets
+in with -c copy. Any background music goes through the mix, even at full
+volume over a silent video1, since the mix limits its peaks (see
+audio.mix_tracks).
+"""
+from .probe import InvalidMedia, probe_media
+
+# Audio codecs the MP4 muxer stores as they are
+COPYABLE_AUDIO_CODECS = ('aac', 'mp3', 'alac', 'ac3', 'eac3')
+
+
+def passthrough_audio(video1_path, background_music_path=None):
+    """
+    Path of the file whose first audio stream is the render's whole
+    soundtrack and can be copied, or None when the audio must be rendered.
+    """
+    if background_music_path:
+        return None
+    try:
+        info = probe_media(video1_path)
+    except InvalidMedia:
+        return None
+
+    if info['audio'] is None or info['audio']['codec'] not in COPYABLE_AUDIO_CODECS:
+        return None
+    return video1_path
@@ -0,0 +1,131 @@
+"""
+Assets shared by every item of a batch render, prepared once.
+
+A batch composites one video2 and one music track under many video1 clips.
+Before the items fan out across the render pool, a single task decodes
+video2 already cropped and scaled to its layout region, and the music to PCM
+samples, into .npy files in the batch's directory. Each render then memory
+maps them instead of decoding and resizing the same sources again.
+"""
+import json
+import os
+import tempfile
+
+import numpy as np
+from django.conf import settings
+from moviepy.editor import VideoClip
+
+from .audio import AUDIO_FPS, decode_pcm
+from .encoder_profiles import DEFAULT_ENCODER_PROFILE, scale_for_profile
+from .layouts import DEFAULT_LAYOUT, compile_layout, output_size
+from .readers import RegionVideoFileClip
+
+VIDEO2_FRAMES = 'video2.npy'
+MUSIC_SAMPLES = 'music.npy'
+METADATA = 'assets.json'
+
+
+class PreparedVideoClip(VideoClip):
+    """Frames decoded ahead of time, indexed as the ffmpeg reader would"""
+
+    def __init__(self, frames, fps, duration):
+        VideoClip.__init__(self, duration=duration)
+        self.frames = frames
+        self.fps = fps
+        self.size = (frames.shape[2], frames.shape[1])
+        self.make_frame = lambda t: self.frames[min(int(self.fps * t + 0.00001), len(self.frames) - 1)]
+
+
+def _save_array(path, array):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, array, allow_pickle=False)
+    os.replace(tmp_path, path)
+
+
+def _read_metadata(prepared_dir):
+    try:
+        with open(os.path.join(prepared_dir, METADATA)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def decode_region_frames(clip, max_bytes):
+    """
+    Every frame of an open region clip, one entry per source frame;
+    (None, None) if they would take more than max_bytes
+    """
+    width, height = clip.size
+    count = int(np.ceil(clip.duration * clip.fps)) + 1
+    if count * width * height * 3 > max_bytes:
+        return None, None
+
+    frames = np.empty((count, height, width, 3), dtype='uint8')
+    for index in range(count):
+        frames[index] = clip.get_frame(index / clip.fps)
+    return frames, {'fps': clip.fps, 'duration': clip.duration}
+
+
+def prepare_region_frames(video_path, size, crop=None):
+    """Decode video_path cropped and scaled to a layout region, one entry per source frame"""
+    clip = RegionVideoFileClip(video_path, size, crop=crop, audio=False)
+    try:
+        return decode_region_frames(clip, settings.BATCH_PREPARED_MAX_BYTES)
+    finally:
+        clip.close()
+
+
+def prepare_music_samples(music_path):
+    """Decode music_path to float32 (samples, channels) PCM"""
+    samples = decode_pcm(music_path)
+    return samples, {'fps': AUDIO_FPS, 'duration': len(samples) / AUDIO_FPS}
+
+
+def prepare_assets(prepared_dir, video2_path, background_music_path=None,
+                   encoder_profile=DEFAULT_ENCODER_PROFILE, **params):
+    """Write video2's frames in its layout region and the music samples for a batch to prepared_dir"""
+    os.makedirs(prepared_dir, exist_ok=True)
+    metadata = {}
+
+    # The region video2 is first drawn in, at the size the profile renders
+    params = scale_for_profile(params, encoder_profile)
+    plan = compile_layout(
+        params.get('layout', DEFAULT_LAYOUT),
+        output_size(params.get('target_resolution', 1080), params.get('aspect_ratio', (9, 16))),
+        params,
+    )
+    region = next((region for region in plan.regions if region.source == 'video2'), None)
+
+    frames, info = prepare_region_frames(video2_path, region.size, region.crop) if region else (None, None)
+    if frames is not None:
+        _save_array(os.path.join(prepared_dir, VIDEO2_FRAMES), frames)
+        metadata['video2'] = dict(info, source=os.path.basename(video2_path), size=list(region.size),
+                                  crop=list(region.crop) if region.crop else None)
+
+    if background_music_path:
+        samples, info = prepare_music_samples(background_music_path)
+        _save_array(os.path.join(prepared_dir, MUSIC_SAMPLES), samples)
+        metadata['music'] = dict(info, source=os.path.basename(background_music_path))
+
+    with open(os.path.join(prepared_dir, METADATA), 'w') as f:
+        json.dump(metadata, f)
+    return metadata
+
+
+def load_region_frames(prepared_dir, video_path, size, crop=None):
+    """The prepared clip of video_path in a region of `size` and `crop`, or None if this batch has none"""
+    info = _read_metadata(prepared_dir).get('video2') if prepared_dir else None
+    if (not info or info['source'] != os.path.basename(video_path) or info.get('size') != list(size)
+            or info.get('crop') != (list(crop) if crop else None)):
+        return None
+    frames = np.load(os.path.join(prepared_dir, VIDEO2_FRAMES), mmap_mode='r')
+    return PreparedVideoClip(frames, info['fps'], info['duration'])
+
+
+def load_music_samples(prepared_dir, music_path):
+    """The prepared PCM of music_path, or None if this batch has none"""
+    info = _read_metadata(prepared_dir).get('music') if prepared_dir else None
+    if not info or info['source'] != os.path.basename(music_path) or info['fps'] != AUDIO_FPS:
+        return None
+    return np.load(os.path.join(prepared_dir, MUSIC_SAMPLES), mmap_mode='r')
@@ -0,0 +1,178 @@
+"""
+Low resolution previews of the layouts.
+
+A preview runs the same place_regions / overlay / LayerStackClip code as a
+full render, for one frame or a few seconds at a low frame rate, with no
+audio and no encode. Sources are opened already fitted to their regions by
+ffmpeg and stay open between requests in a small LRU, together with the
+frames decoded from them, so changing an offset or the text only
+recomposites frames that are already in memory.
+"""
+import io
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+from PIL import Image
+
+from .captions import caption_track
+from .compositor import LayerStackClip
+from .encoder_profiles import scale_layout
+from .layouts import DEFAULT_LAYOUT, compile_layout, output_size
+from .readers import RegionVideoFileClip
+from .tasks import place_regions, build_overlays
+
+PREVIEW_FORMATS = {
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'gif': 'image/gif',
+    'webp': 'image/webp',
+}
+ANIMATED_FORMATS = ('gif', 'webp')
+
+PREVIEW_MAX_RESOLUTION = 720
+PREVIEW_MAX_SECONDS = 5
+PREVIEW_MAX_FPS = 15
+
+# Parameters of combine_videos_vertically that change the picture
+LAYOUT_PARAMS = (
+    'target_resolution', 'aspect_ratio', 'video1_offset', 'video2_offset',
+    'watermark', 'watermark_opacity', 'watermark_fontsize',
+    'text_overlay', 'text_position', 'text_fontsize', 'text_font', 'text_color',
+    'text_x_offset', 'text_y_offset', 'layout',
+    'captions_path', 'caption_font', 'caption_fontsize', 'caption_color', 'caption_position',
+)
+
+_sources = OrderedDict()
+_sources_lock = threading.Lock()
+
+
+class PreviewSource:
+    """A video decoded to a layout region of `size`, keeping the frames it has read"""
+
+    def __init__(self, path, size, crop=None):
+        self.clip = RegionVideoFileClip(path, size, crop=crop, audio=False)
+        self.lock = threading.Lock()
+        self.frames = OrderedDict()
+
+        # An equal share of the preview cache for every open source
+        width, height = self.clip.size
+        share = settings.PREVIEW_CACHE_MAX_BYTES // max(1, settings.PREVIEW_SOURCE_CACHE_ITEMS)
+        self.max_frames = max(1, share // (width * height * 3))
+
+    def get_frame(self, t):
+        # Same frame index the ffmpeg reader would pick for this time
+        index = int(self.clip.fps * t + 0.00001)
+        with self.lock:
+            frame = self.frames.get(index)
+            if frame is not None:
+                self.frames.move_to_end(index)
+                return frame
+            frame = self.clip.get_frame(t)
+            frame.setflags(write=False)
+            self.frames[index] = frame
+            while len(self.frames) > self.max_frames:
+                self.frames.popitem(last=False)
+        return frame
+
+    def as_clip(self):
+        """A clip of the source that reads through the frame cache"""
+        return self.clip.fl(lambda gf, t: self.get_frame(t))
+
+    def close(self):
+        self.clip.close()
+
+
+def get_preview_source(path, size, crop=None):
+    """Return the open source for `path` at this size and crop, opening it on a cache miss"""
+    key = (path, size, crop)
+    with _sources_lock:
+        source = _sources.get(key)
+        if source is not None:
+            _sources.move_to_end(key)
+            return source
+
+    source = PreviewSource(path, size, crop)
+    with _sources_lock:
+        if key in _sources:
+            # Another request opened it meanwhile
+            source.close()
+            return _sources[key]
+        _sources[key] = source
+        # Evicted readers close when the last request using them lets go
+        while len(_sources) > settings.PREVIEW_SOURCE_CACHE_ITEMS:
+            _sources.popitem(last=False)
+    return source
+
+
+def preview_times(start, duration, fps, clip_duration):
+    """Timestamps of the preview frames, kept inside the clip"""
+    start = min(max(0.0, start), max(0.0, clip_duration - 1.0 / fps))
+    count = max(1, int(round(duration * fps)))
+    times = start + np.arange(count) / fps
+    return times[times < clip_duration] if count > 1 else times
+
+
+def encode_frames(frames, image_format, fps):
+    """Encode RGB frames as a still image or an animation"""
+    images = [Image.fromarray(frame) for frame in frames]
+    buffer = io.BytesIO()
+    if image_format in ANIMATED_FORMATS:
+        images[0].save(
+            buffer,
+            format=image_format.upper(),
+            save_all=True,
+            append_images=images[1:],
+            duration=int(1000 / fps),
+            loop=0,
+        )
+    else:
+        images[0].save(buffer, format=image_format.upper(), quality=85)
+    return buffer.getvalue()
+
+
+def render_preview(video1_path, video2_path, video3_path=None, t=0.0, duration=0.0, fps=8, resolution=480,
+                   image_format='jpeg', **params):
+    """
+    Render the layout described by `params` at `resolution` pixels high.
+
+    Returns (image bytes, content type). Pixel parameters (offsets, font
+    sizes) are given for params['target_resolution'] and scaled down with
+    the frame, as the draft encoder profile does.
+    """
+    if image_format not in PREVIEW_FORMATS:
+        raise ValueError(f"image_format must be one of {', '.join(PREVIEW_FORMATS)}")
+    if duration > 0 and image_format not in ANIMATED_FORMATS:
+        raise ValueError(f"Animated previews need image_format {' or '.join(ANIMATED_FORMATS)}")
+    resolution = min(max(2, int(resolution)), PREVIEW_MAX_RESOLUTION)
+    duration = min(max(0.0, duration), PREVIEW_MAX_SECONDS)
+    fps = min(max(1, fps), PREVIEW_MAX_FPS)
+
+    params = {k: v for k, v in params.items() if k in LAYOUT_PARAMS}
+    params = scale_layout(params, resolution)
+    aspect_ratio = tuple(params.pop('aspect_ratio', (9, 16)))
+    video1_offset = params.pop('video1_offset', 34)
+    video2_offset = params.pop('video2_offset', 34)
+    layout = params.pop('layout', DEFAULT_LAYOUT)
+    params.pop('target_resolution', None)
+    caption_style = {key[len('caption_'):]: params.pop(key) for key in LAYOUT_PARAMS
+                     if key.startswith('caption_') and key in params}
+    captions_path = params.pop('captions_path', None)
+
+    plan = compile_layout(layout, output_size(resolution, aspect_ratio),
+                          {'video1_offset': video1_offset, 'video2_offset': video2_offset})
+    paths = {'video1': video1_path, 'video2': video2_path, 'video3': video3_path}
+    clips = [get_preview_source(paths[region.source], region.size, region.crop).as_clip()
+             for region in plan.regions]
+
+    clip_duration = next(clip for clip, region in zip(clips, plan.regions) if region.source == 'video1').duration
+    layers = place_regions(plan, clips, clip_duration)
+    overlays = build_overlays(plan.size + (clip_duration,), layout_overlays=plan.overlays, **params)
+    captions = caption_track(captions_path, plan.size, **caption_style)
+    composite = LayerStackClip(layers, overlays, size=plan.size, duration=clip_duration, captions=captions)
+
+    # get_frame reuses its buffer, so copy each frame out
+    times = preview_times(t, duration, fps, clip_duration)
+    frames = [composite.get_frame(frame_time).copy() for frame_time in times]
+    return encode_frames(frames, image_format, fps), PREVIEW_FORMATS[image_format]
@@ -0,0 +1,188 @@
+"""
+Input checks run by the API before a render is queued.
+
+Each input is opened once with `ffmpeg -i`, which reads only the container
+headers (~10 ms), and its stream report is parsed for the streams, codecs,
+frame size, frame rate and duration. Files that ffmpeg cannot read, have no
+stream of the kind the field needs, use a codec this ffmpeg cannot decode,
+or are empty, too long or absurdly sized are rejected with a 400 before any
+decoding. Results are stored per content hash, so an asset used by many
+renders or previews is probed once.
+"""
+import functools
+import re
+import subprocess
+
+from django.conf import settings
+from moviepy.config import get_setting
+
+from .models import MediaProbe
+
+_input_re = re.compile(r'^Input #0, (?P<format>[^ ]+), from ', re.M)
+_duration_re = re.compile(r'Duration: (?P<h>\d+):(?P<m>\d+):(?P<s>\d+(?:\.\d+)?)')
+_stream_re = re.compile(r'^\s*Stream #0:\d+(?:\[\w+\])?(?:\(\w+\))?: (?P<kind>Video|Audio): (?P<codec>\w+)(?P<rest>.*)$', re.M)
+_size_re = re.compile(r', (?P<width>\d+)x(?P<height>\d+)')
+_fps_re = re.compile(r', (?P<fps>[\d.]+)(?P<k>k?) (?:fps|tbr)')
+_audio_re = re.compile(r', (?P<rate>\d+) Hz, (?P<layout>[^,]+)')
+_rotate_re = re.compile(r'^\s*rotate\s*: (?P<rotate>-?\d+)', re.M)
+
+CHANNEL_LAYOUTS = {'mono': 1, 'stereo': 2}
+
+
+class InvalidMedia(ValueError):
+    """Raised when an input cannot be rendered"""
+
+
+@functools.lru_cache(maxsize=1)
+def decodable_codecs():
+    """Names of the codecs this ffmpeg build can decode"""
+    result = subprocess.run([get_setting("FFMPEG_BINARY"), '-hide_banner', '-codecs'],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    codecs = set()
+    for line in result.stdout.decode('utf-8', errors='replace').splitlines():
+        parts = line.split()
+        if len(parts) >= 2 and len(parts[0]) == 6 and parts[0][0] == 'D':
+            codecs.add(parts[1])
+    return codecs
+
+
+def _parse_channels(layout):
+    """Channel count of a layout such as 'stereo', '5.1(side)' or '3 channels'"""
+    if layout in CHANNEL_LAYOUTS:
+        return CHANNEL_LAYOUTS[layout]
+    match = re.match(r'(\d+) channels', layout) or re.match(r'(\d+)\.(\d+)', layout)
+    return sum(int(n) for n in match.groups()) if match else None
+
+
+def _parse_fps(rest):
+    match = _fps_re.search(rest)
+    if not match:
+        return None
+    return float(match.group('fps')) * (1000 if match.group('k') else 1)
+
+
+def parse_stream_report(report):
+    """Container, duration and first video/audio stream from ffmpeg's input report"""
+    input_match = _input_re.search(report)
+    if input_match is None:
+        return None
+    duration_match = _duration_re.search(report)
+    info = {
+        'format': input_match.group('format'),
+        'duration': (int(duration_match.group('h')) * 3600 + int(duration_match.group('m')) * 60
+                     + float(duration_match.group('s'))) if duration_match else None,
+        'video': None,
+        'audio': None,
+    }
+
+    for match in _stream_re.finditer(report):
+        rest = match.group('rest')
+        if match.group('kind') == 'Video' and info['video'] is None and '(attached pic)' not in rest:
+            size = _size_re.search(rest)
+            # The stream's metadata follows its line, up to the next stream
+            following = report[match.end():]
+            next_stream = re.search(r'^\s*Stream #', following, re.M)
+            rotate = _rotate_re.search(following[:next_stream.start()] if next_stream else following)
+            info['video'] = {
+                'codec': match.group('codec'),
+                'width': int(size.group('width')) if size else 0,
+                'height': int(size.group('height')) if size else 0,
+                'fps': _parse_fps(rest),
+                'rotation': int(rotate.group('rotate')) % 360 if rotate else 0,
+            }
+        elif match.group('kind') == 'Audio' and info['audio'] is None:
+            audio = _audio_re.search(rest)
+            info['audio'] = {
+                'codec': match.group('codec'),
+                'sample_rate': int(audio.group('rate')) if audio else 0,
+                'channels': _parse_channels(audio.group('layout').strip()) if audio else None,
+            }
+    return info
+
+
+def probe_media(path):
+    """Read the stream report of `path`; raises InvalidMedia if ffmpeg cannot open it"""
+    result = subprocess.run([get_setting("FFMPEG_BINARY"), '-hide_banner', '-i', path],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    report = result.stderr.decode('utf-8', errors='replace')
+    info = parse_stream_report(report)
+    if info is None:
+        last_line = report.strip().splitlines()[-1] if report.strip() else 'unreadable file'
+        raise InvalidMedia(f"could not be read as media ({last_line.split(': ', 1)[-1]})")
+    return info
+
+
+def get_probe(path, sha256=None):
+    """Probe info for a file, from the per-content cache when its sha256 is known"""
+    if sha256:
+        cached = MediaProbe.objects.filter(sha256=sha256).values_list('info', flat=True).first()
+        if cached is not None:
+            return cached
+    info = probe_media(path)
+    if sha256:
+        MediaProbe.objects.update_or_create(sha256=sha256, defaults={'info': info})
+    return info
+
+
+def _check_duration(info):
+    duration = info['duration']
+    if duration is not None and duration <= 0:
+        raise InvalidMedia("is empty (zero duration)")
+    if duration is not None and duration > settings.MAX_INPUT_DURATION:
+        raise InvalidMedia(f"is {duration:.0f} s long; the limit is {settings.MAX_INPUT_DURATION} s")
+
+
+def check_video(info):
+    """Require a decodable video stream of sensible size, rate and duration"""
+    video = info['video']
+    if video is None:
+        raise InvalidMedia("has no video stream" + (" (audio only)" if info['audio'] else ""))
+    if video['codec'] not in decodable_codecs():
+        raise InvalidMedia(f"uses the {video['codec']} video codec, which cannot be decoded")
+    width, height = video['width'], video['height']
+    if min(width, height) < settings.MIN_INPUT_DIMENSION or max(width, height) > settings.MAX_INPUT_DIMENSION:
+        raise InvalidMedia(
+            f"is {width}x{height}; sides must be between {settings.MIN_INPUT_DIMENSION} "
+            f"and {settings.MAX_INPUT_DIMENSION} pixels"
+        )
+    if not video['fps'] or video['fps'] > 1000:
+        raise InvalidMedia("has no usable frame rate")
+    if info['duration'] is None:
+        raise InvalidMedia("has an unknown duration")
+    _check_duration(info)
+
+
+def check_audio(info):
+    """Require a decodable audio stream with some duration"""
+    audio = info['audio']
+    if audio is None:
+        raise InvalidMedia("has no audio stream")
+    if audio['codec'] not in decodable_codecs():
+        raise InvalidMedia(f"uses the {audio['codec']} audio codec, which cannot be decoded")
+    _check_duration(info)
+
+
+INPUT_CHECKS = {
+    'video1': check_video,
+    'video2': check_video,
+    'video3': check_video,
+    'background_music': check_audio,
+}
+
+
+def probe_inputs(inputs):
+    """
+    Probe and check {field: (path, sha256)} inputs; missing ones are skipped.
+    Returns {field: info}. Raises InvalidMedia naming the failing field.
+    """
+    infos = {}
+    for field, (path, sha256) in inputs.items():
+        if not path:
+            continue
+        try:
+            info = get_probe(path, sha256)
+            INPUT_CHECKS[field](info)
+        except InvalidMedia as e:
+            raise InvalidMedia(f"{field} {e}") from None
+        infos[field] = info
+    return infos
@@ -0,0 +1,226 @@
+"""
+Render progress, counted in the encoder loop and streamed to clients.
+
+Workers are separate processes, so progress goes through the RenderJob row.
+The frame loop counts the frames it hands to the encoder and adds them to
+frames_done with an F() update at most every RENDER_PROGRESS_INTERVAL
+seconds. The segment processes of a segmented render add to the same row,
+so their counts sum to the job's.
+
+Clients follow a job on /api/jobs/<id>/events/, a Server-Sent Events
+stream served by an async view. Each event loop runs one poller that reads
+all the jobs its streams are watching in a single query per interval and
+wakes them, so one ASGI process holds thousands of open streams for one
+query per interval instead of a sync worker and a poll loop per client.
+"""
+import asyncio
+import contextlib
+import contextvars
+import json
+import time
+import weakref
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from .models import RenderJob
+
+# Comment lines keep idle streams open through proxies
+KEEPALIVE_SECONDS = 15
+
+_current = contextvars.ContextVar('render_progress', default=None)
+_hubs = weakref.WeakKeyDictionary()
+
+
+class ProgressReporter:
+    """Batches frame counts of one render into periodic updates of its RenderJob row"""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    def set_total(self, frames):
+        RenderJob.objects.filter(pk=self.job_id).update(
+            frames_total=frames, frames_done=0, progress_at=timezone.now()
+        )
+        self.pending = 0
+
+    def advance(self, frames=1):
+        self.pending += frames
+        if time.monotonic() - self.last_flush >= settings.RENDER_PROGRESS_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            RenderJob.objects.filter(pk=self.job_id).update(
+                frames_done=F('frames_done') + self.pending, progress_at=timezone.now()
+            )
+            self.pending = 0
+        self.last_flush = time.monotonic()
+
+
+@contextlib.contextmanager
+def reporting_progress(job_id):
+    """Report the frames rendered inside this block to job `job_id`"""
+    reporter = ProgressReporter(job_id)
+    token = _current.set(reporter)
+    try:
+        yield reporter
+    finally:
+        _current.reset(token)
+        reporter.flush()
+
+
+def current_job_id():
+    reporter = _current.get()
+    return reporter.job_id if reporter is not None else None
+
+
+def set_total_frames(frames):
+    reporter = _current.get()
+    if reporter is not None:
+        reporter.set_total(frames)
+
+
+def advance_frames(count=1):
+    reporter = _current.get()
+    if reporter is not None:
+        reporter.advance(count)
+
+
+def progress_clip(clip):
+    """A copy of `clip` that counts each frame the encoder takes from it"""
+    reporter = _current.get()
+    if reporter is None:
+        return clip
+
+    def make_frame(t):
+        frame = clip.get_frame(t)
+        reporter.advance()
+        return frame
+
+    # Not clip.fl(), which reads a frame for the new clip's size that would be counted
+    counted = clip.copy()
+    counted.make_frame = make_frame
+    return counted
+
+
+def job_progress(job):
+    """Frames encoded, percent complete and estimated seconds left of a job"""
+    if job.status == RenderJob.STATUS_DONE:
+        return {'frames_done': job.frames_total, 'frames_total': job.frames_total,
+                'percent': 100.0, 'eta_seconds': 0}
+    # Segments may decode a frame or two past their range
+    frames_done = min(job.frames_done, job.frames_total) if job.frames_total else job.frames_done
+    progress = {'frames_done': frames_done, 'frames_total': job.frames_total,
+                'percent': None, 'eta_seconds': None}
+    if job.frames_total:
+        progress['percent'] = round(100.0 * frames_done / job.frames_total, 1)
+    if frames_done and job.frames_total and job.started_at and job.progress_at:
+        # Rate so far, load time included
+        elapsed = (job.progress_at - job.started_at).total_seconds()
+        progress['eta_seconds'] = round(elapsed * (job.frames_total - frames_done) / frames_done, 1)
+    return progress
+
+
+def job_event(job):
+    """(event name, data) describing a job's state for its event stream"""
+    data = {'job_id': str(job.id), 'status': job.status, **job_progress(job)}
+    if job.status == RenderJob.STATUS_DONE:
+        data['output_url'] = job.output_url
+    elif job.status == RenderJob.STATUS_FAILED:
+        data['error'] = job.error
+    name = job.status if job.status in (RenderJob.STATUS_DONE, RenderJob.STATUS_FAILED) else 'progress'
+    return name, data
+
+
+class ProgressHub:
+    """Polls the jobs watched on one event loop and wakes the streams waiting on them"""
+
+    FIELDS = ('id', 'status', 'output_filename', 'error', 'frames_done', 'frames_total',
+              'started_at', 'progress_at')
+
+    def __init__(self):
+        self.watchers = {}
+        self.jobs = {}
+        self.polled = asyncio.Condition()
+        self.task = None
+
+    def watch(self, job_id):
+        self.watchers[job_id] = self.watchers.get(job_id, 0) + 1
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def unwatch(self, job_id):
+        self.watchers[job_id] -= 1
+        if not self.watchers[job_id]:
+            del self.watchers[job_id]
+            self.jobs.pop(job_id, None)
+
+    async def wait(self, timeout):
+        """Wait for the next poll, or `timeout` seconds"""
+        async with self.polled:
+            try:
+                await asyncio.wait_for(self.polled.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self):
+        try:
+            while self.watchers:
+                try:
+                    jobs = {
+                        job.pk: job async for job in
+                        RenderJob.objects.filter(pk__in=list(self.watchers)).only(*self.FIELDS)
+                    }
+                except Exception as e:
+                    print(f"Error polling render progress: {str(e)}")
+                else:
+                    async with self.polled:
+                        self.jobs = jobs
+                        self.polled.notify_all()
+                await asyncio.sleep(settings.RENDER_PROGRESS_INTERVAL)
+        finally:
+            self.task = None
+
+
+def get_hub():
+    loop = asyncio.get_running_loop()
+    hub = _hubs.get(loop)
+    if hub is None:
+        hub = _hubs[loop] = ProgressHub()
+    return hub
+
+
+def format_event(name, data):
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+async def job_events(job):
+    """Server-Sent Events for a job: progress while it runs, then done or failed"""
+    name, data = job_event(job)
+    yield f"retry: {int(settings.RENDER_PROGRESS_INTERVAL * 4000)}\n" + format_event(name, data)
+    if name != 'progress':
+        return
+
+    hub = get_hub()
+    hub.watch(job.pk)
+    try:
+        last_sent = time.monotonic()
+        while True:
+            await hub.wait(KEEPALIVE_SECONDS)
+            job = hub.jobs.get(job.pk, job)
+            event = job_event(job)
+            if event != (name, data):
+                name, data = event
+                yield format_event(name, data)
+                last_sent = time.monotonic()
+                if name != 'progress':
+                    return
+            elif time.monotonic() - last_sent >= KEEPALIVE_SECONDS:
+                yield ": keepalive\n\n"
+                last_sent = time.monotonic()
+    finally:
+        hub.unwatch(job.pk)
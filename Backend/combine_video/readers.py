@@ -0,0 +1,130 @@
+"""
+Video readers that decode straight to the size the layout needs.
+
+VideoFileClip pipes every frame at source resolution and fit_to_region
+then crops and scales it in Python, so a 4K phone clip headed for a 512px
+square moves ~50x more pixels through the pipe and NumPy than it keeps.
+RegionVideoFileClip gives the crop and scale to the ffmpeg process reading
+the file (the same filter the ffmpeg backend uses), so only frames of the
+layout region's size reach Python. With reuse_buffers they are read into
+a FramePool instead of a new array each (see streaming.py).
+"""
+import os
+import subprocess as sp
+import warnings
+
+from moviepy.audio.io.AudioFileClip import AudioFileClip
+from moviepy.config import get_setting
+from moviepy.editor import VideoClip, VideoFileClip
+from moviepy.video.io.ffmpeg_reader import FFMPEG_VideoReader
+
+from .ffmpeg_backend import fit_filter
+from .streaming import FramePool, read_into
+
+
+class RegionVideoReader(FFMPEG_VideoReader):
+    """
+    FFMPEG_VideoReader whose ffmpeg process crops and scales to fill a
+    region of `size` (see ffmpeg_backend.crop_box). With reuse_buffers, a
+    frame it returns is only valid until the frame after next is read.
+    """
+
+    def __init__(self, filename, size, crop=None, pix_fmt='rgb24', reuse_buffers=False):
+        width, height = size
+        depth = 4 if pix_fmt == 'rgba' else 3
+        self.crop = crop
+        self.pool = FramePool((height, width, depth)) if reuse_buffers else None
+        FFMPEG_VideoReader.__init__(
+            self, filename, pix_fmt=pix_fmt, target_resolution=(height, width)
+        )
+
+    def source_size(self):
+        """Frame size as ffmpeg decodes it, rotated phone footage upright"""
+        width, height = self.infos['video_size']
+        if self.rotation in (90, 270):
+            width, height = height, width
+        return width, height
+
+    def initialize(self, starttime=0):
+        """Opens the file, creates the pipe. """
+        self.close()
+
+        if starttime != 0:
+            offset = min(1, starttime)
+            i_arg = ['-ss', "%.06f" % (starttime - offset),
+                     '-i', self.filename,
+                     '-ss', "%.06f" % offset]
+        else:
+            i_arg = ['-i', self.filename]
+
+        cmd = ([get_setting("FFMPEG_BINARY")] + i_arg +
+               ['-loglevel', 'error',
+                '-f', 'image2pipe',
+                '-vf', fit_filter(self.source_size(), self.size, self.crop),
+                '-pix_fmt', self.pix_fmt,
+                '-vcodec', 'rawvideo', '-'])
+        popen_params = {"bufsize": self.bufsize,
+                        "stdout": sp.PIPE,
+                        "stderr": sp.PIPE,
+                        "stdin": sp.DEVNULL}
+
+        if os.name == "nt":
+            popen_params["creationflags"] = 0x08000000
+
+        self.proc = sp.Popen(cmd, **popen_params)
+
+    def skip_frames(self, n=1):
+        """Reads and throws away n frames, into the buffer the next frame will use"""
+        if self.pool is None:
+            return FFMPEG_VideoReader.skip_frames(self, n)
+        for _ in range(n):
+            read_into(self.proc.stdout, self.pool.next())
+            self.pool.unget()
+        self.pos += n
+
+    def read_frame(self):
+        if self.pool is None:
+            return FFMPEG_VideoReader.read_frame(self)
+
+        frame = self.pool.next()
+        if read_into(self.proc.stdout, frame) == frame.nbytes:
+            self.lastread = frame
+            return frame
+
+        # Like FFMPEG_VideoReader: repeat the last good frame, kept out of the next read's way
+        self.pool.unget()
+        if not hasattr(self, 'lastread'):
+            raise IOError(f"MoviePy error: failed to read the first frame of video file {self.filename}")
+        warnings.warn(f"Warning: in file {self.filename}, frame {self.pos}/{self.nframes} could not be "
+                      f"read. Using the last valid frame instead.", UserWarning)
+        return self.lastread
+
+
+class RegionVideoFileClip(VideoFileClip):
+    """A VideoFileClip already cropped and scaled to fill a layout region of `size`"""
+
+    def __init__(self, filename, size, crop=None, audio=True, audio_buffersize=200000,
+                 audio_fps=44100, audio_nbytes=2, reuse_buffers=False):
+        VideoClip.__init__(self)
+
+        self.reader = RegionVideoReader(filename, size, crop=crop, reuse_buffers=reuse_buffers)
+        self.duration = self.reader.duration
+        self.end = self.reader.duration
+        self.fps = self.reader.fps
+        self.size = self.reader.size
+        self.rotation = self.reader.rotation
+        self.filename = self.reader.filename
+        self.make_frame = lambda t: self.reader.get_frame(t)
+
+        if audio and self.reader.infos['audio_found']:
+            self.audio = AudioFileClip(filename, buffersize=audio_buffersize,
+                                       fps=audio_fps, nbytes=audio_nbytes)
+
+
+def source_timing(path):
+    """(duration, fps, has_audio) of a video as the render's reader sees it"""
+    clip = RegionVideoFileClip(path, (2, 2), audio=False)
+    try:
+        return clip.duration, clip.fps, clip.reader.infos['audio_found']
+    finally:
+        clip.close()
@@ -0,0 +1,153 @@
+"""
+Result cache for repeat render requests.
+
+A render is identified by the content hashes of its inputs plus its
+normalized parameters. The first request for a key creates the RenderJob;
+identical requests while it is queued or running attach to that job
+(single-flight) as long as a live process holds it, and requests after it
+finished get its output straight away. Finished outputs are evicted least recently used first once their
+total size passes RENDER_CACHE_MAX_BYTES, and once they have not been
+requested for RENDER_OUTPUT_TTL seconds.
+"""
+import hashlib
+import json
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .jobs import job_is_live, recover_job
+from .models import RenderJob, RenderCacheEntry
+
+# Bump when a pipeline change alters the output for the same inputs
+RENDER_CACHE_VERSION = 2
+
+# Parameters that only say where files live, not what is rendered
+PATH_PARAMS = ('video1_path', 'video2_path', 'video3_path', 'background_music_path', 'captions_path',
+               'output_path', 'prepared_dir')
+
+
+def render_cache_key(input_hashes, params):
+    """Hash the input contents and the parameters that affect the output"""
+    normalized = {k: v for k, v in params.items() if k not in PATH_PARAMS}
+    if 'aspect_ratio' in normalized:
+        normalized['aspect_ratio'] = list(normalized['aspect_ratio'])
+    payload = json.dumps(
+        {'version': RENDER_CACHE_VERSION, 'inputs': list(input_hashes), 'params': normalized},
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _output_available(job):
+    return os.path.exists(job.params.get('output_path', ''))
+
+
+def get_or_create_render_job(cache_key, **job_fields):
+    """
+    Return (job, created). An existing job is reused when it is still
+    queued or running in a live process, or finished with its output still
+    on disk. A queued or running job no process holds is re-queued here
+    (see jobs.recover_job); one failed instead is rendered again.
+    """
+    for _ in range(3):
+        entry = RenderCacheEntry.objects.select_related('job').filter(cache_key=cache_key).first()
+        if entry is not None:
+            job = entry.job
+            if job.status in (RenderJob.STATUS_QUEUED, RenderJob.STATUS_RUNNING):
+                if job_is_live(job):
+                    return job, False
+                if recover_job(job) and job.status == RenderJob.STATUS_QUEUED:
+                    return job, False
+                # Failed here, or recovered by another process meanwhile: look again
+                continue
+            if job.status == RenderJob.STATUS_DONE and _output_available(job):
+                RenderCacheEntry.objects.filter(pk=entry.pk).update(
+                    hits=F('hits') + 1, last_used_at=timezone.now()
+                )
+                return job, False
+            # Failed or evicted: forget it and render again
+            entry.delete()
+
+        try:
+            with transaction.atomic():
+                job = RenderJob.objects.create(**job_fields)
+                RenderCacheEntry.objects.create(cache_key=cache_key, job=job)
+            return job, True
+        except IntegrityError:
+            # An identical request claimed the key first; attach to its job
+            continue
+
+    return RenderJob.objects.create(**job_fields), True
+
+
+def forget_render(job_id):
+    """Drop the cache entry of a job that did not produce an output"""
+    RenderCacheEntry.objects.filter(job_id=job_id).delete()
+
+
+def record_render(job):
+    """Account for a finished job's output and evict old outputs over the limit"""
+    try:
+        size = os.path.getsize(job.params['output_path'])
+    except OSError:
+        forget_render(job.pk)
+        return
+    RenderCacheEntry.objects.filter(job=job).update(output_size=size, last_used_at=timezone.now())
+    evict_renders(settings.RENDER_CACHE_MAX_BYTES, keep=job.pk, max_age=settings.RENDER_OUTPUT_TTL)
+    remove_orphan_outputs(settings.RENDER_OUTPUT_TTL)
+
+
+def touch_render(job):
+    """Mark a job's output as used, e.g. when it is downloaded"""
+    RenderCacheEntry.objects.filter(job=job).update(last_used_at=timezone.now())
+
+
+def evict_renders(max_bytes, keep=None, max_age=None):
+    """
+    Delete the least recently used outputs until the rest fit in max_bytes,
+    and outputs unused for max_age seconds
+    """
+    cutoff = timezone.now() - timedelta(seconds=max_age) if max_age else None
+    entries = (RenderCacheEntry.objects
+               .filter(job__status=RenderJob.STATUS_DONE)
+               .select_related('job')
+               .order_by('-last_used_at'))
+    total = 0
+    for entry in entries:
+        total += entry.output_size
+        expired = cutoff is not None and entry.last_used_at < cutoff
+        if (total <= max_bytes and not expired) or entry.job_id == keep:
+            continue
+        try:
+            os.remove(entry.job.params['output_path'])
+        except OSError:
+            pass
+        entry.delete()
+        total -= entry.output_size
+
+
+def remove_orphan_outputs(max_age):
+    """
+    Delete files in the output directory older than max_age seconds that no
+    cached render or unfinished job owns, e.g. outputs of failed renders
+    """
+    output_dir = os.path.join(settings.MEDIA_ROOT, 'output_videos')
+    if not os.path.isdir(output_dir):
+        return
+    owned = set(RenderCacheEntry.objects.values_list('job__output_filename', flat=True))
+    owned.update(RenderJob.objects
+                 .filter(status__in=[RenderJob.STATUS_QUEUED, RenderJob.STATUS_RUNNING])
+                 .values_list('output_filename', flat=True))
+
+    cutoff = timezone.now().timestamp() - max_age
+    for name in os.listdir(output_dir):
+        path = os.path.join(output_dir, name)
+        try:
+            if name not in owned and os.path.isfile(path) and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
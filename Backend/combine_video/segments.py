@@ -0,0 +1,204 @@
+"""
+Segment-parallel rendering for long videos.
+
+The MoviePy pipeline composites one frame at a time on a single Python
+thread, so one long render leaves most cores idle. The 'segmented' backend
+splits the output timeline into ranges that start on a keyframe interval
+boundary and renders each range's video in its own process. The parts are
+joined with the ffmpeg concat demuxer and stream copied, without
+re-encoding.
+
+Audio is not rendered per segment: separately encoded AAC parts carry
+priming samples and padding that would click at every join. The whole
+soundtrack (video1's audio, or the music mix with its loops) is encoded
+once by the parent while the segments render and muxed over the joined
+video, so it is continuous across segment boundaries. A soundtrack that
+needs no mixing is copied from its source instead (see passthrough.py).
+"""
+import contextlib
+import multiprocessing
+import os
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from moviepy.audio.io.AudioFileClip import AudioFileClip
+from moviepy.config import get_setting
+
+from .asset_pool import music_samples, release
+from .audio import LoopedTrack, write_mix
+from .encoder_profiles import DEFAULT_ENCODER_PROFILE, MP4_MUXER_ARGS, encoder_settings, encoder_threads
+from .metrics import profiling, merge_profile, stage
+from .passthrough import passthrough_audio
+from .prepared import load_music_samples
+from .progress import current_job_id, reporting_progress, set_total_frames
+from .readers import source_timing
+
+
+def frame_count(duration, fps):
+    """Frames write_videofile produces for a clip of `duration` seconds"""
+    return len(np.arange(0, duration, 1.0 / fps))
+
+
+def plan_segments(frames, keyint, workers, min_frames=1):
+    """
+    Split frames [0, frames) into at most `workers` (start, end) ranges.
+
+    Every range but the last is a whole number of keyframe intervals, so
+    each part starts where a single pass would place a keyframe anyway.
+    """
+    intervals = -(-frames // keyint)
+    count = max(1, min(workers, intervals, frames // max(1, min_frames)))
+    step = -(-intervals // count) * keyint
+    starts = list(range(0, frames, step))
+    return [(start, min(start + step, frames)) for start in starts]
+
+
+def segment_workers():
+    """Processes a segmented render may use: the cores of one render worker by default"""
+    return settings.RENDER_SEGMENT_WORKERS or encoder_threads()
+
+
+def render_segment(params, segment, output_path, threads, job_id=None):
+    """
+    Worker entry point: render the video of one segment; returns its profile
+    summary. Frames are reported to job_id's progress as they are encoded.
+    """
+    from .tasks import combine_videos_vertically
+
+    progress = reporting_progress(job_id) if job_id else contextlib.nullcontext()
+    with profiling() as profile, progress:
+        combine_videos_vertically(output_path=output_path, segment=segment, threads=threads, **params)
+    return profile.summary()
+
+
+def write_soundtrack(output_path, video1_path, duration, has_audio, background_music_path=None,
+                     bg_music_volume=0.3, duck_music=False, prepared_dir=None):
+    """
+    Encode the audio of the whole render to an AAC file, as write_videofile
+    would. Returns None when the output has no audio.
+    """
+    if background_music_path and Path(background_music_path).exists():
+        pooled = None
+        try:
+            # Music a batch has already decoded, short music kept by this
+            # worker's asset pool, or decode it as the mix streams
+            samples = load_music_samples(prepared_dir, background_music_path)
+            if samples is None:
+                samples = pooled = music_samples(background_music_path)
+            music = LoopedTrack(
+                background_music_path,
+                samples=samples,
+                duration=duration,
+                max_bytes=settings.LOOP_CACHE_MAX_BYTES,
+            )
+            try:
+                return write_mix(
+                    output_path,
+                    video1_path if has_audio else None,
+                    music,
+                    duration,
+                    music_volume=bg_music_volume,
+                    duck=duck_music,
+                )
+            finally:
+                music.close()
+        except Exception as e:
+            print(f"Error with background music, using original audio: {str(e)}")
+        finally:
+            release(pooled)
+
+    if not has_audio:
+        return None
+    audio = AudioFileClip(video1_path)
+    try:
+        audio.subclip(0, min(audio.duration, duration)).write_audiofile(
+            output_path, fps=44100, nbytes=4, codec='aac', logger=None
+        )
+    finally:
+        audio.close()
+    return output_path
+
+
+def concat_segments(segment_paths, audio_path, output_path, duration):
+    """Join the segment files with the concat demuxer and mux the soundtrack, copying all streams"""
+    list_path = os.path.join(os.path.dirname(segment_paths[0]), 'segments.txt')
+    with open(list_path, 'w') as f:
+        for path in segment_paths:
+            f.write("file '{}'\n".format(path.replace("'", "'\\''")))
+
+    cmd = [get_setting("FFMPEG_BINARY"), '-y', '-v', 'error', '-f', 'concat', '-safe', '0', '-i', list_path]
+    if audio_path:
+        cmd += ['-i', audio_path, '-map', '0:v:0', '-map', '1:a:0']
+    cmd += ['-c', 'copy', '-t', str(duration)] + MP4_MUXER_ARGS + [output_path]
+
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        error = result.stderr.decode('utf-8', errors='replace').strip()
+        raise RuntimeError(f"Could not join segments: {error[-500:]}")
+
+
+def render_segmented(video1_path, output_path, encoder_profile=DEFAULT_ENCODER_PROFILE,
+                     background_music_path=None, bg_music_volume=0.3, duck_music=False,
+                     prepared_dir=None, **params):
+    """
+    Render the layout like combine_videos_vertically, splitting
+    videos longer than RENDER_SEGMENT_MIN_SECONDS across processes.
+    """
+    from .jobs import _init_worker
+    from .tasks import combine_videos_vertically
+
+    audio_params = {
+        'background_music_path': background_music_path,
+        'bg_music_volume': bg_music_volume,
+        'duck_music': duck_music,
+        'prepared_dir': prepared_dir,
+    }
+    # The single pass cuts the output to video1's reader, so plan the frames from it too
+    duration, fps, has_audio = source_timing(video1_path)
+    workers = segment_workers()
+    # Keyframe interval only depends on fps, so any size will do
+    keyint = encoder_settings(encoder_profile, (2, 2), fps)['keyint']
+    segments = plan_segments(
+        frame_count(duration, fps), keyint, workers,
+        min_frames=int(settings.RENDER_SEGMENT_MIN_SECONDS * fps)
+    )
+    if len(segments) == 1:
+        return combine_videos_vertically(
+            video1_path=video1_path, output_path=output_path, encoder_profile=encoder_profile,
+            **audio_params, **params
+        )
+
+    params = dict(params, video1_path=video1_path, encoder_profile=encoder_profile, prepared_dir=prepared_dir)
+    threads = max(1, encoder_threads() // len(segments))
+    set_total_frames(sum(end - start for start, end in segments))
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path))) as tmp:
+        segment_paths = [os.path.join(tmp, f'segment_{index:03d}.mp4') for index in range(len(segments))]
+        executor = ProcessPoolExecutor(
+            max_workers=len(segments),
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+        )
+        try:
+            futures = [
+                executor.submit(render_segment, params, segment, path, threads, current_job_id())
+                for segment, path in zip(segments, segment_paths)
+            ]
+            # The soundtrack is copied, or encoded here while the segments render
+            audio_path = passthrough_audio(video1_path, background_music_path)
+            if audio_path is None:
+                with stage('audio_mix'):
+                    audio_path = write_soundtrack(
+                        os.path.join(tmp, 'audio.m4a'), video1_path, duration, has_audio, **audio_params
+                    )
+            for future in futures:
+                merge_profile(future.result())
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+        with stage('concat'):
+            concat_segments(segment_paths, audio_path, output_path, duration)
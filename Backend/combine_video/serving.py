@@ -0,0 +1,115 @@
+"""
+Sending rendered videos to clients.
+
+With OUTPUT_SERVE_MODE 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache,
+lighttpd) Django only checks the request and the web server sends the
+file, Range requests included. In the default 'django' mode the file is
+returned as a FileResponse that honours a single byte range, so players can
+seek without downloading the whole MP4. Open-ended ranges ('bytes=N-',
+what browsers send while seeking) hand the open file to the WSGI server,
+which can use sendfile for them like for whole files.
+"""
+import os
+import re
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import FileResponse, HttpResponse
+from django.utils.http import content_disposition_header, http_date
+
+OUTPUT_SERVE_MODES = ('django', 'x-accel-redirect', 'x-sendfile')
+
+_range_re = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class FileRange:
+    """Reads of an open file limited to `length` bytes from its current position"""
+
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def parse_range(header, size):
+    """
+    (start, end) inclusive of a single 'bytes=' range, None to send the
+    whole file, or 'unsatisfiable'. Multipart ranges are answered in full.
+    """
+    match = _range_re.match(header.strip()) if header else None
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first == '':
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            return 'unsatisfiable'
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        return 'unsatisfiable'
+    return start, end
+
+
+def file_response(request, path, content_type, filename=None, as_attachment=False):
+    """Serve `path` in the configured OUTPUT_SERVE_MODE"""
+    mode = settings.OUTPUT_SERVE_MODE
+    if mode not in OUTPUT_SERVE_MODES:
+        raise ImproperlyConfigured(f"OUTPUT_SERVE_MODE must be one of {', '.join(OUTPUT_SERVE_MODES)}")
+    if mode == 'x-accel-redirect':
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = settings.OUTPUT_ACCEL_PREFIX + os.path.basename(path)
+    elif mode == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = os.path.abspath(path)
+    else:
+        response = ranged_file_response(request, path, content_type)
+
+    if as_attachment or filename:
+        response['Content-Disposition'] = content_disposition_header(
+            as_attachment, filename or os.path.basename(path)
+        )
+    return response
+
+
+def ranged_file_response(request, path, content_type):
+    """A FileResponse for the whole file or the single byte range requested"""
+    stat = os.stat(path)
+    size = stat.st_size
+    byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+    if request.META.get('HTTP_IF_RANGE') and request.META['HTTP_IF_RANGE'] != http_date(stat.st_mtime):
+        # The client's partial copy is of an older file
+        byte_range = None
+
+    if byte_range == 'unsatisfiable':
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    file = open(path, 'rb')
+    if byte_range is None:
+        response = FileResponse(file, content_type=content_type)
+    else:
+        start, end = byte_range
+        file.seek(start)
+        if end == size - 1:
+            response = FileResponse(file, content_type=content_type, status=206)
+        else:
+            response = FileResponse(FileRange(file, end - start + 1), content_type=content_type, status=206)
+        response['Content-Length'] = str(end - start + 1)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+
+    response['Accept-Ranges'] = 'bytes'
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    return response
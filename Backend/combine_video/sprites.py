@@ -0,0 +1,138 @@
+"""
+Cache of pre-rendered text sprites.
+
+TextClip shells out to ImageMagick for every clip it creates, which costs
+hundreds of milliseconds, yet the watermark and the text overlay are the
+same on almost every request. Rendered sprites are kept as RGBA uint8
+arrays keyed on a hash of everything ImageMagick sees (text, font, size,
+colour): in an in-memory LRU for the current process and as .npy files in
+SPRITE_CACHE_DIR so other workers and later runs can share them. Every
+request may bring new text, so the files are kept to
+SPRITE_DISK_CACHE_MAX_BYTES, least recently used first out; a hit touches
+the file's mtime, which is what "used" means here (atime is often off).
+
+Opacity is applied to the mask when the clip is built, so one raster
+serves every opacity.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+from moviepy.editor import TextClip, ImageClip
+
+_memory_cache = OrderedDict()
+_memory_lock = threading.Lock()
+
+
+def sprite_key(text, font, fontsize, color):
+    """Content address of a rendered text sprite"""
+    payload = json.dumps(['text', text, font, fontsize, color])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _disk_path(key):
+    return os.path.join(settings.SPRITE_CACHE_DIR, key[:2], f"{key}.npy")
+
+
+def _render_text(text, font, fontsize, color):
+    """Rasterize `text` with ImageMagick into an RGBA uint8 array"""
+    clip = TextClip(text, fontsize=fontsize, color=color, font=font)
+    try:
+        rgb = clip.get_frame(0)
+        # ImageClip stores the PNG alpha as alpha / 255, so this is lossless
+        alpha = np.round(clip.mask.get_frame(0) * 255)
+    finally:
+        clip.close()
+    return np.dstack([rgb, alpha]).astype('uint8')
+
+
+def _load_from_disk(path):
+    try:
+        rgba = np.load(path, allow_pickle=False)
+        os.utime(path)
+        return rgba
+    except (OSError, ValueError):
+        return None
+
+
+def prune_disk_cache(max_bytes, keep=None):
+    """Remove the least recently used sprite files until they fit in max_bytes, never `keep`"""
+    files = []
+    for root, _, names in os.walk(settings.SPRITE_CACHE_DIR):
+        for name in names:
+            if not name.endswith('.npy'):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def _save_to_disk(path, rgba):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, rgba, allow_pickle=False)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Error writing sprite cache: {str(e)}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def get_text_sprite(text, font, fontsize, color):
+    """Return the RGBA rendering of `text`, rendering it only on a cache miss"""
+    key = sprite_key(text, font, fontsize, color)
+
+    with _memory_lock:
+        rgba = _memory_cache.get(key)
+        if rgba is not None:
+            _memory_cache.move_to_end(key)
+            return rgba
+
+    path = _disk_path(key)
+    rgba = _load_from_disk(path)
+    if rgba is None:
+        rgba = _render_text(text, font, fontsize, color)
+        _save_to_disk(path, rgba)
+        prune_disk_cache(settings.SPRITE_DISK_CACHE_MAX_BYTES, keep=path)
+
+    # Shared between requests, so nobody may draw on it
+    rgba.setflags(write=False)
+
+    with _memory_lock:
+        _memory_cache[key] = rgba
+        _memory_cache.move_to_end(key)
+        while len(_memory_cache) > settings.SPRITE_CACHE_MAX_ITEMS:
+            _memory_cache.popitem(last=False)
+
+    return rgba
+
+
+def text_sprite_clip(text, fontsize=40, color='white', font='Arial-Bold', opacity=1.0):
+    """Cached equivalent of TextClip(...).set_opacity(opacity)"""
+    clip = ImageClip(get_text_sprite(text, font, fontsize, color))
+    return clip.set_opacity(opacity)
+
@@ -0,0 +1,141 @@
+"""
+Streaming frames through fixed buffers.
+
+write_videofile hands every frame to its writer through iter_frames and
+ffmpeg_writer, and the readers allocate a new array for every frame they
+read from their ffmpeg pipe. The render loop here does neither: readers
+decode into a small ring of preallocated frames (FramePool), the compositor
+draws into its single output buffer, and write_frames passes that buffer to
+the encoder's stdin as it is. Memory for frames is therefore fixed by the
+output and region sizes, whatever the duration.
+"""
+import subprocess
+import threading
+
+import numpy as np
+from moviepy.config import get_setting
+
+from .encoder_profiles import ffmpeg_output_args
+
+
+class FramePool:
+    """
+    A ring of preallocated frames. A frame handed out by next() is
+    overwritten `size` calls later, so a reader with a pool of two can
+    keep returning its last frame while it reads the next one.
+    """
+
+    def __init__(self, shape, size=2, dtype='uint8'):
+        self.frames = [np.empty(shape, dtype=dtype) for _ in range(size)]
+        self.index = 0
+
+    def next(self):
+        frame = self.frames[self.index]
+        self.index = (self.index + 1) % len(self.frames)
+        return frame
+
+    def unget(self):
+        """Hand out the frame of the last next() call again on the following one"""
+        self.index = (self.index - 1) % len(self.frames)
+
+
+def read_into(stream, frame):
+    """Fill `frame` from a binary stream; returns the bytes read, fewer only at the end"""
+    view = memoryview(frame).cast('B')
+    filled = 0
+    while filled < len(view):
+        count = stream.readinto(view[filled:])
+        if not count:
+            break
+        filled += count
+    return filled
+
+
+class EncoderPipe:
+    """
+    An ffmpeg process reading raw media on stdin. Its stderr is drained on
+    a thread so a chatty encoder never blocks the writer; the last of it is
+    the error message if the process fails.
+    """
+
+    def __init__(self, cmd, description):
+        self.description = description
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                     stderr=subprocess.PIPE)
+        self.stderr = []
+        self.drain = threading.Thread(target=self._drain, daemon=True)
+        self.drain.start()
+
+    def _drain(self):
+        for line in self.proc.stderr:
+            self.stderr = (self.stderr + [line])[-20:]
+
+    def write(self, data):
+        try:
+            self.proc.stdin.write(memoryview(np.ascontiguousarray(data)).cast('B'))
+        except BrokenPipeError:
+            # ffmpeg exited early; close() reports why
+            self.close()
+            raise RuntimeError(f"{self.description} failed: the encoder stopped reading")
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = self.proc.wait()
+        self.drain.join()
+        if returncode != 0:
+            error = b''.join(self.stderr).decode('utf-8', errors='replace').strip()
+            raise RuntimeError(f"{self.description} failed: {error[-500:]}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is not None:
+            self.proc.kill()
+            try:
+                self.proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            self.proc.wait()
+            self.drain.join()
+        else:
+            self.close()
+
+
+def encoder_command(output_path, size, fps, encoding, audio_path=None, duration=None):
+    """
+    ffmpeg command encoding rgb24 frames from stdin with the settings
+    write_videofile uses, copying the first audio stream of audio_path.
+    With a duration, the output is cut to it (a copied source's audio may
+    run past the video).
+    """
+    width, height = size
+    cmd = [get_setting("FFMPEG_BINARY"), '-y', '-loglevel', 'error',
+           '-f', 'rawvideo', '-vcodec', 'rawvideo', '-s', f'{width}x{height}', '-pix_fmt', 'rgb24',
+           '-r', '%.02f' % fps, '-an', '-i', '-']
+    if audio_path:
+        cmd += ['-i', audio_path, '-map', '0:v:0', '-map', '1:a:0', '-c:a', 'copy']
+    if duration is not None:
+        cmd += ['-t', str(duration)]
+    cmd += ffmpeg_output_args(encoding)
+    if width % 2 == 0 and height % 2 == 0:
+        cmd += ['-pix_fmt', 'yuv420p']
+    return cmd + [output_path]
+
+
+def write_frames(clip, output_path, fps, encoding, audio_path=None, duration=None):
+    """
+    Encode the frames of `clip` at `fps` straight into ffmpeg's stdin, at
+    the times write_videofile would take them. Frames are written from the
+    clip's own buffers, so nothing is copied on the way to the encoder.
+    """
+    cmd = encoder_command(output_path, clip.size, fps, encoding, audio_path=audio_path, duration=duration)
+    with EncoderPipe(cmd, "Video encoding") as pipe:
+        for t in np.arange(0, clip.duration, 1.0 / fps):
+            frame = clip.get_frame(t)
+            if frame.dtype != np.uint8:
+                frame = frame.astype('uint8')
+            pipe.write(frame)
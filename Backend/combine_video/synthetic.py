@@ -0,0 +1,30 @@
+"""
+Synthetic input media for the benchmark and parity commands.
+
+Clips are generated with ffmpeg's lavfi sources so no sample files need to
+be shipped with the repository.
+"""
+import subprocess
+
+from moviepy.config import get_setting
+
+
+def run_ffmpeg(args):
+    subprocess.run([get_setting("FFMPEG_BINARY"), '-v', 'error', '-y'] + args, check=True)
+
+
+def make_test_clip(path, size, duration, fps=30, with_audio=False, frequency=440):
+    """Encode a moving test pattern, optionally with a sine tone soundtrack"""
+    args = ['-f', 'lavfi', '-i', f'testsrc2=size={size[0]}x{size[1]}:rate={fps}:duration={duration}']
+    if with_audio:
+        args += ['-f', 'lavfi', '-i', f'sine=frequency={frequency}:duration={duration}',
+                 '-c:a', 'aac', '-shortest']
+    args += ['-c:v', 'libx264', '-pix_fmt', 'yuv420p', path]
+    run_ffmpeg(args)
+    return path
+
+
+def make_test_tone(path, duration, frequency=220):
+    """Encode a sine wave as background music"""
+    run_ffmpeg(['-f', 'lavfi', '-i', f'sine=frequency={frequency}:duration={duration}', path])
+    return path
@@ -1,8 +1,21 @@
-from moviepy.editor import VideoFileClip, CompositeVideoClip, TextClip, AudioFileClip, ColorClip, concatenate_videoclips, concatenate_audioclips
-import numpy as np
 from moviepy.config import change_settings
-from pathlib import Path
+import os
 import platform
+import tempfile
+from .compositor import LayerStackClip
+from .sprites import text_sprite_clip
+from .captions import caption_track
+from .ffmpeg_backend import combine_videos_ffmpeg, crop_box
+from .layouts import DEFAULT_LAYOUT, compile_layout, output_size
+from .segments import render_segmented, frame_count, write_soundtrack
+from .looping import LoopedVideoClip
+from .prepared import load_region_frames
+from .asset_pool import open_region_clip, release
+from .passthrough import passthrough_audio
+from .streaming import write_frames
+from .metrics import stage, timed_clip
+from .progress import progress_clip, set_total_frames
+from .encoder_profiles import DEFAULT_ENCODER_PROFILE, encoder_settings, scale_for_profile
 
 # Configure moviepy to use ImageMagick for text
 if platform.system() == "Windows":
@@ -10,12 +23,14 @@ if platform.system() == "Windows":
 else:
     change_settings({"IMAGEMAGICK_BINARY": "/usr/bin/convert"})
 
-def create_watermark(text, size, opacity=0.7, fontsize=30):
+def create_watermark(text, size, opacity=0.7, fontsize=30, layout_overlay=None):
     """Create a semi-transparent watermark"""
-    watermark = (TextClip(text, fontsize=fontsize, color='white', font='Arial-Bold')
-                .set_opacity(opacity)
+    watermark = (text_sprite_clip(text, fontsize=fontsize, color='white', font='Arial-Bold', opacity=opacity)
                 .set_duration(size[2]))
-    watermark = watermark.set_position(lambda t: (40, ((size[1] - watermark.h) // 2)+60))
+    # A fixed position, so the compositor can flatten it into the static plate
+    if layout_overlay is not None and layout_overlay.placed:
+        return watermark.set_position(layout_overlay.position(watermark.size))
+    watermark = watermark.set_position((40, ((size[1] - watermark.h) // 2)+60))
     return watermark
 
 def create_text_overlay(
@@ -26,7 +41,8 @@ def create_text_overlay(
     font_style='Arial-Bold', # Font family/style
     text_color='white',      # Text color
     x_offset=0,             # Additional horizontal offset
-    y_offset=0              # Additional vertical offset
+    y_offset=0,             # Additional vertical offset
+    layout_overlay=None     # Placement from the layout, see layouts.py
 ):
     """
     Create a text overlay with customizable positioning and styling
@@ -49,10 +65,12 @@ def create_text_overlay(
         Additional horizontal offset from calculated position
     y_offset : int
         Additional vertical offset from calculated position
+    layout_overlay : LayoutOverlay
+        Where the layout places the text; replaces `position` if it does
     """
     try:
         # Create text clip with custom styling
-        text_clip = (TextClip(
+        text_clip = (text_sprite_clip(
             text, 
             fontsize=fontsize, 
             color=text_color, 
@@ -60,7 +78,9 @@ def create_text_overlay(
         ).set_duration(size[2]))
         
         # Calculate position
-        if isinstance(position, tuple):
+        if layout_overlay is not None and layout_overlay.placed:
+            x_pos, y_pos = layout_overlay.position(text_clip.size)
+        elif isinstance(position, tuple):
             # Use exact coordinates if position is a tuple
             x_pos, y_pos = position
         else:
@@ -84,7 +104,7 @@ def create_text_overlay(
     except Exception as e:
         print(f"Error creating text overlay: {str(e)}")
         # Return a default text clip if there's an error
-        return (TextClip(
+        return (text_sprite_clip(
             text,
             fontsize=40,
             color='white',
@@ -92,57 +112,79 @@ def create_text_overlay(
         ).set_duration(size[2])
          .set_position(('center', 'top')))
 
-def mix_audio(video1_audio, background_music_path, duration, bg_volume=0.3):
-    """
-    Mix video1's audio with looping background music correctly
-    """
-    try:
-        # Load background music
-        bg_music = AudioFileClip(background_music_path)
-        
-        # If background music is shorter than needed duration, loop it
-        if bg_music.duration < duration:
-            # Calculate how many loops needed
-            repeats = int(np.ceil(duration / bg_music.duration))
-            bg_clips = []
-            
-            for _ in range(repeats):
-                bg_clips.append(bg_music)
-            
-            # Concatenate all clips
-            bg_music = concatenate_audioclips(bg_clips)
-        
-        # Trim to exact duration needed
-        bg_music = bg_music.subclip(0, duration)
-        
-        # Ensure video1 audio is the correct duration
-        video1_audio = video1_audio.subclip(0, duration)
-        
-        # Set volumes
-        bg_music = bg_music.volumex(bg_volume)
-        
-        # Simply return the two audio clips to be composited
-        return [video1_audio, bg_music]
-        
-    except Exception as e:
-        print(f"Error mixing audio: {str(e)}")
-        return [video1_audio]  # Return only original audio if mixing fails
-
-
 def adjust_video2_duration(video2, target_duration):
-    """Adjust video2 duration by either looping or trimming"""
+    """Adjust video2 (or video3) duration by either looping or trimming"""
     if video2.duration < target_duration:
-        repeats = int(np.ceil(target_duration / video2.duration))
-        clips = [video2] * repeats
-        extended_video = concatenate_videoclips(clips)
-        return extended_video.subclip(0, target_duration)
+        return LoopedVideoClip(video2, target_duration)
     else:
         return video2.subclip(0, target_duration)
 
+def place_regions(plan, clips, duration):
+    """
+    Fit the clips of a compiled layout's regions (one per region, in
+    plan.regions order) to their regions and position them there. Sources
+    other than video1 are looped or cut to `duration`. Returns the
+    positioned clips, bottom to top.
+    """
+    placed = []
+    for region, clip in zip(plan.regions, clips):
+        clip = fit_to_region(clip, region.size, region.crop)
+        if region.source != 'video1':
+            clip = adjust_video2_duration(clip, duration)
+        placed.append(clip.set_position(region.position))
+    return placed
+
+def build_overlays(
+    size,
+    watermark="",
+    watermark_opacity=0.7,
+    watermark_fontsize=30,
+    text_overlay="",
+    text_position='top',
+    text_fontsize=40,
+    text_font='Arial-Bold',
+    text_color='white',
+    text_x_offset=0,
+    text_y_offset=0,
+    layout_overlays=None
+):
+    """
+    Watermark and text clips drawn over the video; size is (width, height, duration).
+    layout_overlays (a LayoutPlan's overlays) sets their order and placement.
+    """
+    if layout_overlays is None:
+        layout_overlays = compile_layout(DEFAULT_LAYOUT, size[:2]).overlays
+    overlays = []
+    
+    for layout_overlay in layout_overlays:
+        if layout_overlay.type == 'watermark' and watermark:
+            overlays.append(create_watermark(
+                watermark,
+                size,
+                opacity=watermark_opacity,
+                fontsize=watermark_fontsize,
+                layout_overlay=layout_overlay
+            ))
+        elif layout_overlay.type == 'text' and text_overlay:
+            overlays.append(create_text_overlay(
+                text_overlay,
+                size,
+                position=text_position,
+                fontsize=text_fontsize,
+                font_style=text_font,
+                text_color=text_color,
+                x_offset=text_x_offset,
+                y_offset=text_y_offset,
+                layout_overlay=layout_overlay
+            ))
+    
+    return overlays
+
 def combine_videos_vertically(
        video1_path, 
     video2_path, 
     output_path, 
+    video3_path=None,         # third source, for layouts that show one
     target_resolution=1080, 
     aspect_ratio=(9, 16),
     watermark="",
@@ -156,131 +198,167 @@ def combine_videos_vertically(
     text_y_offset=0,          # New parameter
     background_music_path=None,  # background audio
     bg_music_volume=0.3,      # background audio volume
+    duck_music=False,         # lower the music while video1 is audible
     video1_offset=34,         # New parameter for video1 position offset
-    video2_offset=34          # New parameter for video2 position offset
+    video2_offset=34,         # New parameter for video2 position offset
+    watermark_fontsize=30,
+    encoder_profile=DEFAULT_ENCODER_PROFILE,  # draft, standard or archive
+    prepared_dir=None,        # assets decoded once for a batch, see prepared.py
+    segment=None,             # (first frame, end frame) to render without audio, see segments.py
+    threads=None,             # encoder threads, when several renders share the cores
+    layout=DEFAULT_LAYOUT,    # template name or layout object, see layouts.py
+    captions_path=None,       # SRT or WebVTT cues burned in, see captions.py
+    caption_font='Arial-Bold',
+    caption_fontsize=40,
+    caption_color='white',
+    caption_position='bottom' # 'bottom' or 'top'
 ):
     try:
-        # Load videos
-        video1 = VideoFileClip(video1_path)
-        video2 = VideoFileClip(video2_path)
-        
-        # Calculate dimensions
-        output_height = target_resolution
-        output_width = int(output_height * aspect_ratio[0] / aspect_ratio[1])
-        square_size = output_height // 2
-        
-        # Process videos to squares
-        video1_squared = resize_to_square(video1, square_size)
-        video2_squared = resize_to_square(video2, square_size)
-        
-        # Adjust video2 duration to match video1
-        video2_squared = adjust_video2_duration(video2_squared, video1_squared.duration)
-        
-        # Center position calculation
-        x_position = (output_width - square_size) // 2
-        
-        # Position videos with custom offsets
-        video1_final = video1_squared.set_position((x_position, video1_offset))
-        video2_final = video2_squared.set_position((x_position, square_size - video2_offset))
-        
-        final_duration = video1_squared.duration
-        
-        # Create black background   
-        background = ColorClip(size=(output_width, output_height), color=(0, 0, 0), duration=final_duration)
-        
-        # List of clips to composite
-        clips = [background, video2_final, video1_final]
-        
-        if watermark:
-            watermark_clip = create_watermark(
-                watermark, 
-                (output_width, output_height, final_duration),
-                opacity=watermark_opacity
-            )
-            clips.append(watermark_clip)
+        # A soundtrack that needs no mixing is copied from its source, not re-encoded
+        copy_audio = None
+        if segment is None:
+            copy_audio = passthrough_audio(video1_path, background_music_path)
+
+        # Where each source goes, resolved once before anything is decoded
+        plan = compile_layout(layout, output_size(target_resolution, aspect_ratio),
+                              {'video1_offset': video1_offset, 'video2_offset': video2_offset})
+        paths = {'video1': video1_path, 'video2': video2_path, 'video3': video3_path}
+
+        # Load videos, decoded by ffmpeg straight to their regions in reused
+        # buffers, one reader per region; a batch may have video2 fitted
+        # already, and earlier jobs in this worker may have left the readers
+        # or a looped source's frames in the asset pool. The soundtrack is
+        # written separately, so no audio readers are opened
+        clips = [None] * len(plan.regions)
+        opened = []
+        with stage('load'):
+            # video1 first: the others loop to its duration
+            order = sorted(range(len(plan.regions)), key=lambda i: plan.regions[i].source != 'video1')
+            for i in order:
+                region = plan.regions[i]
+                if region.source == 'video2':
+                    clips[i] = load_region_frames(prepared_dir, video2_path, region.size, region.crop)
+                if clips[i] is None:
+                    loop_duration = None if region.source == 'video1' else clips[order[0]].duration
+                    clips[i] = open_region_clip(paths[region.source], region.size, region.crop,
+                                                loop_duration=loop_duration)
+                    opened.append(clips[i])
+        video1 = clips[order[0]]
+        final_duration = video1.duration
+
+        # Fit and position each source in its region, bottom to top
+        layers = place_regions(plan, [timed_clip(clip, 'decode') for clip in clips], final_duration)
+        layers = [timed_clip(clip, 'crop_resize') for clip in layers]
         
-        if text_overlay:
-            text_clip = create_text_overlay(
-                text_overlay,
-                (output_width, output_height, final_duration),
-                position=text_position,
-                fontsize=text_fontsize,
-                font_style=text_font,
+        # Static layers drawn over the video
+        with stage('text'):
+            overlays = build_overlays(
+                (plan.size[0], plan.size[1], final_duration),
+                watermark=watermark,
+                watermark_opacity=watermark_opacity,
+                watermark_fontsize=watermark_fontsize,
+                text_overlay=text_overlay,
+                text_position=text_position,
+                text_fontsize=text_fontsize,
+                text_font=text_font,
                 text_color=text_color,
-                x_offset=text_x_offset,
-                y_offset=text_y_offset
+                text_x_offset=text_x_offset,
+                text_y_offset=text_y_offset,
+                layout_overlays=plan.overlays
+            )
+            captions = caption_track(
+                captions_path,
+                plan.size,
+                font=caption_font,
+                fontsize=caption_fontsize,
+                color=caption_color,
+                position=caption_position
             )
-            clips.append(text_clip)
 
+        # Composite on a black background in a single pass per frame
+        with stage('composite'):
+            final_video = LayerStackClip(
+                layers,
+                overlays,
+                size=plan.size,
+                duration=final_duration,
+                captions=captions
+            )
+        final_video = progress_clip(timed_clip(final_video, 'composite', count_frames=True))
         
-        # Create final composite for video
-        final_video = CompositeVideoClip(clips, size=(output_width, output_height))
-        
-        # Handle audio mixing
-        if background_music_path and Path(background_music_path).exists():
-            try:
-                # Get mixed audio clips
-                audio_clips = mix_audio(
-                    video1_squared.audio,
-                    background_music_path,
-                    final_duration,
-                    bg_music_volume
-                )
-                
-                # Create dummy video clips with the audio
-                audio_video_clips = [
-                    ColorClip(size=(1,1), color=(0,0,0), duration=final_duration)
-                    .set_audio(audio_clip)
-                    for audio_clip in audio_clips
-                ]
-                
-                # Composite the audio
-                final_audio = CompositeVideoClip(audio_video_clips).audio
-                final_video = final_video.set_audio(final_audio)
-                
-            except Exception as e:
-                print(f"Error with background music, using original audio: {str(e)}")
-                final_video = final_video.set_audio(video1_squared.audio)
-        else:
-            final_video = final_video.set_audio(video1_squared.audio)
-        
+        if segment is not None:
+            # Video only; segments.py muxes one soundtrack over the joined parts.
+            # Ends half a frame early so no extra frame is written
+            start, end = segment
+            final_video = final_video.subclip(start / video1.fps, (end - 0.5) / video1.fps)
+
+        # Segments add to the total their parent set
+        if segment is None:
+            set_total_frames(frame_count(final_duration, video1.fps))
+
         # Export with optimized settings
-        final_video.write_videofile(
-            output_path,
-            codec="libx264",
-            audio_codec="aac",
-            preset="faster",
-            threads=4,
-            bitrate="8000k",
-            fps=video1.fps
-        )
+        encoding = encoder_settings(encoder_profile, final_video.size, video1.fps, threads=threads)
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path))) as tmp:
+            # The soundtrack is copied from its source, or streamed to a file
+            # first, then muxed as the frames are encoded
+            audio_path = copy_audio
+            if segment is None and not copy_audio:
+                with stage('audio_mix'):
+                    audio_path = write_soundtrack(
+                        os.path.join(tmp, 'audio.m4a'),
+                        video1_path,
+                        final_duration,
+                        video1.reader.infos['audio_found'],
+                        background_music_path=background_music_path,
+                        bg_music_volume=bg_music_volume,
+                        duck_music=duck_music,
+                        prepared_dir=prepared_dir
+                    )
+            with stage('encode'):
+                write_frames(
+                    final_video,
+                    output_path,
+                    video1.fps,
+                    encoding,
+                    audio_path=audio_path,
+                    duration=final_duration if copy_audio else None
+                )
         
     except Exception as e:
         print(f"Error processing videos: {str(e)}")
         raise
         
     finally:
-        # Clean up
+        # Clean up; pooled sources are rewound for the next job
         try:
-            video1.close()
-            video2.close()
+            for clip in opened:
+                release(clip)
             final_video.close()
         except:
             pass
 
-def resize_to_square(video, square_size):
-    """Resize a video to a square while maintaining aspect ratio."""
-    width, height = video.size
-    if width > height:
-        # Crop width
-        crop_width = (width - height) // 2
-        video = video.crop(x1=crop_width, x2=width - crop_width)
-    else:
-        # Crop height
-        crop_height = (height - width) // 2
-        video = video.crop(y1=crop_height, y2=height - crop_height)
+RENDER_BACKENDS = {
+    'moviepy': combine_videos_vertically,
+    'ffmpeg': combine_videos_ffmpeg,
+    'segmented': render_segmented,
+}
+
+def render_video(render_backend='moviepy', encoder_profile=DEFAULT_ENCODER_PROFILE, **params):
+    """Render the requested layout with the chosen backend and encoder profile"""
+    if render_backend not in RENDER_BACKENDS:
+        raise ValueError(f"Unknown render backend: {render_backend}")
+    params = scale_for_profile(params, encoder_profile)
+    return RENDER_BACKENDS[render_backend](encoder_profile=encoder_profile, **params)
+
+def fit_to_region(video, size, crop=None):
+    """Crop a video to what a region of `size` shows (ffmpeg_backend.crop_box) and scale it to fill it"""
+    if tuple(video.size) == tuple(size):
+        # Already fitted, crop included, e.g. by RegionVideoFileClip or prepared for a batch
+        return video
+    x, y, width, height = crop_box(video.size, size, crop)
+    if (x, y, width, height) != (0, 0) + tuple(video.size):
+        video = video.crop(x1=x, y1=y, x2=x + width, y2=y + height)
     
-    # Resize to square
-    video = video.resize((square_size, square_size))
+    # Resize to the region
+    video = video.resize(tuple(size))
     return video
-
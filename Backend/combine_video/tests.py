@@ -1,3 +1,1677 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import Future
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import StopFutureHandlers
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from moviepy.config import get_setting
+from moviepy.editor import AudioClip, CompositeVideoClip, ImageClip, VideoClip, VideoFileClip
+from PIL import Image
+from rest_framework.test import APIClient
+
+from . import asset_pool, jobs, sprites
+from .asset_pool import AssetPool, get_pool, music_samples, open_region_clip, release
+from .audio import (AUDIO_FPS, DUCK_GAIN, LIMITER_CEILING, LoopedTrack, decode_pcm, mix_tracks,
+                    mixed_chunks)
+from .captions import Cue, CueIndex, InvalidCaptions, parse_captions, parse_timestamp
+from .chunked_uploads import finalize_session, part_path
+from .compositor import LayerStackClip, is_static
+from .ffmpeg_backend import build_filtergraph, crop_box, escape_filter_value, probe_video
+from .layouts import TEMPLATES, InvalidLayout, check_layout, compile_layout, output_size
+from .looping import LoopedVideoClip, loop_audio
+from .management.commands import benchmark_pipeline
+from .management.commands.benchmark_pipeline import BENCHMARK_SUITES, find_regressions
+from .management.commands.check_render_parity import PARITY_CASES, case_params, measure_psnr
+from .memory import estimate_render_memory, memory_limit
+from .metrics import profiling, record_job_metrics, stage, timed_clip
+from .models import MediaProbe, RenderBatch, RenderCacheEntry, RenderJob, UploadSession
+from .passthrough import passthrough_audio
+from .prepared import PreparedVideoClip
+from .probe import InvalidMedia, get_probe, parse_stream_report, probe_inputs, probe_media
+from .progress import job_progress, progress_clip, reporting_progress, set_total_frames
+from .readers import RegionVideoFileClip, source_timing
+from .render_cache import evict_renders, get_or_create_render_job
+from .segments import frame_count, plan_segments
+from .serving import parse_range
+from .synthetic import make_test_clip, make_test_tone, run_ffmpeg
+from .tasks import fit_to_region, render_video
+from .upload_handlers import ContentAddressedUploadHandler, input_dir, remove_unless_held
+
+SIZE = (64, 48)
+
+
+def overlay(seed, size, position):
+    """A static overlay with a random picture and a random soft mask"""
+    rng = np.random.default_rng(seed)
+    w, h = size
+    mask = ImageClip(rng.random((h, w)), ismask=True)
+    return ImageClip(rng.integers(0, 256, (h, w, 3), dtype='uint8')).set_mask(mask).set_position(position)
+
+
+class StaticPlateTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        w, h = SIZE
+        self.background = ImageClip(rng.integers(0, 256, (h, w, 3), dtype='uint8')).set_duration(1)
+
+    def composite(self, overlays):
+        overlays = [clip.set_duration(1) for clip in overlays]
+        stacked = LayerStackClip([self.background], overlays, size=SIZE, duration=1).get_frame(0)
+        reference = CompositeVideoClip([self.background] + overlays, size=SIZE).get_frame(0)
+        return stacked.astype(int), reference.astype(int)
+
+    def test_separate_overlays_match_exactly(self):
+        stacked, reference = self.composite([
+            overlay(1, (20, 10), (2, 3)),
+            overlay(2, (30, 12), (30, 30)),
+            overlay(3, (10, 40), (-5, 20)),
+        ])
+        np.testing.assert_array_equal(stacked, reference)
+
+    def test_overlapping_overlays_within_a_level_per_layer_below(self):
+        placed = [((40, 30), (0, 0)), ((40, 30), (20, 15)), ((40, 30), (10, 8))]
+        stacked, reference = self.composite([overlay(seed, *args) for seed, args in enumerate(placed, 1)])
+        w, h = SIZE
+        layers = np.zeros((h, w, 1), dtype=int)
+        for (ow, oh), (x, y) in placed:
+            layers[y:y + oh, x:x + ow] += 1
+        self.assertTrue((np.abs(stacked - reference) <= np.maximum(layers - 1, 0)).all())
+        self.assertTrue((stacked[(layers <= 1)[..., 0]] == reference[(layers <= 1)[..., 0]]).all())
+
+
+def moving_layer(seed, size, position, duration=1):
+    """An opaque video layer whose picture changes every frame"""
+    w, h = size
+
+    def make_frame(t):
+        return np.random.default_rng([seed, int(round(t * 100))]).integers(0, 256, (h, w, 3), dtype='uint8')
+    return VideoClip(make_frame, duration=duration).set_position(position)
+
+
+class LayerStackClipTests(SimpleTestCase):
+    """LayerStackClip composites frames as CompositeVideoClip does"""
+
+    TIMES = (0, 0.25, 0.6, 0.9)
+
+    def assert_matches_composite(self, layers, overlays=()):
+        stacked = LayerStackClip(layers, overlays, size=SIZE, duration=1)
+        reference = CompositeVideoClip(list(layers) + list(overlays), size=SIZE).set_duration(1)
+        for t in self.TIMES:
+            with self.subTest(t=t):
+                np.testing.assert_array_equal(stacked.get_frame(t), reference.get_frame(t))
+
+    def test_layers_and_static_overlays(self):
+        self.assert_matches_composite(
+            [moving_layer(1, (40, 30), (0, 0)), moving_layer(2, (30, 30), (30, 20))],
+            [overlay(3, (20, 10), (5, 5)).set_duration(1)],
+        )
+
+    def test_layer_ending_early_leaves_the_background(self):
+        self.assert_matches_composite(
+            [moving_layer(1, (64, 20), (0, 0), duration=0.5), moving_layer(2, (20, 20), ('center', 'bottom'))],
+        )
+
+    def test_moving_overlay_is_drawn_every_frame(self):
+        moving = overlay(3, (10, 10), lambda t: (int(t * 40), 5)).set_duration(1)
+        self.assertFalse(is_static(moving, 1))
+        self.assert_matches_composite(
+            [moving_layer(1, (64, 48), (0, 0))],
+            [overlay(4, (20, 10), (5, 30)).set_duration(1), moving],
+        )
+
+    def test_frames_reuse_one_buffer(self):
+        stacked = LayerStackClip([moving_layer(1, (64, 48), (0, 0))], size=SIZE, duration=1)
+        first = stacked.get_frame(0)
+        self.assertIs(stacked.get_frame(0.5), first)
+
+
+class RenderParityTests(SimpleTestCase):
+    """The moviepy and ffmpeg backends render the same synthetic inputs alike"""
+
+    MIN_PSNR = 35.0
+    MAX_DURATION_DELTA = 0.1
+
+    def test_backends_agree(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            music_path = make_test_tone(os.path.join(tmp, 'music.mp3'), 1.5)
+            for case in PARITY_CASES:
+                name = case[0]
+                with self.subTest(name):
+                    params = case_params(tmp, case, music_path, resolution=240)
+                    outputs = {}
+                    for backend in ('moviepy', 'ffmpeg'):
+                        outputs[backend] = os.path.join(tmp, f'{name}-{backend}.mp4')
+                        render_video(render_backend=backend, output_path=outputs[backend], **params)
+
+                    self.assertGreaterEqual(measure_psnr(outputs['moviepy'], outputs['ffmpeg']), self.MIN_PSNR)
+                    _, reference_duration, _, _ = probe_video(outputs['moviepy'])
+                    _, candidate_duration, _, _ = probe_video(outputs['ffmpeg'])
+                    self.assertLessEqual(abs(reference_duration - candidate_duration), self.MAX_DURATION_DELTA)
+
+
+class FilterGraphTests(SimpleTestCase):
+    """The ffmpeg backend's filter_complex pieces (the rendered output is compared in RenderParityTests)"""
+
+    SIZES = {'video1': (1280, 720), 'video2': (720, 1280)}
+
+    def graph(self, **options):
+        plan = compile_layout('vertical-stack', output_size(240, (9, 16)), {'video1_offset': 0, 'video2_offset': 0})
+        graph, has_audio = build_filtergraph(self.SIZES, plan, 2.0, 30, **options)
+        return graph.split(';'), has_audio
+
+    def test_escape_filter_value(self):
+        self.assertEqual(escape_filter_value("it's a:b [x],y"), r"it\\\'s a\\:b \[x\]\,y")
+        self.assertEqual(escape_filter_value(12), '12')
+
+    def test_crop_box(self):
+        # Centre-cropped to the region's aspect ratio, after any crop fractions
+        self.assertEqual(crop_box((1280, 720), (540, 540)), (280, 0, 720, 720))
+        self.assertEqual(crop_box((720, 1280), (540, 540)), (0, 280, 720, 720))
+        self.assertEqual(crop_box((1280, 720), (540, 540), (0, 0, 0.5, 1)), (0, 40, 640, 640))
+
+    def test_regions(self):
+        graph, _ = self.graph(has_video1_audio=False)
+        regions = [line for line in graph if line.endswith(']') and 'crop=' in line]
+        self.assertEqual(len(regions), 2)
+        # Only the looped sources are cut to video1's duration
+        [video1] = [line for line in regions if line.startswith('[0:v]')]
+        [video2] = [line for line in regions if line.startswith('[1:v]')]
+        self.assertNotIn('trim=', video1)
+        self.assertIn('trim=duration=2.0', video2)
+        # 135x240 cannot be 4:2:0
+        self.assertTrue(graph[-1].endswith('format=yuv444p[vout]'))
+
+    def test_audio(self):
+        graph, has_audio = self.graph(has_video1_audio=False, has_music=False)
+        self.assertFalse(has_audio)
+        self.assertFalse(any('[aout]' in line for line in graph))
+
+        graph, has_audio = self.graph(has_video1_audio=True)
+        self.assertTrue(has_audio)
+        self.assertEqual(graph[-1], '[0:a]atrim=0:2.0,asetpts=PTS-STARTPTS[aout]')
+
+        graph, _ = self.graph(has_video1_audio=True, has_music=True, bg_music_volume=0.5)
+        self.assertIn('volume=0.5', graph[-2])
+        self.assertIn('amix=inputs=2', graph[-1])
+        self.assertIn(f'alimiter=limit={LIMITER_CEILING:.6f}', graph[-1])
+
+        graph, _ = self.graph(has_video1_audio=False, has_music=True)
+        self.assertIn(f'alimiter=limit={LIMITER_CEILING:.6f}', graph[-1])
+
+
+class BenchmarkCommandTests(SimpleTestCase):
+    """benchmark_pipeline reports each case as JSON and fails on regressions against a baseline"""
+
+    TINY_SUITE = [('tiny', (160, 90), 1, (90, 160), 1, {'target_resolution': 160, 'background_music': True})]
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        suite = mock.patch.dict(BENCHMARK_SUITES, {'quick': self.TINY_SUITE})
+        suite.start()
+        self.addCleanup(suite.stop)
+
+    def benchmark(self, ceiling=2 ** 40, **options):
+        with mock.patch.object(benchmark_pipeline, 'estimate_render_memory', return_value=ceiling):
+            call_command('benchmark_pipeline', repeat=1, stdout=io.StringIO(), stderr=io.StringIO(), **options)
+
+    def write_report(self, name, report):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w') as f:
+            json.dump(report, f)
+        return path
+
+    def test_report_and_baseline(self):
+        output = os.path.join(self.tmp, 'report.json')
+        self.benchmark(output=output)
+        with open(output) as f:
+            report = json.load(f)
+
+        self.assertEqual((report['suite'], report['backend']), ('quick', 'moviepy'))
+        self.assertEqual(set(report['environment']), set(benchmark_pipeline.environment()))
+        [case] = report['cases']
+        self.assertEqual(case['name'], 'tiny')
+        # Every frame encoded counted once
+        video1 = make_test_clip(os.path.join(self.tmp, 'video1.mp4'), (160, 90), 1, with_audio=True)
+        self.assertEqual(case['frames'], frame_count(*source_timing(video1)[:2]))
+        self.assertEqual(case['output_size'], [90, 160])
+        self.assertGreater(case['fps'], 0)
+        self.assertGreater(case['output_bytes'], 0)
+        self.assertIn('composite', case['stages'])
+
+        # A baseline ten times faster is a regression, a ten times slower one is not
+        faster = dict(report, cases=[dict(case, fps=case['fps'] * 10)])
+        with self.assertRaisesRegex(CommandError, 'regression'):
+            self.benchmark(baseline=self.write_report('faster.json', faster))
+        slower = dict(report, cases=[dict(case, fps=case['fps'] / 10)])
+        self.benchmark(baseline=self.write_report('slower.json', slower), threshold=0.5)
+
+    def test_case_over_its_memory_ceiling_fails(self):
+        with self.assertRaisesRegex(CommandError, 'memory ceiling'):
+            self.benchmark(ceiling=1)
+
+    def test_find_regressions(self):
+        baseline = {'cases': [{'name': 'a', 'fps': 100.0, 'peak_rss_bytes': 1000}]}
+
+        def regressions(threshold=0.1, **metrics):
+            return find_regressions({'cases': [dict({'name': 'a'}, **metrics)]}, baseline, threshold)
+
+        self.assertEqual(regressions(fps=95.0, peak_rss_bytes=1050), [])
+        self.assertEqual(regressions(fps=150.0, peak_rss_bytes=500), [])
+        self.assertEqual(regressions(fps=80.0, peak_rss_bytes=1000), ['a: fps 100.0 -> 80.0 (-20.0%)'])
+        self.assertEqual(regressions(fps=100.0, peak_rss_bytes=1200), ['a: peak_rss_bytes 1000 -> 1200 (+20.0%)'])
+        self.assertEqual(regressions(threshold=0.25, fps=80.0, peak_rss_bytes=1200), [])
+        # Cases the baseline did not run are not compared
+        self.assertEqual(find_regressions({'cases': [{'name': 'b', 'fps': 1.0}]}, baseline, 0.1), [])
+
+
+class StreamingMemoryTests(SimpleTestCase):
+    """A long render streams: its peak stays inside the ceiling estimated for it"""
+
+    def test_long_render_stays_under_estimate(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            params = {
+                'video1_path': make_test_clip(os.path.join(tmp, 'long-1.mp4'), (640, 360), 60, with_audio=True),
+                'video2_path': make_test_clip(os.path.join(tmp, 'long-2.mp4'), (360, 640), 4),
+                'background_music_path': make_test_tone(os.path.join(tmp, 'music.mp3'), 10),
+                'target_resolution': 240,
+                'aspect_ratio': (9, 16),
+                'watermark': '',
+                'text_overlay': '',
+            }
+            infos = {name: probe_media(params[f'{name}_path']) for name in ('video1', 'video2', 'background_music')}
+
+            for backend in ('moviepy', 'ffmpeg'):
+                with self.subTest(backend):
+                    ceiling = estimate_render_memory(dict(params, render_backend=backend), infos)
+                    get_pool().clear()
+                    with memory_limit(ceiling) as watch:
+                        render_video(render_backend=backend, output_path=os.path.join(tmp, f'{backend}.mp4'), **params)
+                    self.assertGreater(watch.peak, 0)
+                    self.assertLessEqual(watch.peak, ceiling)
+
+
+def stack_layout(**region):
+    """A one-region layout showing video1, with `region` overriding its geometry"""
+    return {'regions': [dict({'source': 'video1', 'x': 0, 'y': 0, 'width': 'W', 'height': 'H'}, **region)]}
+
+
+class LayoutTests(SimpleTestCase):
+    SIZE = output_size(1080, (9, 16))
+
+    def test_expressions_allow_only_arithmetic_on_known_names(self):
+        for expression in ("W.real", "H.__class__", "__import__('os')", "open('/etc/passwd')",
+                           "abs(W)", "min(W)", "max(W, H, key=1)", "(lambda: 1)()", "[W][0]",
+                           "'W'", "True", "W if H else 0", "W ** 2", "video4_offset", "w"):
+            with self.subTest(expression), self.assertRaises(InvalidLayout):
+                compile_layout(stack_layout(width=expression), self.SIZE)
+
+    def test_expressions_evaluate(self):
+        plan = compile_layout({
+            'vars': {'a': 'max(W, H) // 4', 'b': '-a + 3 * a % 7'},
+            'regions': [{'source': 'video1', 'x': 'b', 'y': 'min(10, video1_offset)', 'width': 'a', 'height': 'a / 2'}],
+        }, self.SIZE, {'video1_offset': 5})
+        region = plan.regions[0]
+        self.assertEqual((region.x, region.y, region.width, region.height), (-270 + 810 % 7, 5, 270, 135))
+
+    def test_invalid_layouts(self):
+        cases = {
+            'unknown template': 'four-up',
+            'unknown key': dict(stack_layout(), background='red'),
+            'no regions': {'regions': []},
+            'no video1': {'regions': [{'source': 'video2', 'x': 0, 'y': 0, 'width': 'W', 'height': 'H'}]},
+            'unknown source': {'regions': [{'source': 'video4', 'x': 0, 'y': 0, 'width': 'W', 'height': 'H'}]},
+            'missing height': {'regions': [{'source': 'video1', 'x': 0, 'y': 0, 'width': 'W'}]},
+            'too small': stack_layout(width=1),
+            'outside the frame': stack_layout(x='W'),
+            'division by zero': stack_layout(width='W // (H - H)'),
+            'too large': dict(stack_layout(), vars={'a': 'W * W * W'}),
+            'var shadows W': dict(stack_layout(), vars={'W': 1}),
+            'bad crop': stack_layout(crop=[0.5, 0, 0.6, 1]),
+            'non-integer z': stack_layout(z=1.5),
+            'overlay twice': dict(stack_layout(), overlays=[{'type': 'text'}, {'type': 'text'}]),
+            'overlay x alone': dict(stack_layout(), overlays=[{'type': 'text', 'x': 0}]),
+        }
+        for name, layout in cases.items():
+            with self.subTest(name), self.assertRaises(InvalidLayout):
+                compile_layout(layout, self.SIZE)
+
+    def test_check_layout_needs_every_source_shown(self):
+        params = {'layout': 'three-up', 'video1_path': 'a.mp4', 'video2_path': 'b.mp4'}
+        with self.assertRaisesMessage(InvalidLayout, "video3, which was not given"):
+            check_layout(params)
+        self.assertEqual(check_layout(dict(params, video3_path='c.mp4')).sources, ['video1', 'video2', 'video3'])
+
+    def test_template_geometry(self):
+        # 1080p at 9:16 is 607x1080
+        expected = {
+            'vertical-stack': [('video2', 33, 510, 540, 540), ('video1', 33, 30, 540, 540)],
+            'side-by-side': [('video1', 0, 0, 303, 1080), ('video2', 303, 0, 304, 1080)],
+            'picture-in-picture': [('video1', 0, 0, 607, 1080), ('video2', 380, 25, 202, 360)],
+            'three-up': [('video1', 0, 0, 607, 360), ('video2', 0, 360, 607, 360), ('video3', 0, 720, 607, 360)],
+        }
+        self.assertEqual(set(expected), set(TEMPLATES))
+        for name, regions in expected.items():
+            with self.subTest(name):
+                plan = compile_layout(name, self.SIZE, {'video1_offset': 30, 'video2_offset': 30})
+                self.assertEqual(plan.size, (607, 1080))
+                self.assertEqual(
+                    [(r.source, r.x, r.y, r.width, r.height) for r in plan.regions], regions
+                )
+                self.assertEqual([overlay.type for overlay in plan.overlays], ['watermark', 'text'])
+                self.assertEqual(plan.overlays[0].position((100, 40)), (40, (1080 - 40) // 2 + 60))
+
+
+class ParseRangeTests(SimpleTestCase):
+    def test_ranges(self):
+        cases = [
+            ('bytes=0-99', 1000, (0, 99)),
+            ('bytes=500-', 1000, (500, 999)),
+            ('bytes=900-5000', 1000, (900, 999)),
+            ('bytes=999-999', 1000, (999, 999)),
+            # Suffix ranges: the last N bytes, the whole file when N is larger
+            ('bytes=-100', 1000, (900, 999)),
+            ('bytes=-5000', 1000, (0, 999)),
+            ('bytes=-0', 1000, 'unsatisfiable'),
+            ('bytes=-10', 0, 'unsatisfiable'),
+            ('bytes=1000-', 1000, 'unsatisfiable'),
+            ('bytes=0-', 0, 'unsatisfiable'),
+            ('bytes=50-10', 1000, 'unsatisfiable'),
+            # Multipart and malformed ranges are answered with the whole file
+            ('bytes=0-10,20-30', 1000, None),
+            ('bytes=-', 1000, None),
+            ('items=0-10', 1000, None),
+            ('bytes=a-b', 1000, None),
+            ('', 1000, None),
+            (None, 1000, None),
+        ]
+        for header, size, expected in cases:
+            with self.subTest(header=header, size=size):
+                self.assertEqual(parse_range(header, size), expected)
+
+
+def tone(seconds, amplitude, frequency=440, fps=AUDIO_FPS):
+    """A stereo float32 sine"""
+    t = np.arange(int(seconds * fps)) / fps
+    wave = (amplitude * np.sin(2 * np.pi * frequency * t)).astype('float32')
+    return np.stack([wave, wave], axis=1)
+
+
+class MixTracksTests(SimpleTestCase):
+    def test_music_loops_to_the_duration(self):
+        music = np.random.default_rng(0).uniform(-0.1, 0.1, (int(0.3 * AUDIO_FPS), 2)).astype('float32')
+        mixed = mix_tracks(None, music, 1.0, music_volume=0.5)
+        self.assertEqual(mixed.shape, (AUDIO_FPS, 2))
+        self.assertEqual(mixed.dtype, np.float32)
+        indices = np.arange(AUDIO_FPS) % len(music)
+        np.testing.assert_array_equal(mixed, music[indices] * np.float32(0.5))
+
+    def test_limiter_holds_peaks_to_the_ceiling(self):
+        voice = tone(2, 0.9)
+        music = tone(0.5, 0.9, frequency=441)
+        self.assertGreater(np.abs(mix_tracks(voice, music, 2, music_volume=1.0, limit=False)).max(), 1.0)
+        mixed = mix_tracks(voice, music, 2, music_volume=1.0)
+        self.assertLessEqual(np.abs(mixed).max(), LIMITER_CEILING + 1e-6)
+        # Limited, not silenced
+        self.assertGreater(np.abs(mixed).max(), 0.9 * LIMITER_CEILING)
+
+    def test_quiet_mix_is_not_limited(self):
+        voice, music = tone(1, 0.4), tone(0.25, 0.4, frequency=300)
+        np.testing.assert_array_equal(mix_tracks(voice, music, 1), mix_tracks(voice, music, 1, limit=False))
+
+    def test_music_ducks_under_speech(self):
+        voice = tone(1, 0.5)
+        music = np.full((AUDIO_FPS, 2), 0.5, dtype='float32')
+        mixed = mix_tracks(voice, music, 3, music_volume=0.4, duck=True, limit=False)
+        music_part = mixed[:len(voice)] - voice
+        self.assertAlmostEqual(music_part[AUDIO_FPS // 2, 0], 0.2 * DUCK_GAIN, places=5)
+        self.assertAlmostEqual(mixed[int(2.5 * AUDIO_FPS), 0], 0.2, places=5)
+
+    def test_streamed_mix_matches(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            voice_path = make_test_tone(os.path.join(tmp, 'voice.wav'), 2)
+            music = tone(0.7, 0.95, frequency=441)
+            for duck in (False, True):
+                with self.subTest(duck=duck):
+                    streamed = np.concatenate(list(mixed_chunks(
+                        voice_path, LoopedTrack(samples=music), 3.3, music_volume=1.0, duck=duck
+                    )))
+                    whole = mix_tracks(decode_pcm(voice_path, 3.3), music, 3.3, music_volume=1.0, duck=duck)
+                    np.testing.assert_array_equal(streamed, whole)
+
+
+def psnr(frame, reference):
+    mse = ((frame.astype(float) - reference.astype(float)) ** 2).mean()
+    return float('inf') if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+
+class RegionReaderTests(SimpleTestCase):
+    """Sources are decoded by ffmpeg straight to their region, as fit_to_region would crop and scale them"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmp = tempfile.mkdtemp()
+        cls.path = make_test_clip(os.path.join(cls.tmp, 'landscape.mp4'), (320, 180), 1)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+        super().tearDownClass()
+
+    def test_frames_match_cropping_full_frames(self):
+        source = VideoFileClip(self.path, audio=False)
+        self.addCleanup(source.close)
+        for crop in (None, (0, 0, 0.5, 1)):
+            with self.subTest(crop=crop):
+                clip = RegionVideoFileClip(self.path, (90, 90), crop=crop, audio=False)
+                self.addCleanup(clip.close)
+                reference = fit_to_region(source, (90, 90), crop)
+                self.assertEqual(clip.size, (90, 90))
+                for t in (0, 0.5):
+                    frame = clip.get_frame(t)
+                    self.assertEqual(frame.shape, (90, 90, 3))
+                    self.assertGreater(psnr(frame, reference.get_frame(t)), 35)
+
+    def test_rotated_footage_is_fitted_upright(self):
+        rotated = os.path.join(self.tmp, 'rotated.mp4')
+        run_ffmpeg(['-i', self.path, '-c', 'copy', '-metadata:s:v', 'rotate=90', rotated])
+        clip = RegionVideoFileClip(rotated, (90, 160), audio=False)
+        self.addCleanup(clip.close)
+        self.assertEqual(clip.reader.source_size(), (180, 320))
+        # Portrait into a portrait region: scaled, not cropped
+        landscape = RegionVideoFileClip(self.path, (160, 90), audio=False)
+        self.addCleanup(landscape.close)
+        self.assertGreater(psnr(clip.get_frame(0.5), np.rot90(landscape.get_frame(0.5))), 35)
+
+    def test_reused_buffers(self):
+        clip = RegionVideoFileClip(self.path, (90, 90), audio=False, reuse_buffers=True)
+        self.addCleanup(clip.close)
+        reader = clip.reader
+        frames = [reader.read_frame() for _ in range(3)]
+        # Two buffers in turn: a frame is valid until the frame after next is read
+        self.assertIsNot(frames[0], frames[1])
+        self.assertIs(frames[0], frames[2])
+
+
+class LoopingTests(SimpleTestCase):
+    """Looped sources play the source again at t mod its duration, decoding a short loop once"""
+
+    def counting_clip(self, duration=0.5, fps=10):
+        calls = []
+
+        def make_frame(t):
+            calls.append(t)
+            return np.full((4, 4, 3), int(round(t * fps)), dtype='uint8')
+        clip = VideoClip(make_frame, duration=duration)
+        clip.fps = fps
+        # VideoClip reads a frame for its size
+        calls.clear()
+        return clip, calls
+
+    def test_video_wraps_time(self):
+        clip, _ = self.counting_clip()
+        looped = LoopedVideoClip(clip, 2.0, cache_max_bytes=0)
+        self.assertEqual(looped.duration, 2.0)
+        for t in (0, 0.3, 0.5, 0.8, 1.6):
+            with self.subTest(t=t):
+                np.testing.assert_array_equal(looped.get_frame(t), clip.get_frame(t % 0.5))
+
+    def test_short_video_loop_is_decoded_once(self):
+        clip, calls = self.counting_clip()
+        looped = LoopedVideoClip(clip, 2.0, cache_max_bytes=2 ** 20)
+        frames = [looped.get_frame(i / 10) for i in range(20)]
+        self.assertEqual(len(calls), 5)
+        self.assertIs(frames[0], frames[5])
+        self.assertFalse(frames[0].flags.writeable)
+
+        clip, calls = self.counting_clip()
+        uncached = LoopedVideoClip(clip, 2.0, cache_max_bytes=0)
+        for i in range(20):
+            uncached.get_frame(i / 10)
+        self.assertEqual(len(calls), 20)
+
+    def test_audio_wraps_time(self):
+        fps = 1000
+        source = AudioClip(lambda t: np.stack([np.sin(40 * t), np.cos(40 * t)], axis=-1), duration=0.5, fps=fps)
+        source.nchannels = 2
+        t = np.arange(int(1.7 * fps)) / fps
+        expected = source.get_frame(np.round(np.mod(t, 0.5) * fps) / fps)
+        for cache_max_bytes in (0, 2 ** 20):
+            with self.subTest(cache_max_bytes=cache_max_bytes):
+                looped = loop_audio(source, 1.7, cache_max_bytes=cache_max_bytes)
+                self.assertEqual(looped.duration, 1.7)
+                np.testing.assert_allclose(looped.get_frame(t), expected, atol=1e-9)
+
+    def test_track_repeats_end_to_end(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = make_test_tone(os.path.join(tmp, 'music.wav'), 0.5)
+            loop = decode_pcm(path)
+            expected = loop[np.arange(3 * len(loop) + 100) % len(loop)]
+            for max_bytes in (0, 2 ** 24):
+                with self.subTest(max_bytes=max_bytes):
+                    track = LoopedTrack(path, max_bytes=max_bytes)
+                    # Pieces that straddle the loop boundaries
+                    pieces = [track.read(1000) for _ in range(len(expected) // 1000)]
+                    pieces.append(track.read(len(expected) % 1000))
+                    track.close()
+                    np.testing.assert_array_equal(np.concatenate(pieces), expected)
+                    # Kept in memory only when the first loop fits
+                    self.assertEqual(track.samples is not None, max_bytes > 0)
+
+
+class PassthroughTests(SimpleTestCase):
+    """Audio is copied only where the rendered soundtrack would be the source's audio unchanged"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmp = tempfile.mkdtemp()
+        cls.voiced = make_test_clip(os.path.join(cls.tmp, 'voiced.mp4'), (64, 64), 1, with_audio=True)
+        cls.silent = make_test_clip(os.path.join(cls.tmp, 'silent.mp4'), (64, 64), 1)
+        cls.music = make_test_tone(os.path.join(cls.tmp, 'music.mp3'), 2)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+        super().tearDownClass()
+
+    def test_video1_audio_alone_is_copied(self):
+        self.assertEqual(passthrough_audio(self.voiced), self.voiced)
+
+    def test_nothing_to_copy_without_audio(self):
+        self.assertIsNone(passthrough_audio(self.silent))
+
+    def test_music_goes_through_the_mix(self):
+        self.assertIsNone(passthrough_audio(self.voiced, self.music))
+        # Even at full volume over a silent video1: the mix limits the music's peaks
+        self.assertIsNone(passthrough_audio(self.silent, self.music))
+        mixed = mix_tracks(None, tone(1, 1.0), 1, music_volume=1)
+        self.assertLessEqual(np.abs(mixed).max(), LIMITER_CEILING + 1e-6)
+
+
+class PlanSegmentsTests(SimpleTestCase):
+    def test_examples(self):
+        self.assertEqual(plan_segments(300, 60, 4), [(0, 120), (120, 240), (240, 300)])
+        self.assertEqual(plan_segments(1200, 60, 4), [(0, 300), (300, 600), (600, 900), (900, 1200)])
+        self.assertEqual(plan_segments(50, 250, 4), [(0, 50)])
+        self.assertEqual(plan_segments(1000, 100, 4, min_frames=400), [(0, 500), (500, 1000)])
+        self.assertEqual(plan_segments(1000, 100, 1), [(0, 1000)])
+
+    def test_ranges_start_on_keyframes_and_cover_every_frame(self):
+        for frames in (1, 59, 60, 61, 299, 300, 1801, 7200):
+            for keyint in (1, 30, 60, 250):
+                for workers in (1, 2, 3, 8):
+                    for min_frames in (1, 90, 1000):
+                        segments = plan_segments(frames, keyint, workers, min_frames)
+                        with self.subTest(frames=frames, keyint=keyint, workers=workers, min_frames=min_frames):
+                            self.assertLessEqual(len(segments), workers)
+                            self.assertTrue(len(segments) == 1 or len(segments) <= frames // min_frames)
+                            self.assertEqual(segments[0][0], 0)
+                            self.assertEqual(segments[-1][1], frames)
+                            for (start, end), (next_start, _) in zip(segments, segments[1:]):
+                                self.assertEqual(end, next_start)
+                                self.assertEqual((end - start) % keyint, 0)
+                            self.assertTrue(all(start % keyint == 0 and end > start for start, end in segments))
+
+
+SRT = """\ufeff1\r
+00:00:01,000 --> 00:00:03,500\r
+<i>Hello</i> &amp; welcome\r
+\r
+2\r
+00:00:03,000 --> 00:00:05,000\r
+{\\an8}Two lines\r
+of text\r
+\r
+3\r
+00:00:06,000 --> 00:00:07,000\r
+<b></b>\r
+"""
+
+VTT = """WEBVTT - captions
+
+NOTE this block is a comment
+over two lines
+
+STYLE
+::cue { color: yellow }
+
+intro
+00:01.500 --> 00:02.250 line:0 align:start
+<c.yellow>First</c> <00:02.000>cue
+
+1:00:00.000 --> 1:00:01.000
+An hour in
+"""
+
+
+def count_frames(path):
+    """Frames in the video stream of `path`, by decoding it"""
+    result = subprocess.run([get_setting("FFMPEG_BINARY"), '-i', path, '-map', '0:v:0', '-f', 'null', '-'],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    return int(re.findall(r'frame=\s*(\d+)', result.stderr.decode('utf-8', errors='replace'))[-1])
+
+
+class SegmentedRenderTests(SimpleTestCase):
+    """Splitting a render across processes leaves the output's frames as a single pass has them"""
+
+    @override_settings(RENDER_SEGMENT_MIN_SECONDS=1, RENDER_SEGMENT_WORKERS=2)
+    def test_segmented_frames_match_single_pass(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            params = {
+                'video1_path': make_test_clip(os.path.join(tmp, 'v1.mp4'), (320, 240), 3.5, with_audio=True),
+                'video2_path': make_test_clip(os.path.join(tmp, 'v2.mp4'), (240, 320), 1.5),
+                'target_resolution': 240,
+                'watermark': '',
+                'text_overlay': '',
+            }
+            duration, fps, _ = source_timing(params['video1_path'])
+            frames = frame_count(duration, fps)
+            self.assertGreater(len(plan_segments(frames, 60, 2)), 1)
+
+            outputs = {}
+            for backend in ('moviepy', 'segmented'):
+                outputs[backend] = os.path.join(tmp, f'{backend}.mp4')
+                render_video(render_backend=backend, output_path=outputs[backend], **params)
+            self.assertEqual(count_frames(outputs['segmented']), count_frames(outputs['moviepy']))
+            self.assertEqual(count_frames(outputs['moviepy']), frames)
+
+
+class CaptionParserTests(SimpleTestCase):
+    def test_timestamps(self):
+        self.assertEqual(parse_timestamp('00:01:02,500'), 62.5)
+        self.assertEqual(parse_timestamp('01:02.5'), 62.5)
+        self.assertEqual(parse_timestamp('2:00:00.000'), 7200)
+        for value in ('00:60:00,000', '00:00:60,000', '1:2:3', '00:00:01', 'later'):
+            with self.subTest(value), self.assertRaises(InvalidCaptions):
+                parse_timestamp(value)
+
+    def test_srt(self):
+        cues = parse_captions(SRT)
+        # The third cue is only tags and is dropped
+        self.assertEqual([(cue.start, cue.end, cue.text) for cue in cues],
+                         [(1.0, 3.5, 'Hello & welcome'), (3.0, 5.0, 'Two lines\nof text')])
+
+    def test_vtt(self):
+        cues = parse_captions(VTT)
+        self.assertEqual([(cue.start, cue.end, cue.text) for cue in cues],
+                         [(1.5, 2.25, 'First cue'), (3600.0, 3601.0, 'An hour in')])
+
+    def test_invalid(self):
+        cases = {
+            'no cues': 'WEBVTT\n',
+            'no timing line': '1\nHello\n',
+            'invalid timing line': '1\n--> 00:00:01,000\nHello\n',
+            'ends before it starts': '1\n00:00:02,000 --> 00:00:01,000\nHello\n',
+            'invalid timestamp': '1\n00:00:01 --> 00:00:02\nHello\n',
+        }
+        for name, text in cases.items():
+            with self.subTest(name), self.assertRaises(InvalidCaptions):
+                parse_captions(text)
+
+    @override_settings(MAX_CAPTION_CUES=2)
+    def test_too_many_cues(self):
+        text = '\n\n'.join(f'00:00:0{i},000 --> 00:00:0{i},500\nCue {i}' for i in range(3))
+        with self.assertRaisesMessage(InvalidCaptions, 'more than 2 cues'):
+            parse_captions(text)
+
+
+class CueIndexTests(SimpleTestCase):
+    def showing(self, cues, t):
+        """The cues showing at t by a scan, earliest first"""
+        return tuple(sorted((i for i, cue in enumerate(cues) if cue.start <= t < cue.end),
+                            key=lambda i: (cues[i].start, i)))
+
+    def test_overlapping_cues(self):
+        cues = [Cue(1, 4, 'a'), Cue(2, 3, 'b'), Cue(2, 6, 'c'), Cue(6, 7, 'd'), Cue(0.5, 2, 'e')]
+        index = CueIndex(cues)
+        self.assertEqual(index.at(0), ())
+        self.assertEqual(index.at(1.5), (4, 0))
+        self.assertEqual(index.at(2), (0, 1, 2))
+        self.assertEqual(index.at(3), (0, 2))
+        self.assertEqual(index.at(6), (3,))
+        self.assertEqual(index.at(7), ())
+        for t in np.arange(0, 8, 0.25):
+            with self.subTest(t=t):
+                self.assertEqual(index.at(t), self.showing(cues, t))
+
+    def test_matches_a_scan(self):
+        rng = np.random.default_rng(0)
+        starts = rng.integers(0, 100, 60) / 4
+        cues = [Cue(start, start + length, str(i))
+                for i, (start, length) in enumerate(zip(starts, rng.integers(1, 20, 60) / 4))]
+        index = CueIndex(cues)
+        for t in np.arange(-1, 32, 0.125):
+            self.assertEqual(index.at(t), self.showing(cues, t))
+
+
+def use_temporary_media(test):
+    """Point MEDIA_ROOT at a directory removed after the test"""
+    media_root = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+    override = override_settings(MEDIA_ROOT=media_root)
+    override.enable()
+    test.addCleanup(override.disable)
+    return media_root
+
+
+@override_settings(RENDER_HEARTBEAT_INTERVAL=0)
+class ChunkedUploadTests(TestCase):
+    DATA = b'0123456789' * 100
+
+    def setUp(self):
+        use_temporary_media(self)
+        self.client = APIClient()
+
+    def open_upload(self, data=DATA, sha256=None):
+        response = self.client.post(reverse('upload_sessions'), {
+            'filename': 'clip.mp4', 'size': len(data), 'sha256': sha256 or hashlib.sha256(data).hexdigest(),
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        return response.data['upload_id']
+
+    def put(self, upload_id, offset, data):
+        return self.client.put(f"{reverse('upload_session', args=[upload_id])}?offset={offset}",
+                               data, content_type='application/octet-stream')
+
+    def finalize(self, upload_id):
+        return self.client.post(reverse('upload_session_finalize', args=[upload_id]))
+
+    def test_chunks_must_continue_at_the_offset(self):
+        upload_id = self.open_upload()
+        self.assertEqual(self.put(upload_id, 0, self.DATA[:400]).data['offset'], 400)
+        response = self.put(upload_id, 300, self.DATA[300:600])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['offset'], 400)
+        # Resent after a dropped connection, from the offset the server reports
+        self.assertEqual(self.put(upload_id, 400, self.DATA[400:]).data['offset'], len(self.DATA))
+
+    def test_chunk_past_the_declared_size(self):
+        upload_id = self.open_upload()
+        response = self.put(upload_id, 0, self.DATA + b'extra')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(UploadSession.objects.get(pk=upload_id).received, 0)
+
+    def test_checksum_mismatch_deletes_the_session(self):
+        upload_id = self.open_upload(sha256=hashlib.sha256(b'other').hexdigest())
+        session = UploadSession.objects.get(pk=upload_id)
+        self.put(upload_id, 0, self.DATA)
+        self.assertEqual(self.finalize(upload_id).status_code, 400)
+        self.assertFalse(UploadSession.objects.filter(pk=upload_id).exists())
+        self.assertFalse(os.path.exists(part_path(session)))
+        self.assertEqual(os.listdir(input_dir()), [])
+
+    def test_finalize_is_idempotent(self):
+        upload_id = self.open_upload()
+        self.put(upload_id, 0, self.DATA)
+        first, second = self.finalize(upload_id), self.finalize(upload_id)
+        self.assertEqual((first.status_code, second.status_code), (200, 200))
+        self.assertEqual(first.data['asset_id'], hashlib.sha256(self.DATA).hexdigest())
+        self.assertEqual(second.data['asset_id'], first.data['asset_id'])
+
+    def test_concurrent_finalize(self):
+        upload_id = self.open_upload()
+        self.put(upload_id, 0, self.DATA)
+        # Both requests loaded the session before either finalized it
+        first, second = UploadSession.objects.get(pk=upload_id), UploadSession.objects.get(pk=upload_id)
+        finalize_session(first)
+        self.assertEqual(finalize_session(second).status, UploadSession.STATUS_COMPLETE)
+        self.assertEqual(second.path, first.path)
+
+        # One still finalizing is a conflict, not a server error
+        other_id = self.open_upload(data=b'other data')
+        self.put(other_id, 0, b'other data')
+        UploadSession.objects.filter(pk=other_id).update(status=UploadSession.STATUS_FINALIZING)
+        self.assertEqual(self.finalize(other_id).status_code, 409)
+
+    def test_finalize_keeps_a_stored_file(self):
+        sha256 = hashlib.sha256(self.DATA).hexdigest()
+        stored = os.path.join(input_dir(), f'{sha256}.mp4')
+        with open(stored, 'wb') as f:
+            f.write(self.DATA)
+        # A multipart upload or queued job holding the stored file
+        held = os.path.join(input_dir(), 'held')
+        os.link(stored, held)
+
+        upload_id = self.open_upload()
+        session = UploadSession.objects.get(pk=upload_id)
+        self.put(upload_id, 0, self.DATA)
+        response = self.finalize(upload_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['asset_id'], sha256)
+        self.assertTrue(os.path.samefile(stored, held))
+        self.assertEqual(os.stat(stored).st_nlink, 2)
+        self.assertFalse(os.path.exists(part_path(session)))
+
+
+class SpriteCacheTests(SimpleTestCase):
+    def setUp(self):
+        media_root = use_temporary_media(self)
+        override = override_settings(SPRITE_CACHE_DIR=os.path.join(media_root, 'sprites'),
+                                     SPRITE_DISK_CACHE_MAX_BYTES=2000)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.addCleanup(sprites._memory_cache.clear)
+        sprites._memory_cache.clear()
+        # ImageMagick stands behind _render_text; each text gets its own random 20x10 raster (928 bytes as .npy)
+        self.rendered = []
+        patcher = mock.patch.object(sprites, '_render_text', side_effect=self.render)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def render(self, text, font, fontsize, color):
+        self.rendered.append(text)
+        return np.random.default_rng(len(self.rendered)).integers(0, 256, (10, 20, 4), dtype='uint8')
+
+    def sprite(self, text):
+        """The sprite as a later process would get it: from disk if it is there"""
+        sprites._memory_cache.clear()
+        rgba = sprites.get_text_sprite(text, 'Arial-Bold', 40, 'white')
+        time.sleep(0.02)  # apart in mtime
+        return rgba
+
+    def cached_texts(self):
+        keys = {text: sprites.sprite_key(text, 'Arial-Bold', 40, 'white') for text in 'abcd'}
+        return {text for text, key in keys.items() if os.path.exists(sprites._disk_path(key))}
+
+    def test_hit_returns_identical_pixels(self):
+        first = self.sprite('a').copy()
+        np.testing.assert_array_equal(self.sprite('a'), first)
+        # The memory cache hands out the same array, read-only
+        again = sprites.get_text_sprite('a', 'Arial-Bold', 40, 'white')
+        self.assertIs(again, sprites.get_text_sprite('a', 'Arial-Bold', 40, 'white'))
+        self.assertFalse(again.flags.writeable)
+        self.assertEqual(self.rendered, ['a'])
+
+    def test_disk_cache_is_bounded_least_recently_used_first(self):
+        self.sprite('a')
+        self.sprite('b')
+        self.sprite('c')
+        self.assertEqual(self.cached_texts(), {'b', 'c'})
+        self.sprite('b')  # a hit makes b the most recently used
+        self.sprite('d')
+        self.assertEqual(self.cached_texts(), {'b', 'd'})
+        self.assertEqual(self.rendered, ['a', 'b', 'c', 'd'])
+
+
+@override_settings(RENDER_HEARTBEAT_INTERVAL=0, RENDER_JOB_STALE_SECONDS=60, RENDER_JOB_MAX_ATTEMPTS=2)
+class RenderJobTests(TestCase):
+    def setUp(self):
+        use_temporary_media(self)
+        self.addCleanup(jobs._waiting.clear)
+        self.addCleanup(jobs._admitted.clear)
+
+    def create_job(self, **fields):
+        params = {'video1_path': 'missing-1.mp4', 'video2_path': 'missing-2.mp4', 'aspect_ratio': [9, 16],
+                  'output_path': os.path.join(tempfile.gettempdir(), 'unused.mp4')}
+        return RenderJob.objects.create(params=params, **fields)
+
+    def stale(self, job):
+        """The job as a process that stopped a while ago left it"""
+        RenderJob.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - timedelta(seconds=120))
+        return RenderJob.objects.get(pk=job.pk)
+
+    @mock.patch('combine_video.tasks.render_video')
+    def test_job_is_claimed_once(self, render_video):
+        job = self.create_job()
+        self.assertEqual(jobs.run_render_job(job.pk), RenderJob.STATUS_DONE)
+        self.assertEqual(jobs.run_render_job(job.pk), RenderJob.STATUS_DONE)
+        self.assertEqual(render_video.call_count, 1)
+        self.assertEqual(RenderJob.objects.get(pk=job.pk).attempts, 1)
+
+        # A worker finds another one already on it
+        running = self.create_job(status=RenderJob.STATUS_RUNNING)
+        self.assertEqual(jobs.run_render_job(running.pk), RenderJob.STATUS_RUNNING)
+        self.assertEqual(render_video.call_count, 1)
+
+    @mock.patch('combine_video.jobs.submit_render_job')
+    def test_stale_running_job_is_requeued_once(self, submit_render_job):
+        job = self.create_job(status=RenderJob.STATUS_RUNNING, attempts=1)
+        # Two processes notice it at the same time
+        first = self.stale(job)
+        second = RenderJob.objects.get(pk=job.pk)
+        self.assertTrue(jobs.recover_job(first))
+        self.assertFalse(jobs.recover_job(second))
+        jobs.recover_stale_jobs()
+        self.assertEqual(submit_render_job.call_count, 1)
+        self.assertEqual(RenderJob.objects.get(pk=job.pk).status, RenderJob.STATUS_QUEUED)
+
+    @mock.patch('combine_video.jobs.submit_render_job')
+    def test_job_that_keeps_stopping_its_worker_fails(self, submit_render_job):
+        job = self.stale(self.create_job(status=RenderJob.STATUS_RUNNING, attempts=2))
+        jobs.recover_stale_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, RenderJob.STATUS_FAILED)
+        self.assertIn('2 times', job.error)
+        submit_render_job.assert_not_called()
+
+    @mock.patch('combine_video.jobs.submit_render_job')
+    def test_live_jobs_are_left_alone(self, submit_render_job):
+        job = self.create_job(status=RenderJob.STATUS_RUNNING, heartbeat_at=timezone.now())
+        jobs.recover_stale_jobs()
+        self.assertTrue(jobs.job_is_live(job))
+        self.assertEqual(RenderJob.objects.get(pk=job.pk).status, RenderJob.STATUS_RUNNING)
+        submit_render_job.assert_not_called()
+
+    @override_settings(RENDER_MEMORY_BUDGET=100)
+    @mock.patch('combine_video.jobs.get_executor')
+    def test_admission_by_memory_budget(self, get_executor):
+        get_executor.return_value.submit.side_effect = lambda *args: Future()
+        big, small, medium = (self.create_job(memory_ceiling=ceiling) for ceiling in (60, 30, 50))
+        for job in (big, small, medium):
+            jobs.submit_render_job(job)
+        self.assertEqual(set(jobs._admitted), {str(big.pk), str(small.pk)})
+        self.assertEqual([job_id for job_id, _ in jobs._waiting], [str(medium.pk)])
+
+        finished = Future()
+        finished.set_result(RenderJob.STATUS_DONE)
+        jobs._on_job_finished(str(big.pk), finished)
+        self.assertEqual(set(jobs._admitted), {str(small.pk), str(medium.pk)})
+
+        # A job over the whole budget still runs, once it has the pool to itself
+        huge = self.create_job(memory_ceiling=500)
+        jobs.submit_render_job(huge)
+        self.assertNotIn(str(huge.pk), jobs._admitted)
+        jobs._on_job_finished(str(small.pk), finished)
+        jobs._on_job_finished(str(medium.pk), finished)
+        self.assertEqual(set(jobs._admitted), {str(huge.pk)})
+
+    def test_worker_failure_removes_inputs(self):
+        input_path = os.path.join(input_dir(), 'input.mp4')
+        open(input_path, 'wb').close()
+        job = self.create_job(status=RenderJob.STATUS_RUNNING, input_paths=[input_path])
+        jobs._record_worker_failure(str(job.pk), RuntimeError("worker died"))
+        self.assertEqual(RenderJob.objects.get(pk=job.pk).status, RenderJob.STATUS_FAILED)
+        self.assertFalse(os.path.exists(input_path))
+        # A job pruned meanwhile is no error
+        job_id = str(job.pk)
+        job.delete()
+        jobs._record_worker_failure(job_id, RuntimeError("worker died"))
+
+
+@override_settings(RENDER_HEARTBEAT_INTERVAL=0)
+class RenderCacheTests(TestCase):
+    def setUp(self):
+        self.media_root = use_temporary_media(self)
+
+    def request(self, key='a' * 64):
+        """What a combine request does for the render with cache key `key`"""
+        output_path = os.path.join(self.media_root, f'{key[:8]}-{RenderJob.objects.count()}.mp4')
+        return get_or_create_render_job(key, params={'output_path': output_path})
+
+    def finish(self, job, size=100, last_used=None):
+        """Mark a job done with an output of `size` bytes, last used `last_used` seconds ago"""
+        with open(job.params['output_path'], 'wb') as f:
+            f.write(b'\0' * size)
+        RenderJob.objects.filter(pk=job.pk).update(status=RenderJob.STATUS_DONE)
+        RenderCacheEntry.objects.filter(job=job).update(
+            output_size=size, last_used_at=timezone.now() - timedelta(seconds=last_used or 0)
+        )
+
+    def test_identical_requests_attach_to_one_job(self):
+        job, created = self.request()
+        self.assertTrue(created)
+        self.assertEqual(self.request(), (job, False))
+        self.finish(job)
+        self.assertEqual(self.request(), (job, False))
+        self.assertEqual(RenderCacheEntry.objects.get(job=job).hits, 1)
+        self.assertEqual(self.request('b' * 64)[1], True)
+
+    def test_losing_the_race_for_a_key_attaches(self):
+        lookup = RenderCacheEntry.objects.select_related
+        rival = {}
+
+        def select_related(*fields):
+            if not rival:
+                # An identical request creates the entry between our lookup and our insert
+                rival['job'] = RenderJob.objects.create(params={})
+                RenderCacheEntry.objects.create(cache_key='a' * 64, job=rival['job'])
+                return RenderCacheEntry.objects.none()
+            return lookup(*fields)
+
+        with mock.patch.object(RenderCacheEntry.objects, 'select_related', side_effect=select_related):
+            self.assertEqual(self.request(), (rival['job'], False))
+        self.assertEqual(RenderJob.objects.count(), 1)
+
+    def test_failed_or_evicted_job_is_rendered_again(self):
+        failed, _ = self.request()
+        RenderJob.objects.filter(pk=failed.pk).update(status=RenderJob.STATUS_FAILED)
+        job, created = self.request()
+        self.assertTrue(created)
+        self.assertNotEqual(job, failed)
+
+        self.finish(job)
+        os.remove(job.params['output_path'])
+        again, created = self.request()
+        self.assertTrue(created)
+        self.assertEqual(RenderCacheEntry.objects.get(cache_key='a' * 64).job, again)
+
+    def test_eviction(self):
+        jobs_by_name = {}
+        for name, last_used in (('old', 3000), ('middle', 200), ('new', 100), ('expired', 10 ** 6)):
+            job, _ = self.request(name.ljust(64, '0'))
+            self.finish(job, size=100, last_used=last_used)
+            jobs_by_name[name] = job
+        running, _ = self.request('running'.ljust(64, '0'))
+        RenderJob.objects.filter(pk=running.pk).update(status=RenderJob.STATUS_RUNNING)
+        open(running.params['output_path'], 'wb').close()
+
+        evict_renders(250, max_age=86400)
+
+        kept = set(RenderCacheEntry.objects.values_list('job_id', flat=True))
+        self.assertEqual(kept, {jobs_by_name['new'].pk, jobs_by_name['middle'].pk, running.pk})
+        for name, job in jobs_by_name.items():
+            self.assertEqual(os.path.exists(job.params['output_path']), name in ('new', 'middle'))
+        self.assertTrue(os.path.exists(running.params['output_path']))
+
+        # The output just recorded stays even if it alone is over the limit
+        evict_renders(50, keep=jobs_by_name['middle'].pk)
+        kept = set(RenderCacheEntry.objects.values_list('job_id', flat=True))
+        self.assertEqual(kept, {jobs_by_name['middle'].pk, running.pk})
+
+
+@override_settings(RENDER_HEARTBEAT_INTERVAL=0)
+class ContentAddressedUploadTests(TestCase):
+    DATA = b'video bytes' * 1000
+
+    def setUp(self):
+        use_temporary_media(self)
+
+    def upload(self, data=DATA, name='clip.mp4'):
+        """Run `data` through the upload handler as a multipart request would; returns the open file"""
+        handler = ContentAddressedUploadHandler()
+        handler.handle_raw_input(None, {}, len(data), b'boundary')
+        try:
+            handler.new_file('video1', name, 'video/mp4', len(data))
+        except StopFutureHandlers:
+            pass
+        for start in range(0, len(data), 4096):
+            handler.receive_data_chunk(data[start:start + 4096], start)
+        return handler.file_complete(len(data))
+
+    def stored_files(self):
+        return sorted(os.listdir(input_dir()))
+
+    def test_duplicate_uploads_share_one_inode(self):
+        first, second = self.upload(), self.upload()
+        self.assertTrue(first.created)
+        self.assertFalse(second.created)
+        self.assertEqual(first.temporary_file_path(), second.temporary_file_path())
+        self.assertEqual(first.sha256, hashlib.sha256(self.DATA).hexdigest())
+        # The stored file and each request's link to it
+        self.assertEqual(os.stat(first.temporary_file_path()).st_nlink, 3)
+        first.close()
+        second.close()
+        self.assertEqual(self.stored_files(), [f'{first.sha256}.mp4'])
+        self.assertEqual(os.stat(first.temporary_file_path()).st_nlink, 1)
+
+    def test_held_upload_survives_removal(self):
+        first, second = self.upload(), self.upload()
+        path = first.temporary_file_path()
+        # The request that stored it fails while the other still holds it
+        first.discard()
+        self.assertTrue(os.path.exists(path))
+        second.close()
+
+        # A queued job reading it keeps it too
+        job = RenderJob.objects.create(input_paths=[path])
+        remove_unless_held(path)
+        self.assertTrue(os.path.exists(path))
+
+        RenderJob.objects.filter(pk=job.pk).update(status=RenderJob.STATUS_DONE)
+        remove_unless_held(path)
+        self.assertEqual(self.stored_files(), [])
+
+    def test_discarding_a_later_duplicate_keeps_the_stored_file(self):
+        first = self.upload()
+        first.close()
+        second = self.upload()
+        second.discard()
+        self.assertEqual(self.stored_files(), [f'{first.sha256}.mp4'])
+
+    @override_settings(MAX_UPLOAD_FILE_SIZE=5000)
+    def test_oversize_file_is_rejected(self):
+        response = APIClient().post(reverse('combine_videos_api'), {
+            'video1': SimpleUploadedFile('a.mp4', b'small'),
+            'video2': SimpleUploadedFile('b.mp4', self.DATA),
+        }, format='multipart')
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(self.stored_files(), [])
+
+    @override_settings(MAX_UPLOAD_REQUEST_SIZE=5000)
+    def test_oversize_request_is_rejected(self):
+        response = APIClient().post(reverse('combine_videos_api'), {
+            'video1': SimpleUploadedFile('a.mp4', self.DATA),
+        }, format='multipart')
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(self.stored_files(), [])
+
+
+@override_settings(RENDER_HEARTBEAT_INTERVAL=0, OUTPUT_SERVE_MODE='django')
+class OutputServingTests(TestCase):
+    DATA = bytes(range(256)) * 4
+
+    def setUp(self):
+        output_dir = os.path.join(use_temporary_media(self), 'output_videos')
+        os.makedirs(output_dir, exist_ok=True)
+        path = os.path.join(output_dir, 'out.mp4')
+        with open(path, 'wb') as f:
+            f.write(self.DATA)
+        self.job = RenderJob.objects.create(
+            status=RenderJob.STATUS_DONE, output_filename='out.mp4', params={'output_path': path},
+        )
+        self.entry = RenderCacheEntry.objects.create(
+            cache_key='key', job=self.job, last_used_at=timezone.now() - timedelta(hours=1),
+        )
+        self.client = APIClient()
+
+    def last_used(self):
+        return RenderCacheEntry.objects.get(pk=self.entry.pk).last_used_at
+
+    def body(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_whole_file_counts_as_a_playback(self):
+        before = self.last_used()
+        response = self.client.get(reverse('render_job_result', args=[self.job.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.DATA)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertGreater(self.last_used(), before)
+
+    def test_seek_range_is_served_without_counting(self):
+        before = self.last_used()
+        response = self.client.get(reverse('output_video', args=['out.mp4']), HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 100-199/{len(self.DATA)}')
+        self.assertEqual(self.body(response), self.DATA[100:200])
+        self.assertEqual(self.last_used(), before)
+
+    def test_first_range_counts_as_a_playback(self):
+        before = self.last_used()
+        response = self.client.get(reverse('output_video', args=['out.mp4']), HTTP_RANGE='bytes=0-')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(self.body(response), self.DATA)
+        self.assertGreater(self.last_used(), before)
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get(reverse('output_video', args=['out.mp4']), HTTP_RANGE='bytes=5000-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.DATA)}')
+
+    def test_missing_output(self):
+        os.remove(self.job.params['output_path'])
+        response = self.client.get(reverse('render_job_result', args=[self.job.pk]))
+        self.assertEqual(response.status_code, 410)
+        response = self.client.get(reverse('output_video', args=['out.mp4']))
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(RENDER_HEARTBEAT_INTERVAL=0)
+class PreviewAPITests(TestCase):
+    """The preview endpoint renders frames of the layout from uploads or stored ids"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmp = tempfile.mkdtemp()
+        cls.video1 = make_test_clip(os.path.join(cls.tmp, 'v1.mp4'), (320, 180), 1, with_audio=True)
+        cls.video2 = make_test_clip(os.path.join(cls.tmp, 'v2.mp4'), (180, 320), 1)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        use_temporary_media(self)
+        self.client = APIClient()
+        self.params = {'watermark': '', 'text_overlay': '', 'aspect_ratio': '9:16', 'preview_resolution': 160}
+
+    def upload(self, **params):
+        with open(self.video1, 'rb') as video1, open(self.video2, 'rb') as video2:
+            return self.client.post(reverse('preview_api'), dict(self.params, video1=video1, video2=video2, **params),
+                                    format='multipart')
+
+    def test_frame_from_uploads_then_from_ids(self):
+        response = self.upload(image_format='png', t=0.5)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        image = Image.open(io.BytesIO(response.content))
+        self.assertEqual(image.size, output_size(160, (9, 16)))
+
+        # Stored uploads are previewed again by id, here as a short animation
+        ids = {'video1_id': response['X-Video1-Id'], 'video2_id': response['X-Video2-Id']}
+        response = self.client.get(reverse('preview_api'),
+                                   dict(self.params, image_format='gif', duration=1, fps=4, **ids))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/gif')
+        self.assertEqual(Image.open(io.BytesIO(response.content)).n_frames, 4)
+
+    def test_unknown_id(self):
+        response = self.client.get(reverse('preview_api'),
+                                   dict(self.params, video1_id='0' * 64, video2_id='1' * 64))
+        self.assertEqual(response.status_code, 404)
+
+    def test_both_videos_required(self):
+        with open(self.video1, 'rb') as video1:
+            response = self.client.post(reverse('preview_api'), dict(self.params, video1=video1), format='multipart')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(os.listdir(input_dir()), [])
+
+    def test_animation_needs_an_animated_format(self):
+        response = self.upload(image_format='jpeg', duration=1)
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(RENDER_HEARTBEAT_INTERVAL=0)
+class BatchAPITests(TestCase):
+    """A batch renders each video1 against the shared video2, reusing renders it already has"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmp = tempfile.mkdtemp()
+        cls.clips = [make_test_clip(os.path.join(cls.tmp, f'v1-{i}.mp4'), (320, 180), 1, with_audio=True,
+                                    frequency=440 + 100 * i) for i in range(2)]
+        cls.video2 = make_test_clip(os.path.join(cls.tmp, 'v2.mp4'), (180, 320), 1)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        use_temporary_media(self)
+        self.client = APIClient()
+        submit = mock.patch('combine_video.views.submit_render_batch')
+        self.submit = submit.start()
+        self.addCleanup(submit.stop)
+
+    def post(self, video1_paths, **params):
+        files = [open(path, 'rb') for path in video1_paths + [self.video2]]
+        try:
+            data = dict({'watermark': '', 'text_overlay': '', 'render_backend': 'moviepy'}, **params)
+            return self.client.post(reverse('batch_combine_api'),
+                                    dict(data, video1=files[:-1], video2=files[-1]), format='multipart')
+        finally:
+            for f in files:
+                f.close()
+
+    def test_items_share_video2_and_repeats_attach(self):
+        # The first clip twice: one render serves both items
+        response = self.post([self.clips[0], self.clips[1], self.clips[0]])
+        self.assertEqual(response.status_code, 202)
+        batch = RenderBatch.objects.get()
+        items = list(batch.items.order_by('index').select_related('job'))
+        self.assertEqual([item.source_name for item in items], ['v1-0.mp4', 'v1-1.mp4', 'v1-0.mp4'])
+        self.assertEqual(items[0].job, items[2].job)
+        self.assertNotEqual(items[0].job, items[1].job)
+        self.assertEqual(items[0].job.params['video2_path'], items[1].job.params['video2_path'])
+        self.assertEqual(response.data['counts'][RenderJob.STATUS_QUEUED], 3)
+        self.assertFalse(response.data['finished'])
+
+        # The two renders are queued together, after the shared assets are prepared once
+        jobs_submitted, prepared_dir = self.submit.call_args[0]
+        self.assertEqual({job.pk for job in jobs_submitted}, {items[0].job.pk, items[1].job.pk})
+        self.assertEqual(prepared_dir, os.path.join(settings.PREPARED_ASSET_DIR, str(batch.id)))
+
+        response = self.client.get(reverse('render_batch_status', args=[batch.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['index'] for item in response.data['items']], [0, 1, 2])
+
+    def test_bad_video1_rejects_the_whole_batch(self):
+        broken = os.path.join(self.tmp, 'broken.mp4')
+        with open(broken, 'wb') as f:
+            f.write(b'not a video' * 100)
+        response = self.post([self.clips[0], broken])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('broken.mp4', response.data['error'])
+        self.assertFalse(RenderBatch.objects.exists())
+        self.assertFalse(self.submit.called)
+        self.assertEqual(os.listdir(input_dir()), [])
+
+    @override_settings(MAX_BATCH_ITEMS=1)
+    def test_too_many_items(self):
+        response = self.post(self.clips)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(RenderBatch.objects.exists())
+
+
+@override_settings(RENDER_HEARTBEAT_INTERVAL=0)
+class MetricsTests(TestCase):
+    """Stage profiles are charged exclusive time and summed into the /metrics series"""
+
+    def summary(self, wall, frames, stages):
+        return {
+            'wall_seconds': wall, 'cpu_seconds': wall, 'peak_rss_bytes': 300 * 2 ** 20, 'frames': frames,
+            'fps': round(frames / wall, 2),
+            'stages': {name: {'wall_seconds': seconds, 'cpu_seconds': seconds / 2, 'calls': 1,
+                              'peak_rss_bytes': 0} for name, seconds in stages.items()},
+        }
+
+    def test_nested_stages_are_charged_exclusive_time(self):
+        # Nothing is recorded outside profiling()
+        with stage('decode'):
+            pass
+        clip = timed_clip(ImageClip(np.zeros((4, 4, 3), dtype='uint8')).set_duration(1), 'composite',
+                          count_frames=True)
+
+        with profiling() as profile:
+            with stage('outer'):
+                time.sleep(0.05)
+                with stage('inner'):
+                    time.sleep(0.1)
+            with stage('inner'):
+                pass
+            timed = timed_clip(clip, 'composite', count_frames=True)
+            for t in (0, 0.5):
+                timed.get_frame(t)
+        summary = profile.summary()
+
+        self.assertEqual(summary['frames'], 2)
+        self.assertEqual(summary['stages']['inner']['calls'], 2)
+        self.assertGreaterEqual(summary['stages']['inner']['wall_seconds'], 0.1)
+        self.assertGreaterEqual(summary['stages']['outer']['wall_seconds'], 0.05)
+        self.assertLess(summary['stages']['outer']['wall_seconds'], 0.1)
+        self.assertEqual(summary['stages']['composite']['calls'], 2)
+        self.assertGreaterEqual(summary['wall_seconds'], 0.15)
+
+    def test_prometheus_text(self):
+        for status in (RenderJob.STATUS_DONE, RenderJob.STATUS_DONE, RenderJob.STATUS_FAILED):
+            RenderJob.objects.create(status=status)
+        record_job_metrics(RenderJob.STATUS_DONE, {}, self.summary(2.0, 60, {'decode': 0.5, 'encode': 1.5}))
+        record_job_metrics(RenderJob.STATUS_DONE, {}, self.summary(10.0, 300, {'decode': 4.0}))
+        record_job_metrics(RenderJob.STATUS_FAILED, {'render_backend': 'ffmpeg'}, self.summary(0.1, 0, {}))
+        record_job_metrics(RenderJob.STATUS_FAILED, {}, {})
+
+        response = APIClient().get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        lines = response.content.decode().splitlines()
+        for line in (
+            'render_jobs{status="done"} 2',
+            'render_jobs{status="failed"} 1',
+            'render_jobs{status="queued"} 0',
+            'render_frames_total{backend="moviepy"} 360',
+            'render_frames_total{backend="ffmpeg"} 0',
+            # Cumulative buckets: 2 s falls in le=5, 10 s in le=15
+            'render_job_duration_seconds_bucket{backend="moviepy",status="done",le="1"} 0',
+            'render_job_duration_seconds_bucket{backend="moviepy",status="done",le="5"} 1',
+            'render_job_duration_seconds_bucket{backend="moviepy",status="done",le="15"} 2',
+            'render_job_duration_seconds_bucket{backend="moviepy",status="done",le="+Inf"} 2',
+            'render_job_duration_seconds_sum{backend="moviepy",status="done"} 12',
+            'render_job_duration_seconds_count{backend="moviepy",status="done"} 2',
+            'render_job_duration_seconds_count{backend="ffmpeg",status="failed"} 1',
+            'render_stage_duration_seconds_count{backend="moviepy",stage="decode"} 2',
+            'render_stage_cpu_seconds_total{backend="moviepy",stage="decode"} 2.25',
+            'render_job_fps_count{backend="moviepy"} 2',
+            '# TYPE render_job_fps histogram',
+            '# TYPE render_frames_total counter',
+        ):
+            self.assertIn(line, lines)
+        # Failed jobs have no throughput
+        self.assertFalse([line for line in lines if line.startswith('render_job_fps') and 'ffmpeg' in line])
+
+
+@override_settings(RENDER_HEARTBEAT_INTERVAL=0, RENDER_PROGRESS_INTERVAL=0.01)
+class ProgressTests(TestCase):
+    """Frame counts reach the job row and are streamed to clients as Server-Sent Events"""
+
+    def setUp(self):
+        self.job = RenderJob.objects.create(status=RenderJob.STATUS_RUNNING, started_at=timezone.now())
+
+    async def next_chunk(self, stream):
+        return (await asyncio.wait_for(anext(stream), 5)).decode()
+
+    def events(self, chunks):
+        return [chunk.split('event: ')[1].split('\n')[0] for chunk in chunks if 'event: ' in chunk]
+
+    @override_settings(RENDER_PROGRESS_INTERVAL=3600)
+    def test_frames_encoded_are_counted(self):
+        clip = ImageClip(np.zeros((4, 4, 3), dtype='uint8')).set_duration(1)
+        with reporting_progress(self.job.pk) as reporter:
+            set_total_frames(10)
+            counted = progress_clip(clip)
+            for t in (0, 0.1, 0.2):
+                counted.get_frame(t)
+            # Held until the interval passes or the render ends
+            self.assertEqual(RenderJob.objects.get(pk=self.job.pk).frames_done, 0)
+            self.assertEqual(reporter.pending, 3)
+        self.assertEqual(progress_clip(clip), clip)
+
+        job = RenderJob.objects.get(pk=self.job.pk)
+        self.assertEqual((job.frames_done, job.frames_total), (3, 10))
+        progress = job_progress(job)
+        self.assertEqual(progress['percent'], 30.0)
+        self.assertIsNotNone(progress['eta_seconds'])
+
+    async def test_stream_follows_the_job_until_it_finishes(self):
+        await RenderJob.objects.filter(pk=self.job.pk).aupdate(frames_total=10)
+        response = await self.async_client.get(reverse('render_job_events', args=[self.job.pk]))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = aiter(response.streaming_content)
+
+        first = await self.next_chunk(stream)
+        self.assertTrue(first.startswith('retry: '))
+        self.assertIn('"frames_done": 0', first)
+
+        await RenderJob.objects.filter(pk=self.job.pk).aupdate(frames_done=4, progress_at=timezone.now())
+        progress = await self.next_chunk(stream)
+        self.assertIn('"frames_done": 4', progress)
+        await RenderJob.objects.filter(pk=self.job.pk).aupdate(status=RenderJob.STATUS_DONE,
+                                                               output_filename='out.mp4')
+        done = await self.next_chunk(stream)
+        self.assertEqual(self.events([first, progress, done]), ['progress', 'progress', 'done'])
+        self.assertIn('"output_url": ', done)
+        with self.assertRaises(StopAsyncIteration):
+            await anext(stream)
+
+    async def test_finished_job_sends_one_event(self):
+        await RenderJob.objects.filter(pk=self.job.pk).aupdate(status=RenderJob.STATUS_FAILED, error='boom')
+        response = await self.async_client.get(reverse('render_job_events', args=[self.job.pk]))
+        chunks = [chunk.decode() async for chunk in response.streaming_content]
+        self.assertEqual(self.events(chunks), ['failed'])
+        self.assertIn('"error": "boom"', chunks[0])
+
+
+@override_settings(RENDER_HEARTBEAT_INTERVAL=0)
+class ProbeTests(TestCase):
+    """Inputs are probed from their headers and bad ones rejected before any job exists"""
+
+    REPORT = """Input #0, mov,mp4,m4a,3gp,3g2,mj2, from 'phone.mov':
+  Duration: 00:01:02.50, start: 0.000000, bitrate: 9000 kb/s
+    Stream #0:0(und): Video: mjpeg, yuvj420p, 300x300, 90k tbr, 90k tbn (attached pic)
+    Stream #0:1(und): Video: hevc (Main) (hvc1 / 0x31637668), yuv420p(tv), 1920x1080, 8000 kb/s, 29.97 fps, 30 tbr
+    Metadata:
+      rotate          : -90
+    Stream #0:2(und): Audio: aac (LC) (mp4a / 0x6134706D), 48000 Hz, 5.1(side), fltp, 256 kb/s
+"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmp = tempfile.mkdtemp()
+        cls.video = make_test_clip(os.path.join(cls.tmp, 'video.mp4'), (320, 180), 1)
+        cls.music = make_test_tone(os.path.join(cls.tmp, 'music.mp3'), 1)
+        cls.garbage = os.path.join(cls.tmp, 'garbage.mp4')
+        with open(cls.garbage, 'wb') as f:
+            f.write(b'not a video' * 100)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        use_temporary_media(self)
+
+    def test_parse_stream_report(self):
+        info = parse_stream_report(self.REPORT)
+        self.assertEqual(info['format'], 'mov,mp4,m4a,3gp,3g2,mj2')
+        self.assertEqual(info['duration'], 62.5)
+        # Cover art is not the video stream
+        self.assertEqual(info['video'], {'codec': 'hevc', 'width': 1920, 'height': 1080, 'fps': 29.97,
+                                         'rotation': 270})
+        self.assertEqual(info['audio'], {'codec': 'aac', 'sample_rate': 48000, 'channels': 6})
+        self.assertIsNone(parse_stream_report("garbage.mp4: Invalid data found when processing input"))
+
+    def assert_rejected(self, message, **inputs):
+        with self.assertRaisesRegex(InvalidMedia, message):
+            probe_inputs({field: (path, None) for field, path in inputs.items()})
+
+    def test_rejections(self):
+        self.assert_rejected('^video1 could not be read as media', video1=self.garbage)
+        self.assert_rejected(r'^video2 has no video stream \(audio only\)', video1=self.video, video2=self.music)
+        self.assert_rejected('^background_music has no audio stream', video1=self.video, background_music=self.video)
+        with override_settings(MAX_INPUT_DURATION=0.5):
+            self.assert_rejected('^video1 is 1 s long; the limit is 0.5 s', video1=self.video)
+        with override_settings(MIN_INPUT_DIMENSION=200):
+            self.assert_rejected('^video1 is 320x180; sides must be between 200', video1=self.video)
+        infos = probe_inputs({'video1': (self.video, None), 'video3': (None, None),
+                              'background_music': (self.music, None)})
+        self.assertEqual(set(infos), {'video1', 'background_music'})
+
+    def test_probes_are_cached_by_content(self):
+        info = get_probe(self.video, 'a' * 64)
+        self.assertEqual(MediaProbe.objects.get(sha256='a' * 64).info, info)
+        # The same content is not probed again, wherever it is stored
+        self.assertEqual(get_probe(os.path.join(self.tmp, 'gone.mp4'), 'a' * 64), info)
+
+    def test_bad_upload_is_rejected_before_queueing(self):
+        with open(self.garbage, 'rb') as video1, open(self.video, 'rb') as video2:
+            response = APIClient().post(reverse('combine_videos_api'), {
+                'video1': video1, 'video2': video2, 'watermark': '', 'text_overlay': '',
+            }, format='multipart')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('video1 could not be read', response.data['error'])
+        self.assertFalse(RenderJob.objects.exists())
+        self.assertEqual(os.listdir(input_dir()), [])
+
+
+class Asset:
+    """A pooled value that records being closed"""
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+@override_settings(RENDER_HEARTBEAT_INTERVAL=0)
+class AssetPoolTests(TestCase):
+    """Readers and decoded assets are kept between jobs, handed out safely and evicted when idle"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmp = tempfile.mkdtemp()
+        cls.video = make_test_clip(os.path.join(cls.tmp, 'video.mp4'), (320, 180), 1)
+        cls.music = make_test_tone(os.path.join(cls.tmp, 'music.mp3'), 1)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        # A pool of this test's own; no sweeper thread
+        self.pool = AssetPool(2 ** 30, 0)
+        patcher = mock.patch.object(asset_pool, '_pool', self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.pool.clear)
+
+    def add(self, pool, key, nbytes=10, shared=False):
+        return pool.add(key, Asset(), nbytes, close=Asset.close, shared=shared)
+
+    def test_exclusive_and_shared_values(self):
+        reader = self.add(self.pool, 'reader')
+        self.assertIsNone(self.pool.checkout('reader'))
+        self.pool.release(reader)
+        self.assertIs(self.pool.checkout('reader'), reader)
+
+        frames = self.add(self.pool, 'frames', shared=True)
+        self.assertIs(self.pool.checkout('frames'), frames)
+        self.assertIsNone(self.pool.checkout('other'))
+
+    def test_idle_values_are_evicted_oldest_first(self):
+        pool = AssetPool(100, 60)
+        pool._start_sweeper = lambda: None
+        values = [self.add(pool, key, nbytes=50) for key in 'abc']
+        held = self.add(pool, 'held', nbytes=50)
+        for value in values:
+            pool.release(value)
+        # Over the limit: only idle values go, least recently released first
+        self.assertEqual([value.closed for value in values], [True, True, False])
+        self.assertFalse(held.closed)
+
+        pool.entries[id(values[2])].last_used -= 61
+        pool.sweep()
+        self.assertTrue(values[2].closed)
+        self.assertEqual(list(pool.entries), [id(held)])
+
+    def test_value_that_cannot_be_rewound_is_closed(self):
+        def reset(value):
+            raise RuntimeError('broken pipe')
+        value = self.pool.add('reader', Asset(), 10, close=Asset.close, reset=reset)
+        self.pool.release(value)
+        self.assertTrue(value.closed)
+        self.assertIsNone(self.pool.checkout('reader'))
+
+    def test_released_reader_starts_again_from_the_first_frame(self):
+        fresh = RegionVideoFileClip(self.video, (90, 90), audio=False)
+        self.addCleanup(fresh.close)
+        expected = [fresh.get_frame(t).copy() for t in (0, 0.5)]
+
+        clip = open_region_clip(self.video, (90, 90))
+        for t in (0, 0.3, 0.6):
+            clip.get_frame(t)
+        release(clip)
+
+        again = open_region_clip(self.video, (90, 90))
+        self.assertIs(again, clip)
+        self.assertEqual(again.reader.pos, 1)
+        for t, frame in zip((0, 0.5), expected):
+            np.testing.assert_array_equal(again.get_frame(t), frame)
+        # In use: the next job gets a reader of its own
+        other = open_region_clip(self.video, (90, 90))
+        self.assertIsNot(other, again)
+        release(again)
+        release(other)
+
+    def test_short_loop_and_music_are_decoded_once_and_shared(self):
+        frames = open_region_clip(self.video, (90, 90), loop_duration=5)
+        self.assertIsInstance(frames, PreparedVideoClip)
+        self.assertIs(open_region_clip(self.video, (90, 90), loop_duration=5), frames)
+        self.assertFalse(frames.frames.flags.writeable)
+        release(frames)
+        release(frames)
+
+        samples = music_samples(self.music)
+        self.assertIs(music_samples(self.music), samples)
+        np.testing.assert_array_equal(samples, decode_pcm(self.music))
+        release(samples)
+        release(samples)
+
+        # Music too long to keep is streamed by the mix instead
+        longer = make_test_tone(os.path.join(self.tmp, 'longer.mp3'), 2)
+        with override_settings(LOOP_CACHE_MAX_BYTES=1000):
+            self.assertIsNone(music_samples(longer))
@@ -0,0 +1,197 @@
+"""
+Upload handling that writes each uploaded file to disk exactly once.
+
+Django's default handlers spool an upload to memory or a temp file, and the
+view then copied it again into MEDIA_ROOT/input_videos. This handler streams
+the body straight into the input directory, hashes it on the way and links
+it to its content address (sha256 + extension) when it completes, so the
+link is the only extra filesystem operation. Size limits are enforced from
+Content-Length before the body is read and again while data arrives.
+
+Identical uploads may arrive at once. Linking fails if the content address
+exists, so exactly one request creates it. Until it closes, each request
+keeps a hard link of its own to the stored file. A request that fails only
+removes the file if it created it and nothing else holds it: no other
+request's link, and no queued or running job or asset using it.
+"""
+import hashlib
+import os
+import re
+import uuid
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+
+
+class UploadTooLarge(Exception):
+    """Raised when a request or a single file exceeds the configured limits"""
+
+
+def input_dir():
+    path = os.path.join(settings.MEDIA_ROOT, 'input_videos')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def safe_extension(filename):
+    ext = os.path.splitext(filename or '')[1].lower()
+    return ext if re.fullmatch(r'\.[a-z0-9]{1,10}', ext) else ''
+
+
+def stored_upload_path(sha256):
+    """Path of a previously uploaded file given its content hash, or None"""
+    if not re.fullmatch(r'[0-9a-f]{64}', sha256 or ''):
+        return None
+    for name in os.listdir(input_dir()):
+        if name.startswith(sha256):
+            return os.path.join(input_dir(), name)
+    return None
+
+
+def remove_unless_held(path):
+    """
+    Remove a stored upload unless another request links to it or a queued
+    or running job or an asset uses it. The name is taken away first, so a
+    request linking to it at the same moment either holds a link already
+    or finds it gone and stores its own copy.
+    """
+    from .chunked_uploads import asset_paths
+    from .jobs import active_input_paths
+
+    if path is None or path in active_input_paths() | asset_paths():
+        return
+    removing_path = os.path.join(input_dir(), f".remove-{uuid.uuid4().hex}.part")
+    try:
+        os.rename(path, removing_path)
+    except OSError:
+        return
+    # Put it back if a request holds it, or queued a job with it and closed since the check above
+    if os.stat(removing_path).st_nlink > 1 or path in active_input_paths() | asset_paths():
+        try:
+            os.link(removing_path, path)
+        except FileExistsError:
+            pass  # stored again meanwhile, same content
+    os.remove(removing_path)
+
+
+def link_to_address(partial_path, path):
+    """
+    Store the finished file at `partial_path` under its content address
+    `path`, or find the identical file stored there already. Either way
+    `partial_path` is left as a link to the stored file, holding it until
+    it is removed. Returns whether this call created the file.
+    """
+    while True:
+        try:
+            os.link(partial_path, path)
+            return True
+        except FileExistsError:
+            pass
+        # Identical content is stored already: hold a link to it in place of our copy
+        hold_path = f"{partial_path}.hold"
+        try:
+            os.link(path, hold_path)
+        except FileNotFoundError:
+            continue  # removed meanwhile; store ours after all
+        os.replace(hold_path, partial_path)
+        return False
+
+
+class ContentAddressedUploadedFile(UploadedFile):
+    """An uploaded file stored under MEDIA_ROOT/input_videos/<sha256><ext>"""
+
+    def __init__(self, name, content_type, charset, content_type_extra=None):
+        self.partial_path = os.path.join(input_dir(), f".upload-{uuid.uuid4().hex}.part")
+        self.path = None
+        self.sha256 = None
+        self.created = False
+        file = open(self.partial_path, 'wb')
+        super().__init__(file, name, content_type, 0, charset, content_type_extra)
+
+    def finalize(self, sha256, size):
+        """Store the completed upload at its content address; the partial file stays as this request's link"""
+        self.file.close()
+        self.sha256 = sha256
+        self.size = size
+        self.path = os.path.join(input_dir(), f"{sha256}{safe_extension(self.name)}")
+        self.created = link_to_address(self.partial_path, self.path)
+        self.file = open(self.path, 'rb')
+
+    def close(self):
+        """Close the file and drop this request's link to it"""
+        try:
+            super().close()
+        except OSError:
+            pass
+        if self.path and self.partial_path:
+            try:
+                os.remove(self.partial_path)
+            except OSError:
+                pass
+            self.partial_path = None
+
+    def discard(self):
+        """Remove this upload, unless the same content was stored before it or is held elsewhere"""
+        unfinished = self.partial_path if self.path is None else None
+        stored = self.path if self.created else None
+        self.close()
+        self.partial_path = None
+        self.created = False
+        if unfinished:
+            try:
+                os.remove(unfinished)
+            except OSError:
+                pass
+        if stored:
+            remove_unless_held(stored)
+
+    def temporary_file_path(self):
+        return self.path
+
+
+class ContentAddressedUploadHandler(FileUploadHandler):
+    """Stream file fields directly to their final, content-addressed location"""
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.file = None
+        self.completed_files = []
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        if content_length > settings.MAX_UPLOAD_REQUEST_SIZE:
+            raise UploadTooLarge(
+                f"Request body is {content_length} bytes; the limit is {settings.MAX_UPLOAD_REQUEST_SIZE}"
+            )
+        return None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.hasher = hashlib.sha256()
+        self.file = ContentAddressedUploadedFile(
+            self.file_name, self.content_type, self.charset, self.content_type_extra
+        )
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) > settings.MAX_UPLOAD_FILE_SIZE:
+            self.upload_interrupted()
+            raise UploadTooLarge(
+                f"{self.file_name} exceeds the {settings.MAX_UPLOAD_FILE_SIZE} byte upload limit"
+            )
+        self.hasher.update(raw_data)
+        self.file.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        self.file.finalize(self.hasher.hexdigest(), file_size)
+        self.completed_files.append(self.file)
+        return self.file
+
+    def upload_interrupted(self):
+        """Drop the file in progress and everything this request stored so far"""
+        if self.file is not None:
+            self.file.discard()
+        for uploaded_file in self.completed_files:
+            uploaded_file.discard()
+        self.completed_files = []
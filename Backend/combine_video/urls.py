@@ -1,10 +1,28 @@
 # urls.py
 from django.urls import path
-from .views import VideoCombinerAPIView, video_combiner_view
+from .views import (
+    VideoCombinerAPIView, BatchCombinerAPIView, RenderJobStatusAPIView, RenderJobResultAPIView,
+    RenderBatchStatusAPIView, PreviewAPIView, UploadSessionAPIView, UploadSessionDetailAPIView,
+    UploadSessionFinalizeAPIView, video_combiner_view, metrics_view, output_video_view,
+    render_job_events_view,
+)
 from django.conf import settings
 from django.conf.urls.static import static
 
 urlpatterns = [
     path('api/combine-videos/', VideoCombinerAPIView.as_view(), name='combine_videos_api'),
+    path('api/combine-videos/batch/', BatchCombinerAPIView.as_view(), name='batch_combine_api'),
+    path('api/batches/<uuid:batch_id>/', RenderBatchStatusAPIView.as_view(), name='render_batch_status'),
+    path('api/preview/', PreviewAPIView.as_view(), name='preview_api'),
+    path('api/uploads/', UploadSessionAPIView.as_view(), name='upload_sessions'),
+    path('api/uploads/<uuid:upload_id>/', UploadSessionDetailAPIView.as_view(), name='upload_session'),
+    path('api/uploads/<uuid:upload_id>/finalize/', UploadSessionFinalizeAPIView.as_view(),
+         name='upload_session_finalize'),
+    path('api/jobs/<uuid:job_id>/', RenderJobStatusAPIView.as_view(), name='render_job_status'),
+    path('api/jobs/<uuid:job_id>/result/', RenderJobResultAPIView.as_view(), name='render_job_result'),
+    path('api/jobs/<uuid:job_id>/events/', render_job_events_view, name='render_job_events'),
+    path('metrics/', metrics_view, name='metrics'),
+    # Ahead of the static() fallback below, which has no Range support
+    path(f"{settings.MEDIA_URL.lstrip('/')}output_videos/<str:filename>", output_video_view, name='output_video'),
     path('', video_combiner_view, name='video_combiner'),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
@@ -1,14 +1,38 @@
-from django.shortcuts import render
+from django.shortcuts import render, get_object_or_404
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.urls import reverse
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from django.conf import settings
 import os
-from .tasks import combine_videos_vertically
+from .jobs import submit_render_job, submit_render_batch, remove_stale_inputs, job_input_paths
+from .models import RenderJob, RenderBatch, RenderBatchItem, UploadSession
+from .tasks import RENDER_BACKENDS
+from .encoder_profiles import DEFAULT_ENCODER_PROFILE, get_encoder_profile
+from .render_cache import render_cache_key, get_or_create_render_job, touch_render
+from .serving import file_response
+from .memory import estimate_render_memory
+from .probe import probe_inputs
+from .layouts import check_layout, parse_layout
+from .captions import check_captions, check_caption_style
+from .metrics import prometheus_text
+from .progress import job_events, job_progress
+from .preview import render_preview
+from .upload_handlers import ContentAddressedUploadHandler, UploadTooLarge
+from .chunked_uploads import (
+    UploadConflict, UnknownAsset, asset_path, create_session, write_chunk, finalize_session, remove_session
+)
 import uuid
 
 class VideoCombinerAPIView(APIView):
+    def initialize_request(self, request, *args, **kwargs):
+        # Stream uploads straight to their final location instead of spooling them first
+        request.upload_handlers = [ContentAddressedUploadHandler(request)]
+        return super().initialize_request(request, *args, **kwargs)
+
     def post(self, request):
+        uploads = []
         try:
             # Generate unique filename for uploaded files
             def get_unique_filename(filename):
@@ -18,93 +42,704 @@ class VideoCombinerAPIView(APIView):
             # Handle file uploads
             video1 = request.FILES.get('video1')
             video2 = request.FILES.get('video2')
+            video3 = request.FILES.get('video3')
             background_music = request.FILES.get('background_music')
+            captions = request.FILES.get('captions')
+            uploads = [f for f in (video1, video2, video3, background_music, captions) if f]
+            
+            # Each input is an upload or the asset id of a chunked upload
+            data = request.data
+            video1_path, video1_id = request_input(request, data, 'video1')
+            video2_path, video2_id = request_input(request, data, 'video2')
+            video3_path, video3_id = request_input(request, data, 'video3')
+            background_music_path, background_music_id = request_input(request, data, 'background_music')
+            captions_path, captions_id = request_input(request, data, 'captions')
             
-            if not all([video1, video2]):
+            if not all([video1_path, video2_path]):
+                discard_uploads(uploads)
                 return Response(
-                    {"error": "Both videos are required"}, 
+                    {"error": "Both videos are required, as uploads or as video1_id and video2_id"}, 
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
+            # Reject unusable inputs before anything is queued
+            infos = probe_inputs({
+                'video1': (video1_path, video1_id),
+                'video2': (video2_path, video2_id),
+                'video3': (video3_path, video3_id),
+                'background_music': (background_music_path, background_music_id),
+            })
+            if captions_path:
+                check_captions(captions_path)
+
             # Create media directories if they don't exist
-            input_dir = os.path.join(settings.MEDIA_ROOT, 'input_videos')
             output_dir = os.path.join(settings.MEDIA_ROOT, 'output_videos')
-            os.makedirs(input_dir, exist_ok=True)
             os.makedirs(output_dir, exist_ok=True)
 
-            # Save uploaded files with unique names
-            video1_path = os.path.join(input_dir, get_unique_filename(video1.name))
-            video2_path = os.path.join(input_dir, get_unique_filename(video2.name))
+            # Uploaded files are already stored under their content hash
             output_filename = get_unique_filename('output.mp4')
             output_path = os.path.join(output_dir, output_filename)
-            
-            with open(video1_path, 'wb+') as destination:
-                for chunk in video1.chunks():
-                    destination.write(chunk)
-            
-            with open(video2_path, 'wb+') as destination:
-                for chunk in video2.chunks():
-                    destination.write(chunk)
-
-            background_music_path = None
-            if background_music:
-                background_music_path = os.path.join(input_dir, get_unique_filename(background_music.name))
-                with open(background_music_path, 'wb+') as destination:
-                    for chunk in background_music.chunks():
-                        destination.write(chunk)
 
             # Get parameters from request data
-            data = request.data
-            
-            # Parse aspect ratio into tuple of integers
-            aspect_ratio_str = data.get('aspect_ratio', '16:9')
-            aspect_ratio = tuple(map(int, aspect_ratio_str.split(':')))
-
             params = {
                 'video1_path': video1_path,
                 'video2_path': video2_path,
+                'video3_path': video3_path,
                 'output_path': output_path,
-                'video1_offset': int(data.get('video1_offset', 30)),
-                'video2_offset': int(data.get('video2_offset', 30)),
-                'target_resolution': int(data.get('target_resolution', 1024)),
-                'watermark': str(data.get('watermark', '@KunalChaudhary2')),
-                'watermark_opacity': float(data.get('watermark_opacity', 0.6)),
-                'bg_music_volume': float(data.get('bg_music_volume', 0.2)),
                 'background_music_path': background_music_path,
-                'text_overlay': str(data.get('text_overlay', 'Follow for more!\nLike & Subscribe')),
-                'text_color': str(data.get('text_color', '#FFD700')),
-                'text_position': str(data.get('text_position', 'bottom')),
-                'text_fontsize': int(data.get('text_fontsize', 50)),
-                'text_font': str(data.get('text_font', 'Impact')),
-                'aspect_ratio': aspect_ratio,  # Updated to use tuple
+                'captions_path': captions_path,
+                **audio_params(data),
+                **layout_params(data),
+                **caption_params(data),
+                **output_params(data),
             }
+            route_render(params, infos)
 
-            # Call the video combining function
-            combine_videos_vertically(**params)
-            
-            # Clean up input files
-            os.remove(video1_path)
-            os.remove(video2_path)
-            if background_music_path:
-                os.remove(background_music_path)
-
-            # Return the URL of the processed video
-            output_url = f"{settings.MEDIA_URL}output_videos/{output_filename}"
-            return Response({
-                "message": "Video processing completed",
-                "output_url": output_url
-            }, status=status.HTTP_200_OK)
+            # Queue the render instead of running it inside the request.
+            # Its uploads are removed after it; assets only once they expire
+            input_paths = job_input_paths(params, [f.temporary_file_path() for f in uploads])
 
+            # Identical inputs and parameters reuse an existing render
+            cache_key = render_cache_key(
+                [video1_id, video2_id, background_music_id if params['background_music_path'] else None,
+                 video3_id if params['video3_path'] else None, captions_id if params['captions_path'] else None],
+                params
+            )
+            job, created = get_or_create_render_job(
+                cache_key,
+                params=params,
+                input_paths=input_paths,
+                output_filename=output_filename,
+                memory_ceiling=estimate_render_memory(params, infos),
+            )
+
+            if not created:
+                discard_uploads(uploads)
+                if job.status == RenderJob.STATUS_DONE:
+                    return Response(
+                        job_payload(request, job, message="Video processing completed", cached=True),
+                        status=status.HTTP_200_OK
+                    )
+                return Response(
+                    job_payload(request, job, message="Video processing queued"),
+                    status=status.HTTP_202_ACCEPTED
+                )
+
+            submit_render_job(job)
+
+            return Response(
+                job_payload(request, job, message="Video processing queued"),
+                status=status.HTTP_202_ACCEPTED
+            )
+
+        except UploadTooLarge as e:
+            return Response(
+                {"error": str(e)},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+        except UnknownAsset as e:
+            discard_uploads(uploads)
+            return Response(
+                {"error": str(e)},
+                status=status.HTTP_404_NOT_FOUND
+            )
         except ValueError as ve:
+            discard_uploads(uploads)
             return Response(
                 {"error": f"Invalid input value: {str(ve)}"}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
         except Exception as e:
+            discard_uploads(uploads)
             return Response(
                 {"error": str(e)}, 
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+class BatchCombinerAPIView(APIView):
+    """
+    Render many video1 files against one shared video2 and background
+    music. The shared assets are decoded once for the whole batch and the
+    items render in parallel on the worker pool.
+    """
+
+    def initialize_request(self, request, *args, **kwargs):
+        request.upload_handlers = [ContentAddressedUploadHandler(request)]
+        return super().initialize_request(request, *args, **kwargs)
+
+    def post(self, request):
+        uploads = []
+        try:
+            video1_files = request.FILES.getlist('video1')
+            video2 = request.FILES.get('video2')
+            video3 = request.FILES.get('video3')
+            background_music = request.FILES.get('background_music')
+            captions = request.FILES.get('captions')
+            uploads = [f for f in video1_files + [video2, video3, background_music, captions] if f]
+
+            # The shared inputs may be assets uploaded once in chunks
+            data = request.data
+            video2_path, video2_id = request_input(request, data, 'video2')
+            video3_path, video3_id = request_input(request, data, 'video3')
+            background_music_path, background_music_id = request_input(request, data, 'background_music')
+            captions_path, captions_id = request_input(request, data, 'captions')
+
+            if not video1_files or not video2_path:
+                discard_uploads(uploads)
+                return Response(
+                    {"error": "video2 (or video2_id) and at least one video1 are required"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            if len(video1_files) > settings.MAX_BATCH_ITEMS:
+                raise ValueError(f"A batch takes at most {settings.MAX_BATCH_ITEMS} video1 files")
+
+            # Probe every input before the batch exists, so a bad file rejects all of it
+            shared_infos = probe_inputs({
+                'video2': (video2_path, video2_id),
+                'video3': (video3_path, video3_id),
+                'background_music': (background_music_path, background_music_id),
+            })
+            if captions_path:
+                check_captions(captions_path)
+            video1_infos = []
+            for video1 in video1_files:
+                try:
+                    video1_infos.append(probe_inputs({'video1': (video1.temporary_file_path(), video1.sha256)}))
+                except ValueError as e:
+                    raise ValueError(f"{video1.name}: {str(e)}")
+
+            output_dir = os.path.join(settings.MEDIA_ROOT, 'output_videos')
+            os.makedirs(output_dir, exist_ok=True)
+
+            shared_params = {
+                'video2_path': video2_path,
+                'video3_path': video3_path,
+                'background_music_path': background_music_path,
+                'captions_path': captions_path,
+                **audio_params(data),
+                **layout_params(data),
+                **caption_params(data),
+                **output_params(data),
+            }
+            batch = RenderBatch.objects.create()
+            # Only the MoviePy pipelines read prepared frames and samples
+            if shared_params['render_backend'] in ('moviepy', 'segmented'):
+                shared_params['prepared_dir'] = os.path.join(settings.PREPARED_ASSET_DIR, str(batch.id))
+
+            created_jobs = []
+            unused = list(uploads)
+            for index, video1 in enumerate(video1_files):
+                output_filename = f"{uuid.uuid4()}.mp4"
+                params = dict(
+                    shared_params,
+                    video1_path=video1.temporary_file_path(),
+                    output_path=os.path.join(output_dir, output_filename),
+                )
+                infos = dict(shared_infos, **video1_infos[index])
+                route_render(params, infos)
+                input_paths = job_input_paths(params, [
+                    f.temporary_file_path() for f in (video2, video3, background_music, captions) if f
+                ])
+
+                cache_key = render_cache_key(
+                    [video1.sha256, video2_id, background_music_id if params['background_music_path'] else None,
+                     video3_id if params['video3_path'] else None, captions_id if params['captions_path'] else None],
+                    params
+                )
+                job, created = get_or_create_render_job(
+                    cache_key,
+                    params=params,
+                    input_paths=input_paths,
+                    output_filename=output_filename,
+                    memory_ceiling=estimate_render_memory(params, infos),
+                )
+                RenderBatchItem.objects.create(batch=batch, job=job, index=index, source_name=video1.name or '')
+
+                if created:
+                    created_jobs.append(job)
+                    unused = [f for f in unused if f not in (video1, video2, video3, background_music, captions)]
+
+            # Files only needed by renders that already exist
+            discard_uploads(unused)
+            submit_render_batch(created_jobs, shared_params.get('prepared_dir') if len(created_jobs) > 1 else None)
+
+            return Response(
+                batch_payload(request, batch, message="Batch queued"),
+                status=status.HTTP_202_ACCEPTED
+            )
+
+        except UploadTooLarge as e:
+            return Response(
+                {"error": str(e)},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+        except UnknownAsset as e:
+            discard_uploads(uploads)
+            return Response(
+                {"error": str(e)},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        except ValueError as ve:
+            discard_uploads(uploads)
+            return Response(
+                {"error": f"Invalid input value: {str(ve)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        except Exception as e:
+            discard_uploads(uploads)
+            return Response(
+                {"error": str(e)},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+def layout_params(data):
+    """Read the parameters that decide what the output looks like"""
+    # Parse aspect ratio into tuple of integers
+    aspect_ratio_str = data.get('aspect_ratio', '16:9')
+    aspect_ratio = tuple(map(int, aspect_ratio_str.split(':')))
+
+    return {
+        'video1_offset': int(data.get('video1_offset', 30)),
+        'video2_offset': int(data.get('video2_offset', 30)),
+        'target_resolution': int(data.get('target_resolution', 1024)),
+        'watermark': str(data.get('watermark', '@KunalChaudhary2')),
+        'watermark_opacity': float(data.get('watermark_opacity', 0.6)),
+        'text_overlay': str(data.get('text_overlay', 'Follow for more!\nLike & Subscribe')),
+        'text_color': str(data.get('text_color', '#FFD700')),
+        'text_position': str(data.get('text_position', 'bottom')),
+        'text_fontsize': int(data.get('text_fontsize', 50)),
+        'text_font': str(data.get('text_font', 'Impact')),
+        'aspect_ratio': aspect_ratio,  # Updated to use tuple
+        'layout': parse_layout(data.get('layout')),  # template name or layout object
+    }
+
+def caption_params(data):
+    """Read how timed captions are drawn"""
+    params = {
+        'caption_font': str(data.get('caption_font', 'Arial-Bold')),
+        'caption_fontsize': int(data.get('caption_fontsize', 40)),
+        'caption_color': str(data.get('caption_color', 'white')),
+        'caption_position': str(data.get('caption_position', 'bottom')),
+    }
+    if params['caption_fontsize'] < 1:
+        raise ValueError("caption_fontsize must be positive")
+    check_caption_style(params['caption_font'], params['caption_color'], params['caption_position'])
+    return params
+
+def audio_params(data):
+    """Read the background music mixing parameters"""
+    return {
+        'bg_music_volume': float(data.get('bg_music_volume', 0.2)),
+        'duck_music': str(data.get('duck_music', 'false')).lower() in ('1', 'true', 'yes', 'on'),
+    }
+
+def output_params(data):
+    """Read and validate the render backend and encoder profile"""
+    render_backend = str(data.get('render_backend', 'moviepy'))
+    if render_backend not in RENDER_BACKENDS:
+        raise ValueError(f"render_backend must be one of {', '.join(RENDER_BACKENDS)}")
+
+    encoder_profile = str(data.get('encoder_profile', DEFAULT_ENCODER_PROFILE))
+    get_encoder_profile(encoder_profile)
+
+    return {
+        'render_backend': render_backend,
+        'encoder_profile': encoder_profile,
+    }
+
+def route_render(params, infos):
+    """
+    Drop inputs and audio work the layout and probed inputs make pointless,
+    so the render takes the cheaper path and shares its cache entry with
+    equivalent requests. Raises InvalidLayout for layouts that cannot render.
+    """
+    # A video3 the layout does not show is never decoded
+    if 'video3' not in check_layout(params).sources:
+        params['video3_path'] = None
+    # Caption style only matters with captions
+    if not params.get('captions_path'):
+        for key in ('caption_font', 'caption_fontsize', 'caption_color', 'caption_position'):
+            params.pop(key, None)
+    # Music at zero volume needs no mixing; video1's own audio is used
+    if params['background_music_path'] and params['bg_music_volume'] <= 0:
+        params['background_music_path'] = None
+    # Nothing to duck under without both tracks
+    if not params['background_music_path'] or infos['video1']['audio'] is None:
+        params['duck_music'] = False
+    return params
+
+def request_input(request, data, field):
+    """
+    (path, sha256) of an input sent as an upload or named by the asset id
+    in `<field>_id`; (None, None) when neither was sent.
+    """
+    upload = request.FILES.get(field)
+    if upload:
+        return upload.temporary_file_path(), upload.sha256
+    asset_id = str(data.get(f'{field}_id', '') or '').lower()
+    if not asset_id:
+        return None, None
+    return asset_path(asset_id), asset_id
+
+def discard_uploads(uploads):
+    """Remove files stored for a request that will not be rendered"""
+    for uploaded_file in uploads:
+        uploaded_file.close()
+        if hasattr(uploaded_file, 'discard'):
+            uploaded_file.discard()
+
+def output_response(request, job, filename=None):
+    """Serve a finished job's output, counting it as used once per playback"""
+    # Later ranges are seeks within a playback already counted
+    if request.META.get('HTTP_RANGE', 'bytes=0-').startswith('bytes=0-'):
+        touch_render(job)
+    return file_response(request, job.params['output_path'], 'video/mp4', filename=filename)
+
+def job_payload(request, job, **extra):
+    """Serialize a RenderJob for the job API responses"""
+    payload = {
+        "job_id": str(job.id),
+        "status": job.status,
+        "status_url": request.build_absolute_uri(reverse('render_job_status', args=[job.id])),
+        "result_url": request.build_absolute_uri(reverse('render_job_result', args=[job.id])),
+        "events_url": request.build_absolute_uri(reverse('render_job_events', args=[job.id])),
+    }
+    if job.status == RenderJob.STATUS_RUNNING:
+        payload["progress"] = job_progress(job)
+    if job.status == RenderJob.STATUS_DONE:
+        payload["output_url"] = job.output_url
+    if job.status == RenderJob.STATUS_FAILED:
+        payload["error"] = job.error
+    payload.update(extra)
+    return payload
+
+
+def batch_payload(request, batch, **extra):
+    """Serialize a RenderBatch with the status of every item"""
+    items = []
+    counts = {choice: 0 for choice, _ in RenderJob.STATUS_CHOICES}
+    for item in batch.items.select_related('job'):
+        counts[item.job.status] += 1
+        items.append({"index": item.index, "name": item.source_name, **job_payload(request, item.job)})
+
+    payload = {
+        "batch_id": str(batch.id),
+        "status_url": request.build_absolute_uri(reverse('render_batch_status', args=[batch.id])),
+        "finished": counts[RenderJob.STATUS_QUEUED] == counts[RenderJob.STATUS_RUNNING] == 0,
+        "counts": counts,
+        "items": items,
+    }
+    payload.update(extra)
+    return payload
+
+
+class RenderJobStatusAPIView(APIView):
+    def get(self, request, job_id):
+        job = get_object_or_404(RenderJob, pk=job_id)
+        return Response(job_payload(request, job), status=status.HTTP_200_OK)
+
+
+class RenderBatchStatusAPIView(APIView):
+    def get(self, request, batch_id):
+        batch = get_object_or_404(RenderBatch, pk=batch_id)
+        return Response(batch_payload(request, batch), status=status.HTTP_200_OK)
+
+
+class RenderJobResultAPIView(APIView):
+    def get(self, request, job_id):
+        job = get_object_or_404(RenderJob, pk=job_id)
+        if job.status != RenderJob.STATUS_DONE:
+            return Response(job_payload(request, job), status=status.HTTP_409_CONFLICT)
+
+        output_path = job.params['output_path']
+        if not os.path.exists(output_path):
+            return Response(
+                {"error": "Output video is no longer available"},
+                status=status.HTTP_410_GONE
+            )
+        return output_response(request, job, filename=job.output_filename)
+
+
+class PreviewAPIView(APIView):
+    """
+    Render one frame (jpeg/png) or a short low-res animation (gif/webp) of
+    the layout. Videos are uploaded as video1/video2 (and video3 for layouts
+    that show one) or, once stored, referenced by the video1_id/video2_id
+    returned in the response headers. Captions are uploaded or referenced
+    the same way, as captions/captions_id.
+    """
+
+    def initialize_request(self, request, *args, **kwargs):
+        request.upload_handlers = [ContentAddressedUploadHandler(request)]
+        return super().initialize_request(request, *args, **kwargs)
+
+    def get(self, request):
+        return self.render_preview(request, request.query_params)
+
+    def post(self, request):
+        return self.render_preview(request, request.data)
+
+    def render_preview(self, request, data):
+        uploads = []
+        try:
+            video_ids = {}
+            for field in ('video1', 'video2', 'video3'):
+                upload = request.FILES.get(field)
+                if upload:
+                    uploads.append(upload)
+                    video_ids[field] = upload.sha256
+                else:
+                    video_ids[field] = str(data.get(f'{field}_id', ''))
+
+            if not (video_ids['video1'] and video_ids['video2']):
+                discard_uploads(uploads)
+                return Response(
+                    {"error": "Both videos are required, as uploads or as video1_id and video2_id"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            # Only the videos the layout shows are opened
+            params = layout_params(data)
+            video_ids = {field: video_id for field, video_id in video_ids.items() if video_id}
+            sources = check_layout(dict(params, **{f'{field}_path': True for field in video_ids})).sources
+            video_ids = {field: video_id for field, video_id in video_ids.items() if field in sources}
+
+            paths = {}
+            for field, video_id in video_ids.items():
+                # Also keeps sources that are being previewed from expiring
+                try:
+                    paths[field] = asset_path(video_id)
+                except UnknownAsset:
+                    discard_uploads(uploads)
+                    return Response(
+                        {"error": f"{field} is not stored on the server; upload it again"},
+                        status=status.HTTP_404_NOT_FOUND
+                    )
+            captions_path, captions_id = request_input(request, data, 'captions')
+            if request.FILES.get('captions'):
+                uploads.append(request.FILES['captions'])
+            if captions_path:
+                check_captions(captions_path)
+                params.update(caption_params(data), captions_path=captions_path)
+            remove_stale_inputs(settings.PREVIEW_INPUT_TTL)
+            probe_inputs({field: (paths[field], video_ids[field]) for field in paths})
+
+            image, content_type = render_preview(
+                paths['video1'],
+                paths.get('video2'),
+                video3_path=paths.get('video3'),
+                t=float(data.get('t', 0)),
+                duration=float(data.get('duration', 0)),
+                fps=int(data.get('fps', 8)),
+                resolution=int(data.get('preview_resolution', 480)),
+                image_format=str(data.get('image_format', 'jpeg')),
+                **params
+            )
+
+            response = HttpResponse(image, content_type=content_type)
+            for field, video_id in video_ids.items():
+                response[f'X-{field.capitalize()}-Id'] = video_id
+            if captions_id:
+                response['X-Captions-Id'] = captions_id
+            return response
+
+        except UploadTooLarge as e:
+            return Response(
+                {"error": str(e)},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+        except UnknownAsset as e:
+            discard_uploads(uploads)
+            return Response(
+                {"error": str(e)},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        except ValueError as ve:
+            discard_uploads(uploads)
+            return Response(
+                {"error": f"Invalid input value: {str(ve)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        except Exception as e:
+            discard_uploads(uploads)
+            return Response(
+                {"error": str(e)},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+
+def upload_payload(request, session, **extra):
+    """Serialize an UploadSession for the chunked upload API"""
+    payload = {
+        "upload_id": str(session.id),
+        "status": session.status,
+        "filename": session.filename,
+        "size": session.size,
+        "offset": session.received,
+        "upload_url": request.build_absolute_uri(reverse('upload_session', args=[session.id])),
+        "finalize_url": request.build_absolute_uri(reverse('upload_session_finalize', args=[session.id])),
+    }
+    if session.status == UploadSession.STATUS_COMPLETE:
+        payload["asset_id"] = session.sha256
+    payload.update(extra)
+    return payload
+
+
+class UploadSessionAPIView(APIView):
+    """
+    Open a resumable upload with the file's filename, size and sha256.
+    The bytes then go to upload_url in chunks and finalize_url completes
+    it, returning the asset_id to send as video1_id, video2_id or
+    background_music_id.
+    """
+
+    def post(self, request):
+        try:
+            data = request.data
+            session = create_session(
+                str(data.get('filename', '')),
+                int(data.get('size', 0)),
+                str(data.get('sha256', ''))
+            )
+            return Response(upload_payload(request, session), status=status.HTTP_201_CREATED)
+
+        except UploadTooLarge as e:
+            return Response(
+                {"error": str(e)},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+        except ValueError as ve:
+            return Response(
+                {"error": f"Invalid input value: {str(ve)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        except Exception as e:
+            return Response(
+                {"error": str(e)},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+
+class UploadSessionDetailAPIView(APIView):
+    """
+    GET reports the offset to continue from. PUT ?offset=N with the raw
+    bytes as the body stores the next chunk. DELETE aborts the upload.
+    """
+
+    def get(self, request, upload_id):
+        session = get_object_or_404(UploadSession, pk=upload_id)
+        return Response(upload_payload(request, session), status=status.HTTP_200_OK)
+
+    def put(self, request, upload_id):
+        session = get_object_or_404(UploadSession, pk=upload_id)
+        try:
+            length = request.META.get('CONTENT_LENGTH')
+            if not length:
+                return Response(
+                    {"error": "Chunks need a Content-Length"},
+                    status=status.HTTP_411_LENGTH_REQUIRED
+                )
+            if 'offset' not in request.query_params:
+                raise ValueError("offset is required")
+
+            session = write_chunk(session, int(request.query_params['offset']), request.stream, int(length))
+            return Response(upload_payload(request, session), status=status.HTTP_200_OK)
+
+        except UploadConflict as e:
+            session.refresh_from_db()
+            return Response(
+                upload_payload(request, session, error=str(e)),
+                status=status.HTTP_409_CONFLICT
+            )
+        except UploadTooLarge as e:
+            return Response(
+                {"error": str(e)},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+        except ValueError as ve:
+            return Response(
+                {"error": f"Invalid input value: {str(ve)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        except Exception as e:
+            return Response(
+                {"error": str(e)},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+    def delete(self, request, upload_id):
+        session = get_object_or_404(UploadSession, pk=upload_id)
+        if session.status == UploadSession.STATUS_COMPLETE:
+            return Response(
+                {"error": "Finished uploads are kept as assets until they expire"},
+                status=status.HTTP_409_CONFLICT
+            )
+        if session.status == UploadSession.STATUS_FINALIZING:
+            return Response(
+                {"error": "Upload is being finalized"},
+                status=status.HTTP_409_CONFLICT
+            )
+        remove_session(session)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class UploadSessionFinalizeAPIView(APIView):
+    """Verify the checksum of a fully sent upload and store it as an asset"""
+
+    def post(self, request, upload_id):
+        session = get_object_or_404(UploadSession, pk=upload_id)
+        try:
+            session = finalize_session(session)
+            return Response(
+                upload_payload(request, session, message="Upload complete"),
+                status=status.HTTP_200_OK
+            )
+
+        except UploadConflict as e:
+            return Response(
+                upload_payload(request, session, error=str(e)),
+                status=status.HTTP_409_CONFLICT
+            )
+        except ValueError as ve:
+            return Response(
+                {"error": str(ve)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        except Exception as e:
+            return Response(
+                {"error": str(e)},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+
+def output_video_view(request, filename):
+    """Serve a finished output at its MEDIA_URL address, with Range support"""
+    job = RenderJob.objects.filter(output_filename=filename, status=RenderJob.STATUS_DONE).first()
+    if job is None or not os.path.exists(job.params['output_path']):
+        raise Http404("Output video is not available")
+    return output_response(request, job)
+
+
 def video_combiner_view(request):
-    return render(request, 'index.html')
\ No newline at end of file
+    return render(request, 'index.html')
+
+
+async def render_job_events_view(request, job_id):
+    """
+    Server-Sent Events with a job's progress until it is done or failed.
+    Served from an async view so waiting clients hold no worker thread
+    under ASGI; under WSGI the stream is only sent once the job finishes.
+    """
+    job = await RenderJob.objects.filter(pk=job_id).afirst()
+    if job is None:
+        raise Http404("No render job matches the given query.")
+    response = StreamingHttpResponse(job_events(job), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Keep nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint for render job counts and stage profiles"""
+    return HttpResponse(prometheus_text(), content_type='text/plain; version=0.0.4; charset=utf-8')